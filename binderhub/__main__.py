@@ -1,3 +1,8 @@
 if __name__ == '__main__':
+    import sys
+    if '--profile-startup' in sys.argv:
+        # start before importing the app, to time its imports
+        from binderhub import startup
+        startup.start_profile()
     from binderhub.app import main
     main()
@@ -12,13 +12,14 @@ from glob import glob
 import tempfile
 from urllib.parse import urlparse
 
-import kubernetes.client
-import kubernetes.config
-from jinja2 import Environment, FileSystemLoader, PrefixLoader, ChoiceLoader
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader, PrefixLoader, ChoiceLoader
 from tornado.httpclient import AsyncHTTPClient
 from tornado.httpserver import HTTPServer
+from tornado.netutil import Resolver
 import tornado.ioloop
+import tornado.netutil
 import tornado.options
+import tornado.process
 import tornado.log
 from tornado.log import app_log
 import tornado.web
@@ -30,7 +31,6 @@ from traitlets import (
     Unicode,
     Union,
     default,
-    observe,
     validate,
 )
 from traitlets.config import Application
@@ -38,23 +38,36 @@ from jupyterhub.services.auth import HubOAuthCallbackHandler
 from jupyterhub.traitlets import Callable
 
 from .base import AboutHandler, Custom404, VersionHandler
-from .build import Build
-from .builder import BuildHandler
+from .builder import BUILD_COUNT, LAUNCH_COUNT, BuildHandler, BuildWebSocketHandler
 from .config import ConfigHandler
+from .dns import CachingResolver, aiodns
 from .health import HealthHandler
+from .jobs import JobHandler, LaunchJobHandler
 from .launcher import Launcher
 from .log import log_request
 from .repoproviders import RepoProvider
 from .registry import DockerRegistry
-from .main import MainHandler, ParameterizedMainHandler, LegacyRedirectHandler
+from .main import MainHandler, ParameterizedMainHandler, LegacyRedirectHandler, NbviewerHandler
+from .main import nbviewer_cache
+from . import startup
 from .repoproviders import (GitHubRepoProvider, GitRepoProvider,
                             GitLabRepoProvider, GistRepoProvider,
                             ZenodoProvider, FigshareProvider, HydroshareProvider,
-                            DataverseProvider, RDMProvider, WEKO3Provider)
+                            DataverseProvider, RDMProvider, WEKO3Provider,
+                            DoiProvider)
 from .rdm import RDMRedirectHandler, WEKO3RedirectHandler
-from .metrics import MetricsHandler
-
-from .utils import ByteSpecification, url_path_join
+from .metrics import MetricsHandler, clear_multiprocess_dir, mark_dead_workers
+from .snapshot import CacheSnapshot
+from .staticfiles import StaticFileHandler
+from .status import RepoStatusHandler
+
+from .utils import (
+    ByteSpecification,
+    NetworkMatcher,
+    multiprocess_dir,
+    patch_kubernetes_threadpool,
+    url_path_join,
+)
 from .events import EventLog
 
 from .repoauth import RepoAuthCallbackHandler
@@ -81,9 +94,23 @@ class BinderHub(Application):
         'debug': (
             {'BinderHub': {'debug': True}},
             "Enable debug HTTP serving & debug logging"
-        )
+        ),
+        'profile-startup': (
+            {'BinderHub': {'profile_startup': True}},
+            "Log the time spent importing modules and in each step of startup"
+        ),
     }
 
+    profile_startup = Bool(
+        False,
+        help="""
+        Log the time spent in each step of startup, and importing modules.
+
+        Imports are only timed when started with `python -m binderhub --profile-startup`.
+        """,
+        config=True
+    )
+
     config_file = Unicode(
         'binderhub_config.py',
         help="""
@@ -207,6 +234,39 @@ class BinderHub(Application):
         config=True
     )
 
+    # index of this worker process, see num_workers
+    worker_id = 0
+
+    num_workers = Integer(
+        1,
+        help="""
+        Number of worker processes serving requests on the port.
+
+        0 starts one per CPU.
+        With more than one, the workers are forked after initialization
+        and share the listening socket.
+        Build pod cleanup and cache snapshots run in the first worker only,
+        so snapshots only have the entries cached by that worker
+        (they are loaded before forking, so every worker starts from them).
+        GitHub ref refresh runs in every worker, for the refs it serves.
+
+        Set the PROMETHEUS_MULTIPROC_DIR environment variable to an empty directory
+        to aggregate the metrics of all workers,
+        otherwise /metrics reports those of the worker serving the request.
+
+        In-memory state is per worker: caches and rate limits.
+        Launch jobs are only known to the worker that started them,
+        so launch_jobs_enabled must be False with more than one worker.
+        """,
+        config=True
+    )
+
+    @validate('num_workers')
+    def _validate_num_workers(self, proposal):
+        if proposal.value < 0:
+            raise TraitError("num_workers must be >= 0")
+        return proposal.value
+
     appendix = Unicode(
         help="""
         Appendix to pass to repo2docker
@@ -512,6 +572,156 @@ class BinderHub(Application):
         """
     )
 
+    ref_refresh_interval = Integer(
+        0,
+        config=True,
+        help="""Interval (in seconds) for how often to revalidate popular GitHub refs in the background.
+
+        Every interval, the `ref_refresh_count` most requested GitHub refs
+        that were last validated at least one interval ago are revalidated,
+        so that launches can use their cached sha without waiting on the GitHub API.
+        Set GitHubRepoProvider.max_ref_staleness to at least twice this interval
+        to serve these refs from the cache on the request path.
+        With num_workers > 1, each worker revalidates the refs most requested
+        from it, in its own cache, so GitHub API requests add up across workers.
+
+        0 (default) disables background revalidation.
+        """
+    )
+    ref_refresh_count = Integer(
+        50,
+        config=True,
+        help="""Number of most requested GitHub refs to revalidate every ref_refresh_interval."""
+    )
+
+    launch_jobs_enabled = Bool(
+        True,
+        config=True,
+        help="""Enable launch jobs (POST /api/launch and GET /api/jobs/{id}).
+
+        Jobs are kept in memory, so this requires num_workers = 1.
+        """
+    )
+
+    job_callbacks_enabled = Bool(
+        False,
+        config=True,
+        help="""Allow launch jobs (POST /api/launch) to be given a callback_url.
+
+        The job is POSTed to the callback URL when it is done.
+        Only enable this if BinderHub making requests to arbitrary URLs
+        (possibly on the internal network) given by users is acceptable.
+        """
+    )
+
+    status_api_concurrency = Integer(
+        8,
+        config=True,
+        help="""Number of repos resolved concurrently by each request to /api/status."""
+    )
+
+    status_api_max_repos = Integer(
+        100,
+        config=True,
+        help="""Maximum number of repos in a request to /api/status."""
+    )
+
+    repo_metrics_top_k = Integer(
+        100,
+        config=True,
+        help="""Number of repos with their own series in the build and launch count metrics.
+
+        The most frequently built and launched repos are tracked
+        with a heavy-hitters sketch, and the counts of all other repos
+        are reported with `repo="other"`,
+        so that the number of series doesn't grow with the number of repos.
+        """
+    )
+
+    @validate('repo_metrics_top_k')
+    def _validate_repo_metrics_top_k(self, proposal):
+        if proposal.value < 1:
+            raise TraitError("repo_metrics_top_k must be at least 1")
+        return proposal.value
+
+    static_precompress = Bool(
+        True,
+        config=True,
+        help="""Compress static files with gzip (and brotli, if installed) on startup.
+
+        Compressed variants written next to the files (e.g. `bundle.js.gz`)
+        are used whether or not this is enabled.
+        """
+    )
+
+    static_memory_max_size = Integer(
+        512 * 1024,
+        config=True,
+        help="""Maximum size (in bytes) of static files to serve from memory.
+
+        Larger files are read from disk on each request.
+        With debug, static files are not loaded in memory (or compressed),
+        so that changes are served without a restart.
+        """
+    )
+
+    template_bytecode_cache = Bool(
+        True,
+        config=True,
+        help="""Cache compiled templates on disk, in template_bytecode_cache_dir."""
+    )
+
+    template_bytecode_cache_dir = Unicode(
+        "",
+        config=True,
+        help="""Directory for compiled templates.
+
+        Use a directory that persists across restarts (e.g. a volume)
+        to avoid compiling templates when starting.
+        Empty (default) uses a private temporary directory.
+        """
+    )
+
+    speculative_resolution = Bool(
+        True,
+        config=True,
+        help="""Start resolving refs and looking up images when rendering the loading page.
+
+        The build request made by the loading page then finds the results ready,
+        instead of waiting on the repository provider and registry after the page has loaded.
+        Not used for providers that require the user's authorization.
+        """
+    )
+
+    nbviewer_cache_ttl = Integer(
+        600,
+        config=True,
+        help="""Time (in seconds) to cache whether nbviewer can show a preview of a repository.
+
+        The loading page never waits for nbviewer:
+        when the result is not cached, it is checked in the background
+        and the page asks for it once rendered.
+        """
+    )
+
+    dns_cache_ttl = Integer(
+        0,
+        config=True,
+        help="""Maximum time (in seconds) to cache the addresses of hostnames for outbound requests.
+
+        When set, hostnames are resolved asynchronously and their addresses cached
+        for the TTL of their DNS records (if aiodns is installed), up to this time,
+        so that slow DNS lookups don't add to the latency of requests.
+
+        0 (default) disables caching, leaving lookups to the HTTP client.
+        """
+    )
+    dns_cache_negative_ttl = Integer(
+        5,
+        config=True,
+        help="""Time (in seconds) to cache failed lookups of hostnames, if dns_cache_ttl is set."""
+    )
+
     # FIXME: Come up with a better name for it?
     builder_required = Bool(
         True,
@@ -543,19 +753,6 @@ class BinderHub(Application):
 
         return networks
 
-    ban_networks_min_prefix_len = Integer(
-        1,
-        help="The shortest prefix in ban_networks",
-    )
-
-    @observe("ban_networks")
-    def _update_prefix_len(self, change):
-        if not change.new:
-            min_len = 1
-        else:
-            min_len = min(net.prefixlen for net in change.new)
-        self.ban_networks_min_prefix_len = min_len or 1
-
     tornado_settings = Dict(
         config=True,
         help="""
@@ -623,26 +820,57 @@ class BinderHub(Application):
             curl_log = logging.getLogger('tornado.curl_httpclient')
             curl_log.setLevel(logging.INFO)
 
+    def init_dns_cache(self):
+        if not self.dns_cache_ttl:
+            return
+        Resolver.configure(
+            CachingResolver,
+            max_ttl=self.dns_cache_ttl,
+            negative_ttl=self.dns_cache_negative_ttl,
+        )
+        if aiodns is None:
+            self.log.info(
+                "aiodns is not installed: DNS records are cached for %is regardless of their TTL",
+                self.dns_cache_ttl,
+            )
+
     def initialize(self, *args, **kwargs):
         """Load configuration settings."""
+        startup.mark("imports")
         super().initialize(*args, **kwargs)
         self.load_config_file(self.config_file)
+        if self.num_workers != 1 and self.launch_jobs_enabled:
+            raise TraitError(
+                "num_workers must be 1 with launch_jobs_enabled:"
+                " launch jobs are only known to the worker that started them"
+            )
         # hook up tornado logging
         if self.debug:
             self.log_level = logging.DEBUG
         tornado.options.options.logging = logging.getLevelName(self.log_level)
         tornado.log.enable_pretty_logging()
         self.log = tornado.log.app_log
+        if self.profile_startup:
+            # if not started before the imports, by __main__
+            startup.start_profile(time_imports=False)
+        startup.mark("loading config")
 
         self.init_pycurl()
+        self.init_dns_cache()
+        startup.mark("HTTP client and DNS cache")
 
         # initialize kubernetes config
         if self.builder_required:
+            # only imported with a builder
+            import kubernetes.client
+            import kubernetes.config
+            patch_kubernetes_threadpool()
             try:
                 kubernetes.config.load_incluster_config()
             except kubernetes.config.ConfigException:
                 kubernetes.config.load_kube_config()
             self.tornado_settings["kubernetes_client"] = self.kube_client = kubernetes.client.CoreV1Api()
+            startup.mark("kubernetes client")
 
         # times 2 for log + build threads
         self.build_pool = ThreadPoolExecutor(self.concurrent_build_limit * 2)
@@ -651,6 +879,11 @@ class BinderHub(Application):
         self.executor = ThreadPoolExecutor(self.executor_threads)
 
         jinja_options = dict(autoescape=True, )
+        if self.template_bytecode_cache:
+            # reuse compiled templates across restarts
+            jinja_options['bytecode_cache'] = FileSystemBytecodeCache(
+                self.template_bytecode_cache_dir or None
+            )
         template_paths = [self.template_path]
         base_template_path = self._template_path_default()
         if base_template_path not in template_paths:
@@ -663,6 +896,15 @@ class BinderHub(Application):
             FileSystemLoader(template_paths)
         ])
         jinja_env = Environment(loader=loader, **jinja_options)
+        # load all templates now (from the bytecode cache, if warm),
+        # instead of on the first request for each page
+        for name in jinja_env.list_templates(extensions=['html']):
+            try:
+                jinja_env.get_template(name)
+            except Exception as e:
+                self.log.warning("Failed to load template %s: %s", name, e)
+        startup.mark("templates")
+
         if self.use_registry and self.builder_required:
             registry = DockerRegistry(parent=self)
         else:
@@ -678,9 +920,17 @@ class BinderHub(Application):
 
         self.event_log = EventLog(parent=self)
 
-        for schema_file in glob(os.path.join(HERE, 'event-schemas','*.json')):
-            with open(schema_file) as f:
-                self.event_log.register_schema(json.load(f))
+        if self.event_log.handlers_maker:
+            # events are discarded without handlers,
+            # don't import jsonschema to validate them
+            for schema_file in glob(os.path.join(HERE, 'event-schemas','*.json')):
+                with open(schema_file) as f:
+                    self.event_log.register_schema(json.load(f))
+        startup.mark("launcher and event log")
+
+        self.cache_snapshot = CacheSnapshot(parent=self)
+        self.cache_snapshot.load(self.get_snapshot_caches())
+        startup.mark("loading cache snapshot")
 
         repo_token_store = self.repo_token_store
         if len(repo_token_store) == 0:
@@ -695,7 +945,6 @@ class BinderHub(Application):
                 "launcher": self.launcher,
                 "appendix": self.appendix,
                 "ban_networks": self.ban_networks,
-                "ban_networks_min_prefix_len": self.ban_networks_min_prefix_len,
                 "build_namespace": self.build_namespace,
                 "build_image": self.build_image,
                 "build_node_selector": self.build_node_selector,
@@ -720,8 +969,14 @@ class BinderHub(Application):
                 "build_docker_host": self.build_docker_host,
                 "base_url": self.base_url,
                 "badge_base_url": self.badge_base_url,
+                "nbviewer_cache_ttl": self.nbviewer_cache_ttl,
+                "speculative_resolution": self.speculative_resolution,
+                "job_callbacks_enabled": self.job_callbacks_enabled,
+                "status_api_concurrency": self.status_api_concurrency,
+                "status_api_max_repos": self.status_api_max_repos,
                 "static_path": os.path.join(HERE, "static"),
                 "static_url_prefix": url_path_join(self.base_url, "static/"),
+                "static_handler_class": StaticFileHandler,
                 "template_variables": self.template_variables,
                 "executor": self.executor,
                 "auth_enabled": self.auth_enabled,
@@ -733,10 +988,34 @@ class BinderHub(Application):
         if self.auth_enabled:
             self.tornado_settings['cookie_secret'] = os.urandom(32)
 
+        static_paths = [self.tornado_settings['static_path']]
+        if self.extra_static_path:
+            static_paths.append(self.extra_static_path)
+        if self.debug:
+            # serve edits to static files, not the files loaded on startup
+            static_paths = []
+        for static_path in static_paths:
+            StaticFileHandler.preload(
+                static_path,
+                memory_max_size=self.static_memory_max_size,
+                precompress=self.static_precompress,
+            )
+
+        BUILD_COUNT.top_k = LAUNCH_COUNT.top_k = self.repo_metrics_top_k
+
+        startup.mark("static files")
+
+        if self.ban_networks:
+            # compile large lists of networks now, not on the first request
+            NetworkMatcher.for_networks(self.ban_networks)
+            startup.mark("ban_networks")
+
         handlers = [
             (r'/metrics', MetricsHandler),
             (r'/versions', VersionHandler),
             (r"/build/([^/]+)/(.+)", BuildHandler, {'binderhub_url': self.binderhub_url}),
+            (r"/ws/build/([^/]+)/(.+)", BuildWebSocketHandler, {'binderhub_url': self.binderhub_url}),
+            (r"/api/status", RepoStatusHandler),
             (r"/v2/([^/]+)/(.+)", ParameterizedMainHandler),
             (r"/repo/([^/]+)/([^/]+)(/.*)?", LegacyRedirectHandler),
             (r"/rdm/([^/]+)/rcosrepo/import/([^/]+)(/.*)?", RDMRedirectHandler),
@@ -745,41 +1024,47 @@ class BinderHub(Application):
             # for backward-compatible mybinder.org badge URLs
             # /assets/images/badge.svg
             (r'/assets/(images/badge\.svg)',
-                tornado.web.StaticFileHandler,
+                StaticFileHandler,
                 {'path': self.tornado_settings['static_path']}),
             # /badge.svg
             (r'/(badge\.svg)',
-                tornado.web.StaticFileHandler,
+                StaticFileHandler,
                 {'path': os.path.join(self.tornado_settings['static_path'], 'images')}),
             # /badge_logo.svg
             (r'/(badge\_logo\.svg)',
-                tornado.web.StaticFileHandler,
+                StaticFileHandler,
                 {'path': os.path.join(self.tornado_settings['static_path'], 'images')}),
             # /logo_social.png
             (r'/(logo\_social\.png)',
-                tornado.web.StaticFileHandler,
+                StaticFileHandler,
                 {'path': os.path.join(self.tornado_settings['static_path'], 'images')}),
             # /favicon_XXX.ico
             (r'/(favicon\_fail\.ico)',
-                tornado.web.StaticFileHandler,
+                StaticFileHandler,
                 {'path': os.path.join(self.tornado_settings['static_path'], 'images')}),
             (r'/(favicon\_success\.ico)',
-                tornado.web.StaticFileHandler,
+                StaticFileHandler,
                 {'path': os.path.join(self.tornado_settings['static_path'], 'images')}),
             (r'/(favicon\_building\.ico)',
-                tornado.web.StaticFileHandler,
+                StaticFileHandler,
                 {'path': os.path.join(self.tornado_settings['static_path'], 'images')}),
             (r'/about', AboutHandler),
             (r'/health', HealthHandler, {'hub_url': self.hub_url_local}),
             (r'/_config', ConfigHandler),
+            (r'/_nbviewer', NbviewerHandler),
             (r'/repoauth/callback', RepoAuthCallbackHandler, {'binderhub_url': self.binderhub_url}),
             (r'/', MainHandler),
             (r'.*', Custom404),
         ]
+        if self.launch_jobs_enabled:
+            handlers[4:4] = [
+                (r"/api/launch", LaunchJobHandler, {'binderhub_url': self.binderhub_url}),
+                (r"/api/jobs/([^/]+)", JobHandler),
+            ]
         handlers = self.add_url_prefix(self.base_url, handlers)
         if self.extra_static_path:
             handlers.insert(-1, (re.escape(url_path_join(self.base_url, self.extra_static_url_prefix)) + r"(.*)",
-                                 tornado.web.StaticFileHandler,
+                                 StaticFileHandler,
                                  {'path': self.extra_static_path}))
         if self.auth_enabled:
             oauth_redirect_uri = os.getenv('JUPYTERHUB_OAUTH_CALLBACK_URL') or \
@@ -787,10 +1072,59 @@ class BinderHub(Application):
             oauth_redirect_uri = urlparse(oauth_redirect_uri).path
             handlers.insert(-1, (re.escape(oauth_redirect_uri), HubOAuthCallbackHandler))
         self.tornado_app = tornado.web.Application(handlers, **self.tornado_settings)
+        startup.mark("tornado application")
+
+    async def watch_hot_refs(self):
+        """Revalidate popular GitHub refs every ref_refresh_interval"""
+        provider = self.repo_providers['gh']
+        while True:
+            await asyncio.sleep(self.ref_refresh_interval)
+            try:
+                await provider.refresh_hot_refs(
+                    self.config,
+                    self.ref_refresh_count,
+                    min_age=self.ref_refresh_interval,
+                )
+            except Exception:
+                app_log.exception("Failed to refresh GitHub refs")
+
+    def get_snapshot_caches(self):
+        """Return the in-process caches to persist in cache snapshots
+
+        dict of name: Cache
+        """
+        return {
+            "github": GitHubRepoProvider.cache,
+            "github_404": GitHubRepoProvider.cache_404,
+            "github_hits": GitHubRepoProvider.ref_hits,
+            "gitlab": GitLabRepoProvider.cache,
+            "gitlab_404": GitLabRepoProvider.cache_404,
+            "gist": GistRepoProvider.cache,
+            "gist_404": GistRepoProvider.cache_404,
+            "git_ls_remote": GitRepoProvider.ls_remote_cache,
+            "doi_records": DoiProvider.record_cache,
+            "doi_redirects": DoiProvider.redirect_cache,
+            "image": BuildHandler.image_cache,
+            "nbviewer": nbviewer_cache,
+        }
+
+    def save_cache_snapshot(self):
+        try:
+            self.cache_snapshot.save(self.get_snapshot_caches())
+        except Exception:
+            app_log.exception("Failed to save cache snapshot")
+
+    async def watch_cache_snapshot(self):
+        """Save a cache snapshot every cache_snapshot.interval"""
+        while True:
+            await asyncio.sleep(self.cache_snapshot.interval)
+            self.save_cache_snapshot()
 
     def stop(self):
         self.http_server.stop()
         self.build_pool.shutdown()
+        if self.worker_id == 0:
+            self.save_cache_snapshot()
 
     async def watch_build_pods(self):
         """Watch build pods
@@ -799,6 +1133,7 @@ class BinderHub(Application):
         - delete stopped build pods
         - delete running build pods older than build_max_age
         """
+        from .build import Build
         while True:
             try:
                 await asyncio.wrap_future(
@@ -814,15 +1149,55 @@ class BinderHub(Application):
                 app_log.exception("Failed to cleanup build pods")
             await asyncio.sleep(self.build_cleanup_interval)
 
+    def start_background_tasks(self):
+        """Start the background tasks of this worker
+
+        Caches are per worker, so each one refreshes its own hot refs.
+        The other tasks run once, in the first worker.
+        """
+        if self.ref_refresh_interval and issubclass(
+            self.repo_providers.get('gh', RepoProvider), GitHubRepoProvider
+        ):
+            asyncio.ensure_future(self.watch_hot_refs())
+        if self.worker_id != 0:
+            return
+        if self.builder_required:
+            asyncio.ensure_future(self.watch_build_pods())
+        if self.cache_snapshot.path and self.cache_snapshot.interval:
+            asyncio.ensure_future(self.watch_cache_snapshot())
+
     def start(self, run_loop=True):
         self.log.info("BinderHub starting on port %i", self.port)
+        sockets = tornado.netutil.bind_sockets(self.port)
+        startup.mark("listening")
+        startup.report(self.log)
+        self.worker_id = 0
+        if self.num_workers == 1:
+            if multiprocess_dir():
+                # metrics of a previous run, not those of this process
+                clear_multiprocess_dir(keep_pid=os.getpid())
+        else:
+            if multiprocess_dir():
+                # metrics of a previous run,
+                # the workers write their own files after the fork
+                clear_multiprocess_dir()
+            else:
+                self.log.warning(
+                    "PROMETHEUS_MULTIPROC_DIR is not set: /metrics will only report"
+                    " the metrics of the worker serving the request"
+                )
+            # doesn't return in this process, only in the workers
+            self.worker_id = tornado.process.fork_processes(self.num_workers or None)
+            self.log.info("BinderHub worker %i started", self.worker_id)
+            if multiprocess_dir():
+                # after a worker was restarted
+                mark_dead_workers()
         self.http_server = HTTPServer(
             self.tornado_app,
             xheaders=True,
         )
-        self.http_server.listen(self.port)
-        if self.builder_required:
-            asyncio.ensure_future(self.watch_build_pods())
+        self.http_server.add_sockets(sockets)
+        self.start_background_tasks()
         if run_loop:
             tornado.ioloop.IOLoop.current().start()
 
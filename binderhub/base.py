@@ -1,5 +1,6 @@
 """Base classes for request handlers"""
 
+import hashlib
 import json
 from ipaddress import ip_address
 
@@ -9,10 +10,12 @@ from tornado.log import app_log
 from jupyterhub.services.auth import HubOAuthenticated, HubOAuth
 
 from . import __version__ as binder_version
-from .utils import ip_in_networks
+from .log import ResponseSizeMixin
+from .ratelimit import RateLimiter, RateLimitExceeded
+from .utils import Cache, NetworkMatcher
 
 
-class BaseHandler(HubOAuthenticated, web.RequestHandler):
+class BaseHandler(ResponseSizeMixin, HubOAuthenticated, web.RequestHandler):
     """HubAuthenticated by default allows all successfully identified users (see allow_all property)."""
 
     def initialize(self):
@@ -33,11 +36,7 @@ class BaseHandler(HubOAuthenticated, web.RequestHandler):
         if self.skip_check_request_ip or not ban_networks:
             return
         request_ip = self.request.remote_ip
-        match = ip_in_networks(
-            request_ip,
-            ban_networks,
-            min_prefix_len=self.settings["ban_networks_min_prefix_len"],
-        )
+        match = NetworkMatcher.for_networks(ban_networks).match(request_ip)
         if match:
             network, message = match
             app_log.warning(
@@ -86,14 +85,55 @@ class BaseHandler(HubOAuthenticated, web.RequestHandler):
             badge_base_url = badge_base_url(self)
         return badge_base_url
 
-    def render_template(self, name, **extra_ns):
-        """Render an HTML page"""
+    def _render_template(self, name, **extra_ns):
         ns = {}
         ns.update(self.template_namespace)
         ns.update(extra_ns)
         template = self.settings['jinja2_env'].get_template(name)
-        html = template.render(**ns)
-        self.write(html)
+        return template.render(**ns)
+
+    def render_template(self, name, **extra_ns):
+        """Render an HTML page"""
+        self.write(self._render_template(name, **extra_ns))
+
+    def render_cached_template(self, name, cache_key=None, **extra_ns):
+        """Render an HTML page that only depends on the configuration
+
+        The page is rendered once (per `cache_key`, for values that depend
+        on the request), see write_cached.
+        """
+        self.write_cached(
+            (name, cache_key), lambda: self._render_template(name, **extra_ns)
+        )
+
+    def write_cached(self, key, render, content_type=None):
+        """Write a response body that only depends on key and the configuration
+
+        `render` is only called the first time, and the body cached
+        with a strong ETag. Requests with a matching If-None-Match header
+        get a 304 Not Modified response without a body.
+        """
+        # one cache per application (i.e. configuration),
+        # by (handler class name, key): (body, etag)
+        response_cache = self.settings.setdefault('response_cache', Cache(256))
+        cache_key = (type(self).__name__, key)
+        cached = response_cache.get(cache_key)
+        if cached is None:
+            body = render()
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            cached = (body, etag)
+            response_cache.set(cache_key, cached)
+        body, etag = cached
+
+        if content_type:
+            self.set_header('Content-Type', content_type)
+        self.set_header('Etag', etag)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write(body)
 
     def extract_message(self, exc_info):
         """Return error message from exc_info"""
@@ -104,12 +144,28 @@ class BaseHandler(HubOAuthenticated, web.RequestHandler):
         except Exception:
             return ''
 
+    def check_rate_limit(self, bucket, count=1):
+        """Raise RateLimitExceeded if the client exceeded its rate limit for `bucket`
+
+        `count` is the number of tokens the request takes.
+        See RateLimiter.limits for the buckets.
+        """
+        RateLimiter.instance(config=self.settings.get('traitlets_config')).check(
+            self, bucket, count
+        )
+
+    def set_retry_after(self, exc_info):
+        """Set the Retry-After header of an error response, for rate limits"""
+        if exc_info and isinstance(exc_info[1], RateLimitExceeded):
+            self.set_header('Retry-After', str(exc_info[1].retry_after))
+
     def write_error(self, status_code, **kwargs):
         exc_info = kwargs.get('exc_info')
         message = ''
         status_message = responses.get(status_code, 'Unknown HTTP Error')
         if exc_info:
             message = self.extract_message(exc_info)
+        self.set_retry_after(exc_info)
 
         self.render_template(
             'error.html',
@@ -132,7 +188,7 @@ class Custom404(BaseHandler):
 class AboutHandler(BaseHandler):
     """Serve the about page"""
     async def get(self):
-        self.render_template(
+        self.render_cached_template(
             "about.html",
             base_url=self.settings['base_url'],
             submit=False,
@@ -154,10 +210,28 @@ class VersionHandler(BaseHandler):
     skip_check_request_ip = True
 
     async def get(self):
-        self.set_header("Content-type", "application/json")
-        self.write(json.dumps(
-            {
-                "builder": self.settings['build_image'],
-                "binderhub": binder_version,
+        self.write_cached(
+            "versions",
+            lambda: json.dumps(
+                {
+                    "builder": self.settings['build_image'],
+                    "binderhub": binder_version,
                 }
-        ))
+            ),
+            content_type="application/json",
+        )
+
+
+class APIHandler(BaseHandler):
+    """Base class for JSON API handlers, with errors as JSON"""
+
+    def write_error(self, status_code, **kwargs):
+        message = ''
+        if 'exc_info' in kwargs:
+            message = self.extract_message(kwargs['exc_info'])
+            self.set_retry_after(kwargs['exc_info'])
+        self.set_header('Content-Type', 'application/json')
+        self.finish(json.dumps({
+            'status_code': status_code,
+            'message': message or responses.get(status_code, 'Unknown HTTP Error'),
+        }))
@@ -7,23 +7,25 @@ import hashlib
 from http.client import responses
 import json
 import string
+import sys
 import time
 import escapism
 
-import docker
 from tornado import gen
 from tornado.httpclient import HTTPClientError
-from tornado.web import Finish, authenticated
+from tornado.web import Finish, HTTPError, authenticated
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
 from tornado.queues import Queue
 from tornado.iostream import StreamClosedError
 from tornado.ioloop import IOLoop
 from tornado.log import app_log
-from prometheus_client import Counter, Histogram, Gauge
+from prometheus_client import REGISTRY, Histogram, Gauge
 
 from .base import BaseHandler
-from .build import Build, FakeBuild
+from .eventstream import EventStreams
 from .repoauth import TokenStore
-from .utils import url_path_join
+from .topk import RepoCounter
+from .utils import Cache, multiprocess_dir, url_path_join
 from .utils import KUBE_REQUEST_TIMEOUT
 
 # Separate buckets for builds and launches.
@@ -43,18 +45,29 @@ LAUNCH_TIME = Histogram(
     ['status', 'retries'],
     buckets=LAUNCH_BUCKETS,
 )
-BUILD_COUNT = Counter(
+# by repo, for the top repos only (see BinderHub.repo_metrics_top_k)
+BUILD_COUNT = RepoCounter(
     'binderhub_build_count',
     'Counter of builds by repo',
-    ['status', 'provider', 'repo'],
+    multiprocess_dir=multiprocess_dir(),
 )
-LAUNCH_COUNT = Counter(
+LAUNCH_COUNT = RepoCounter(
     'binderhub_launch_count',
     'Counter of launches by repo',
-    ['status', 'provider', 'repo'],
+    multiprocess_dir=multiprocess_dir(),
+)
+REGISTRY.register(BUILD_COUNT)
+REGISTRY.register(LAUNCH_COUNT)
+BUILDS_INPROGRESS = Gauge(
+    'binderhub_inprogress_builds',
+    'Builds currently in progress',
+    multiprocess_mode='livesum',
+)
+LAUNCHES_INPROGRESS = Gauge(
+    'binderhub_inprogress_launches',
+    'Launches currently in progress',
+    multiprocess_mode='livesum',
 )
-BUILDS_INPROGRESS = Gauge('binderhub_inprogress_builds', 'Builds currently in progress')
-LAUNCHES_INPROGRESS = Gauge('binderhub_inprogress_launches', 'Launches currently in progress')
 
 
 def _generate_build_name(build_slug, ref, prefix='', limit=63, ref_length=6):
@@ -112,13 +125,121 @@ def _safe_build_slug(build_slug, limit, hash_length=6):
     ).lower()
 
 
+def _get_image_name(provider, ref, image_prefix):
+    """Return the name of the image for a resolved ref of a provider"""
+    # Enforces max 255 characters before image
+    safe_build_slug = _safe_build_slug(provider.get_build_slug(), limit=255 - len(image_prefix))
+
+    return '{prefix}{build_slug}:{ref}'.format(
+        prefix=image_prefix,
+        build_slug=safe_build_slug,
+        ref=ref
+    ).replace('_', '-').lower()
+
+
+async def _image_exists(settings, image_name):
+    """Return whether the image image_name is already built
+
+    Looks in the registry, or the local docker daemon if not using a registry.
+    """
+    if settings['use_registry']:
+        registry = settings['registry']
+        for _ in range(3):
+            try:
+                image_manifest = await registry.get_image_manifest(*'/'.join(image_name.split('/')[-2:]).split(':', 1))
+                return bool(image_manifest)
+            except HTTPClientError:
+                app_log.exception("Tornado HTTP Timeout error: Failed to get image manifest for %s", image_name)
+        return False
+    else:
+        # Check if the image exists locally!
+        # Assume we're running in single-node mode or all binder pods are assigned to the same node!
+        # only imported without a registry
+        import docker
+        docker_client = docker.from_env(version='auto')
+        try:
+            docker_client.images.get(image_name)
+        except docker.errors.ImageNotFound:
+            # image doesn't exist, so do a build!
+            return False
+        else:
+            return True
+
+
 class BuildHandler(BaseHandler):
     """A handler for working with GitHub."""
 
-    # emit keepalives every 25 seconds to avoid idle connections being closed
-    KEEPALIVE_INTERVAL = 25
     build = None
 
+    # an event stream, lasting as long as the build and launch (see log.py)
+    streaming = True
+
+    # shared cache of image names known to exist.
+    # Only positive results are cached: a missing image is about to be built,
+    # and images are rarely deleted once pushed.
+    image_cache = Cache(4096, max_age=3600)
+
+    # short-lived cache of speculative ref resolutions and image lookups,
+    # started when the loading page is rendered, by provider_prefix:spec.
+    # Values are futures resolving to
+    # {'provider': provider, 'ref': ref, 'image_name': image_name, 'image_found': bool}
+    speculative_cache = Cache(1024, max_age=60)
+
+    @classmethod
+    def speculate(cls, settings, provider_prefix, spec):
+        """Start resolving the ref of spec and looking up its image in the background
+
+        Called when rendering the loading page, so that the build request
+        that follows finds the results ready.
+        Only for providers that don't need the user's authorization.
+        """
+        key = '%s:%s' % (provider_prefix, spec)
+        if cls.speculative_cache.get(key) is not None:
+            return
+        providers = settings['repo_providers']
+        if provider_prefix not in providers:
+            return
+        provider = providers[provider_prefix](config=settings['traitlets_config'], spec=spec)
+        if provider.is_banned() or provider.get_authorization_provider() is not None:
+            return
+
+        async def resolve():
+            ref = await provider.get_resolved_ref()
+            if ref is None:
+                return None
+            image_name = _get_image_name(provider, ref, settings['image_prefix'])
+            image_found = bool(cls.image_cache.get(image_name)) or await _image_exists(
+                settings, image_name
+            )
+            return {
+                'provider': provider,
+                'ref': ref,
+                'image_name': image_name,
+                'image_found': image_found,
+            }
+
+        future = asyncio.ensure_future(resolve())
+        # errors are reported by the build request, resolving again
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        cls.speculative_cache.set(key, future)
+
+    @classmethod
+    async def pop_speculation(cls, key):
+        """Return the result of a speculative resolution of key, if any
+
+        Each result is only used once.
+        Returns None if there is none, or it failed.
+        """
+        future = cls.speculative_cache.get(key)
+        if future is None:
+            return None
+        cls.speculative_cache.pop(key)
+        try:
+            return await future
+        except Exception as e:
+            app_log.debug("Speculative resolution of %s failed: %s", key, e)
+            return None
+
     async def emit(self, data):
         """Emit an eventstream event"""
         if type(data) is not str:
@@ -127,6 +248,7 @@ class BuildHandler(BaseHandler):
             serialized_data = data
         try:
             self.write('data: {}\n\n'.format(serialized_data))
+            self.event_streams.touch(self)
             await self.flush()
         except StreamClosedError:
             app_log.warning("Stream closed while handling %s", self.request.uri)
@@ -135,47 +257,50 @@ class BuildHandler(BaseHandler):
 
     def on_finish(self):
         """Stop keepalive when finish has been called"""
-        self._keepalive = False
+        self.event_streams.unregister(self)
         if self.build:
             # if we have a build, tell it to stop watching
             self.build.stop()
 
-    async def keep_alive(self):
-        """Constantly emit keepalive events
+    def on_connection_close(self):
+        """Stop waiting for the client to close the stream"""
+        super().on_connection_close()
+        self.event_streams.closed(self)
 
-        So that intermediate proxies don't terminate an idle connection
-        """
-        self._keepalive = True
-        while True:
-            await gen.sleep(self.KEEPALIVE_INTERVAL)
-            if not self._keepalive:
-                return
-            try:
-                # lines that start with : are comments
-                # and should be ignored by event consumers
-                self.write(':keepalive\n\n')
-                await self.flush()
-            except StreamClosedError:
-                return
-
-    def send_error(self, status_code, **kwargs):
-        """event stream cannot set an error code, so send an error event"""
-        exc_info = kwargs.get('exc_info')
+    def error_event(self, status_code, exc_info=None):
+        """Return the event reporting an error"""
         message = ''
         if exc_info:
             message = self.extract_message(exc_info)
         if not message:
             message = responses.get(status_code, 'Unknown HTTP Error')
-
-        # this cannot be async
-        evt = json.dumps({
+        return {
             'phase': 'failed',
             'status_code': status_code,
             'message': message + '\n',
-        })
+        }
+
+    def send_error(self, status_code, **kwargs):
+        """event stream cannot set an error code, so send an error event"""
+        # this cannot be async
+        evt = json.dumps(self.error_event(status_code, kwargs.get('exc_info')))
         self.write('data: {}\n\n'.format(evt))
         self.finish()
 
+    def start_stream(self):
+        """Keep the stream alive while building and launching"""
+        self.event_streams.register(self)
+
+    async def end_stream(self):
+        """Called after the last event"""
+        # Don't close the eventstream immediately.
+        # (javascript) eventstream clients reconnect automatically on dropped connections,
+        # so if the server closes the connection first,
+        # the client will reconnect which starts a new build.
+        # Wait for the client to close its connection after the launch event,
+        # for at most linger_timeout.
+        await self.event_streams.linger(self)
+
     def initialize(self, binderhub_url=None):
         super().initialize()
         if self.settings['use_registry']:
@@ -184,6 +309,7 @@ class BuildHandler(BaseHandler):
         self.event_log = self.settings['event_log']
         self.binderhub_url = binderhub_url
         self.tokenstore = TokenStore(self.settings['repo_token_store'])
+        self.event_streams = EventStreams.instance(config=self.settings.get('traitlets_config'))
 
     async def fail(self, message):
         await self.emit(
@@ -214,6 +340,13 @@ class BuildHandler(BaseHandler):
                 specifies information needed by the repo provider (i.e. user,
                 repo, ref, etc.)
 
+        """
+        await self.build_and_launch(provider_prefix, _unescaped_spec)
+
+    async def build_and_launch(self, provider_prefix, _unescaped_spec):
+        """Build the image of a spec if needed, and launch it
+
+        Reports progress with emit, the same events whatever the transport.
         """
         prefix = '/build/' + provider_prefix
         spec = self.get_spec_from_request(prefix)
@@ -225,8 +358,8 @@ class BuildHandler(BaseHandler):
             await self.fail("No provider found for prefix %s" % provider_prefix)
             return
 
-        # create a heartbeat
-        IOLoop.current().spawn_callback(self.keep_alive)
+        self.start_stream()
+        self.check_rate_limit('launch')
 
         spec = spec.rstrip("/")
         key = '%s:%s' % (provider_prefix, spec)
@@ -263,6 +396,15 @@ class BuildHandler(BaseHandler):
                     'authorization_url': auth_url,
                 })
                 return
+            provider.user_access_token = auth_token
+
+        speculation = None
+        if auth_provider_id is None:
+            speculation = await self.pop_speculation(key)
+        if speculation is not None:
+            # resolved while the loading page was rendered
+            app_log.debug("Using speculative resolution of %s", key)
+            provider = speculation['provider']
 
         repo_url = self.repo_url = provider.get_repo_url()
 
@@ -273,7 +415,10 @@ class BuildHandler(BaseHandler):
         }
 
         try:
-            ref = await provider.get_resolved_ref()
+            if speculation is not None:
+                ref = speculation['ref']
+            else:
+                ref = await provider.get_resolved_ref()
         except Exception as e:
             await self.fail("Error resolving ref for %s: %s" % (key, e))
             return
@@ -318,37 +463,20 @@ class BuildHandler(BaseHandler):
 
         image_prefix = self.settings['image_prefix']
 
-        # Enforces max 255 characters before image
-        safe_build_slug = _safe_build_slug(provider.get_build_slug(), limit=255 - len(image_prefix))
-
         build_name = _generate_build_name(provider.get_build_slug(), ref, prefix='build-')
 
-        image_name = self.image_name = '{prefix}{build_slug}:{ref}'.format(
-            prefix=image_prefix,
-            build_slug=safe_build_slug,
-            ref=ref
-        ).replace('_', '-').lower()
+        image_name = self.image_name = _get_image_name(provider, ref, image_prefix)
 
-        if self.settings['use_registry']:
-            for _ in range(3):
-                try:
-                    image_manifest = await self.registry.get_image_manifest(*'/'.join(image_name.split('/')[-2:]).split(':', 1))
-                    image_found = bool(image_manifest)
-                    break
-                except HTTPClientError:
-                    app_log.exception("Tornado HTTP Timeout error: Failed to get image manifest for %s", image_name)
-                    image_found = False
+        if self.image_cache.get(image_name):
+            app_log.debug("Cache hit for image %s", image_name)
+            image_found = True
+        elif speculation is not None and speculation['image_name'] == image_name:
+            image_found = speculation['image_found']
         else:
-            # Check if the image exists locally!
-            # Assume we're running in single-node mode or all binder pods are assigned to the same node!
-            docker_client = docker.from_env(version='auto')
-            try:
-                docker_client.images.get(image_name)
-            except docker.errors.ImageNotFound:
-                # image doesn't exist, so do a build!
-                image_found = False
-            else:
-                image_found = True
+            image_found = await _image_exists(self.settings, image_name)
+
+        if image_found:
+            self.image_cache.set(image_name, True)
 
         # Launch a notebook server if the image already is built
         kube = self.settings['kubernetes_client']
@@ -371,6 +499,7 @@ class BuildHandler(BaseHandler):
             return
 
         # Prepare to build
+        self.check_rate_limit('build')
         q = Queue()
 
         if self.settings['use_registry']:
@@ -378,6 +507,8 @@ class BuildHandler(BaseHandler):
         else:
             push_secret = None
 
+        # imports kubernetes, only needed when building
+        from .build import Build, FakeBuild
         BuildClass = FakeBuild if self.settings.get('fake_build') else Build
 
         appendix = self.settings['appendix'].format(
@@ -468,6 +599,7 @@ class BuildHandler(BaseHandler):
         if not failed:
             BUILD_TIME.labels(status='success').observe(time.perf_counter() - build_starttime)
             BUILD_COUNT.labels(status='success', **self.repo_metric_labels).inc()
+            self.image_cache.set(image_name, True)
             with LAUNCHES_INPROGRESS.track_inprogress():
                 await self.launch(kube, provider)
             self.event_log.emit('binderhub.jupyter.org/launch', 4, {
@@ -478,15 +610,7 @@ class BuildHandler(BaseHandler):
                 'origin': self.settings['normalized_origin'] if self.settings['normalized_origin'] else self.request.host
             })
 
-        # Don't close the eventstream immediately.
-        # (javascript) eventstream clients reconnect automatically on dropped connections,
-        # so if the server closes the connection first,
-        # the client will reconnect which starts a new build.
-        # If we sleep here, that makes it more likely that a well-behaved
-        # client will close its connection first.
-        # The duration of this shouldn't matter because
-        # well-behaved clients will close connections after they receive the launch event.
-        await gen.sleep(60)
+        await self.end_stream()
 
     async def launch(self, kube, provider):
         """Ask JupyterHub to launch the image."""
@@ -628,3 +752,82 @@ class BuildHandler(BaseHandler):
         }
         event.update(server_info)
         await self.emit(event)
+
+
+class BuildWebSocketHandler(BuildHandler, WebSocketHandler):
+    """Build and launch like BuildHandler, with progress sent over a WebSocket
+
+    Each message is one event, the same as the data of BuildHandler's events.
+    Messages are compressed with permessage-deflate if the client supports it.
+    The server closes the connection after the last event.
+    """
+
+    def set_default_headers(self):
+        # not an event stream
+        BaseHandler.set_default_headers(self)
+
+    def get_compression_options(self):
+        # enable permessage-deflate, with the default settings
+        return {}
+
+    def send_error(self, status_code=500, **kwargs):
+        # errors before the upgrade are plain HTTP errors, not events
+        WebSocketHandler.send_error(self, status_code, **kwargs)
+
+    @property
+    def ping_interval(self):
+        # instead of keepalive events
+        return self.event_streams.keepalive_interval
+
+    @authenticated
+    async def get(self, provider_prefix, _unescaped_spec):
+        await WebSocketHandler.get(self, provider_prefix, _unescaped_spec)
+
+    def open(self, provider_prefix, _unescaped_spec):
+        # don't block receiving messages (e.g. close) while building
+        self._pipeline = asyncio.ensure_future(
+            self._build_and_launch(provider_prefix, _unescaped_spec)
+        )
+
+    def on_message(self, message):
+        """Messages from the client are ignored"""
+
+    async def _build_and_launch(self, provider_prefix, _unescaped_spec):
+        try:
+            await self.build_and_launch(provider_prefix, _unescaped_spec)
+        except Finish:
+            pass
+        except Exception as e:
+            # like send_error
+            exc_info = sys.exc_info()
+            self.log_exception(*exc_info)
+            status_code = e.status_code if isinstance(e, HTTPError) else 500
+            try:
+                await self.emit(self.error_event(status_code, exc_info))
+            except Finish:
+                pass
+        finally:
+            if self.build:
+                self.build.stop()
+            self.close()
+
+    async def emit(self, data):
+        """Send an event"""
+        if type(data) is not str:
+            serialized_data = json.dumps(data)
+        else:
+            serialized_data = data
+        try:
+            await self.write_message(serialized_data)
+        except (WebSocketClosedError, StreamClosedError):
+            app_log.warning("WebSocket closed while handling %s", self.request.uri)
+            # raise Finish to halt the build
+            raise Finish()
+
+    def start_stream(self):
+        # kept alive with pings
+        pass
+
+    async def end_stream(self):
+        # WebSocket clients don't reconnect automatically
+        pass
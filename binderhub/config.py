@@ -1,3 +1,5 @@
+import json
+
 from tornado.log import app_log
 from .base import BaseHandler
 
@@ -10,4 +12,8 @@ class ConfigHandler(BaseHandler):
         return config
 
     async def get(self):
-        self.write(self.generate_config())
\ No newline at end of file
+        self.write_cached(
+            "config",
+            lambda: json.dumps(self.generate_config()),
+            content_type="application/json; charset=UTF-8",
+        )
\ No newline at end of file
@@ -0,0 +1,159 @@
+"""
+Caching DNS resolver for outbound requests
+"""
+import asyncio
+import socket
+import urllib.parse
+
+from prometheus_client import Counter
+from tornado.netutil import Resolver
+
+from .utils import Cache
+
+try:
+    import aiodns
+except ImportError:
+    aiodns = None
+
+try:
+    import pycurl
+except ImportError:
+    pycurl = None
+
+DNS_LOOKUPS = Counter(
+    'binderhub_dns_cache_lookups',
+    'Hostname lookups by the caching DNS resolver',
+    ['result'],
+)
+for result in ("hit", "miss", "negative_hit"):
+    DNS_LOOKUPS.labels(result)
+
+
+class CachingResolver(Resolver):
+    """Resolver caching addresses (and failures) of hostnames
+
+    Addresses are cached for the TTL of their DNS records when aiodns is installed,
+    up to `max_ttl` seconds, and for `max_ttl` seconds otherwise.
+    Failed lookups are cached for `negative_ttl` seconds.
+    Concurrent lookups of the same hostname share a single query.
+
+    Install with ``Resolver.configure(CachingResolver, max_ttl=...)``.
+    Tornado's simple HTTP client uses the configured resolver;
+    requests made with curl can be pinned to the cached addresses with :meth:`pin_request`.
+    """
+
+    # shared cache of lookups, by (host, family)
+    # values are {'addresses': [(family, address)], 'ttl': ttl} or {'error': message, 'ttl': ttl}
+    cache = Cache(1024)
+
+    # in-progress lookups, by (host, family)
+    _lookups = {}
+
+    def initialize(self, max_ttl=60, min_ttl=1, negative_ttl=5):
+        self.max_ttl = max_ttl
+        self.min_ttl = min_ttl
+        self.negative_ttl = negative_ttl
+        self._dns = None
+
+    def close(self):
+        if self._dns is not None:
+            self._dns.cancel()
+
+    async def resolve(self, host, port, family=socket.AF_UNSPEC):
+        key = (host, family)
+        cached = self.cache.get(key)
+        if cached and self.cache.age(key) < cached['ttl']:
+            if 'error' in cached:
+                DNS_LOOKUPS.labels('negative_hit').inc()
+                raise IOError(cached['error'])
+            DNS_LOOKUPS.labels('hit').inc()
+        else:
+            DNS_LOOKUPS.labels('miss').inc()
+            future = self._lookups.get(key)
+            if future is None:
+                future = asyncio.ensure_future(self._lookup(host, family))
+                self._lookups[key] = future
+                future.add_done_callback(lambda f: self._lookups.pop(key, None))
+            cached = await asyncio.shield(future)
+            if 'error' in cached:
+                raise IOError(cached['error'])
+
+        results = []
+        for addr_family, address in cached['addresses']:
+            if addr_family == socket.AF_INET6:
+                results.append((addr_family, (address, port, 0, 0)))
+            else:
+                results.append((addr_family, (address, port)))
+        return results
+
+    async def _lookup(self, host, family):
+        """Look up the addresses of `host`, and cache the result"""
+        key = (host, family)
+        try:
+            if aiodns is not None:
+                if self._dns is None:
+                    self._dns = aiodns.DNSResolver()
+                result = await self._dns.getaddrinfo(host, family=family, type=socket.SOCK_STREAM)
+                addresses = []
+                ttls = []
+                for node in result.nodes:
+                    address = node.addr[0]
+                    if isinstance(address, bytes):
+                        address = address.decode('ascii')
+                    addresses.append((node.family, address))
+                    ttls.append(node.ttl)
+                ttl = min(ttls) if ttls else self.negative_ttl
+            else:
+                infos = await asyncio.get_running_loop().getaddrinfo(
+                    host, None, family=family, type=socket.SOCK_STREAM
+                )
+                addresses = [(info[0], info[4][0]) for info in infos]
+                ttl = self.max_ttl
+        except Exception as e:
+            entry = {'error': "Failed to resolve {}: {}".format(host, e), 'ttl': self.negative_ttl}
+        else:
+            if not addresses:
+                entry = {'error': "No addresses for {}".format(host), 'ttl': self.negative_ttl}
+            else:
+                # remove duplicates, preserving order
+                addresses = list(dict.fromkeys(addresses))
+                entry = {'addresses': addresses, 'ttl': max(min(ttl, self.max_ttl), self.min_ttl)}
+        self.cache.set(key, entry)
+        return entry
+
+    async def pin_request(self, request):
+        """Return `request` (an HTTPRequest) pinned to the cached addresses of its host
+
+        For curl, which does its own lookups otherwise.
+        Requests that can't be resolved are returned as they are,
+        so that curl reports the error.
+        """
+        if pycurl is None:
+            return request
+        parsed = urllib.parse.urlsplit(request.url)
+        host = parsed.hostname
+        if not host:
+            return request
+        try:
+            port = parsed.port or (443 if parsed.scheme == 'https' else 80)
+            addresses = await self.resolve(host, port)
+        except (IOError, ValueError):
+            return request
+
+        option = "{}:{}:{}".format(
+            host,
+            port,
+            ",".join(
+                "[{}]".format(address[0]) if family == socket.AF_INET6 else address[0]
+                for family, address in addresses
+            ),
+        )
+        prepare = request.prepare_curl_callback
+
+        def prepare_curl_callback(curl):
+            curl.setopt(pycurl.RESOLVE, [option])
+            if prepare is not None:
+                prepare(curl)
+
+        request.prepare_curl_callback = prepare_curl_callback
+        return request
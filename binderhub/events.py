@@ -5,7 +5,6 @@ from traitlets.config import Configurable
 
 import logging
 from datetime import datetime
-import jsonschema
 from pythonjsonlogger import jsonlogger
 from jupyterhub.traitlets import Callable
 import json
@@ -60,6 +59,9 @@ class EventLog(Configurable):
 
         'version' and '$id' are required fields.
         """
+        # slow to import, only needed when events are emitted
+        import jsonschema
+
         # Check if our schema itself is valid
         # This throws an exception if it isn't valid
         jsonschema.validators.validator_for(schema).check_schema(schema)
@@ -93,6 +95,7 @@ class EventLog(Configurable):
         if (schema_name, version) not in self.schemas:
             raise ValueError(f'Schema {schema_name} version {version} not registered')
         schema = self.schemas[(schema_name, version)]
+        import jsonschema
         jsonschema.validate(event, schema)
 
         capsule = {
@@ -0,0 +1,201 @@
+"""
+Registry of open event streams, with a shared keepalive tick
+"""
+import asyncio
+import time
+
+from prometheus_client import Gauge
+from tornado.ioloop import IOLoop, PeriodicCallback
+from traitlets.config import LoggingConfigurable
+from traitlets import Float
+
+OPEN_STREAMS = Gauge(
+    'binderhub_event_streams_open',
+    'Event streams currently open',
+    multiprocess_mode='livesum',
+)
+LINGERING_STREAMS = Gauge(
+    'binderhub_event_streams_lingering',
+    'Event streams open after their last event, waiting for the client to close them',
+    multiprocess_mode='livesum',
+)
+BUFFERED_BYTES = Gauge(
+    'binderhub_event_streams_buffered_bytes',
+    'Bytes written to event streams and not yet sent to clients',
+    multiprocess_mode='livesum',
+)
+
+
+def _buffered_bytes(handler):
+    """Return the number of bytes written to handler and not yet sent"""
+    size = sum(len(chunk) for chunk in getattr(handler, '_write_buffer', []))
+    connection = getattr(handler.request, 'connection', None)
+    stream = getattr(connection, 'stream', None)
+    write_buffer = getattr(stream, '_write_buffer', None)
+    if write_buffer is not None:
+        size += len(write_buffer)
+    return size
+
+
+def _connection_closed(handler):
+    connection = handler.request.connection
+    stream = getattr(connection, 'stream', None)
+    return stream is not None and stream.closed()
+
+
+class EventStreams(LoggingConfigurable):
+    """Registry of open event streams (e.g. of BuildHandler)
+
+    Instead of a keepalive coroutine per stream,
+    a single periodic tick writes keepalive comments
+    to the streams that have been idle for `keepalive_interval`,
+    and closes the streams that outlived `linger_timeout`
+    after their last event.
+    The tick only runs while streams are open.
+
+    Handlers call :meth:`register` when they start streaming,
+    :meth:`touch` when writing an event,
+    :meth:`linger` after their last event,
+    and :meth:`unregister` when finished.
+    """
+
+    # shared instance
+    _instance = None
+
+    keepalive_interval = Float(
+        25,
+        config=True,
+        help="""Time (in seconds) without events after which to write a keepalive
+
+        So that intermediate proxies don't terminate idle connections.
+        """,
+    )
+
+    linger_timeout = Float(
+        60,
+        config=True,
+        help="""Maximum time (in seconds) to keep a stream open after its last event
+
+        EventSource clients reconnect automatically when the server closes a stream,
+        so streams are left open for the client to close them
+        once it has received the last event.
+        """,
+    )
+
+    tick_interval = Float(
+        5,
+        config=True,
+        help="""Time (in seconds) between checks of the open streams
+
+        Keepalives and closing lingering streams are accurate to this interval.
+        """,
+    )
+
+    @classmethod
+    def instance(cls, config=None):
+        """Return the shared registry"""
+        if cls._instance is None:
+            cls._instance = cls(config=config)
+        return cls._instance
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # time of the last write, by handler
+        self.streams = {}
+        # lingering streams, by handler: (future resolved when the stream
+        # should be closed, time after which to close it)
+        self.lingering = {}
+        self._ticker = None
+        self._loop = None
+
+    def _now(self):
+        return time.monotonic()
+
+    def _ensure_ticking(self):
+        loop = IOLoop.current()
+        if self._ticker is not None and self._loop is loop:
+            return
+        if self._ticker is not None:
+            self._ticker.stop()
+        self._loop = loop
+        self._ticker = PeriodicCallback(self.tick, self.tick_interval * 1000)
+        self._ticker.start()
+
+    def _update_metrics(self):
+        OPEN_STREAMS.set(len(self.streams))
+        LINGERING_STREAMS.set(len(self.lingering))
+
+    def register(self, handler):
+        """Start keeping handler's stream alive"""
+        self.streams[handler] = self._now()
+        self._ensure_ticking()
+        self._update_metrics()
+
+    def touch(self, handler):
+        """Record a write to handler's stream, postponing the next keepalive"""
+        if handler in self.streams:
+            self.streams[handler] = self._now()
+
+    def linger(self, handler):
+        """Return a future resolved when handler's stream should be closed
+
+        That is when the client closes the connection,
+        or after `linger_timeout`.
+        """
+        if handler in self.lingering:
+            return self.lingering[handler][0]
+        future = asyncio.get_running_loop().create_future()
+        if handler not in self.streams or _connection_closed(handler):
+            future.set_result(None)
+            return future
+        self.lingering[handler] = (future, self._now() + self.linger_timeout)
+        self._update_metrics()
+        return future
+
+    def closed(self, handler):
+        """Signal that the client closed handler's connection"""
+        future, _ = self.lingering.pop(handler, (None, None))
+        if future is not None and not future.done():
+            future.set_result(None)
+        self.streams.pop(handler, None)
+        self._update_metrics()
+
+    def unregister(self, handler):
+        """Stop tracking handler's stream, when it is finished"""
+        self.closed(handler)
+
+    def tick(self):
+        """Write keepalives to idle streams, and release expired lingering streams"""
+        now = self._now()
+        buffered = 0
+        for handler, last_write in list(self.streams.items()):
+            if handler._finished:
+                self.unregister(handler)
+                continue
+            if handler in self.lingering and now >= self.lingering[handler][1]:
+                self.log.debug("Closing lingering stream %s", handler.request.uri)
+                self.closed(handler)
+                continue
+            buffered += _buffered_bytes(handler)
+            if now - last_write >= self.keepalive_interval:
+                self._keepalive(handler, now)
+        BUFFERED_BYTES.set(buffered)
+        self._update_metrics()
+
+        if not self.streams and self._ticker is not None:
+            self._ticker.stop()
+            self._ticker = None
+
+    def _keepalive(self, handler, now):
+        self.streams[handler] = now
+        # lines that start with : are comments
+        # and should be ignored by event consumers
+        handler.write(':keepalive\n\n')
+        future = handler.flush()
+
+        def flushed(f):
+            if f.cancelled() or f.exception() is not None:
+                # the client is gone
+                self.closed(handler)
+
+        future.add_done_callback(flushed)
@@ -4,10 +4,10 @@ import time
 
 from functools import wraps
 
-from tornado.httpclient import AsyncHTTPClient
 from tornado.log import app_log
 
 from .base import BaseHandler
+from .httpclient import HubHTTPClient
 from .utils import KUBE_REQUEST_TIMEOUT
 
 
@@ -138,7 +138,9 @@ class HealthHandler(BaseHandler):
     @retry
     async def check_jupyterhub_api(self, hub_url):
         """Check JupyterHub API health"""
-        await AsyncHTTPClient().fetch(hub_url + "hub/health", request_timeout=3)
+        await HubHTTPClient.instance(config=self.settings.get("traitlets_config")).fetch(
+            hub_url + "hub/health", request_timeout=3
+        )
         return True
 
     @false_if_raises
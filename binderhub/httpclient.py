@@ -0,0 +1,231 @@
+"""
+Isolated HTTP clients for each upstream service
+
+Each upstream (the JupyterHub API, the docker registry, GitHub, ...)
+gets its own AsyncHTTPClient instance, with its own limit on concurrent requests,
+timeouts and connections, so that slow requests to one upstream
+(e.g. a third-party API) never queue up requests to another (e.g. launches on the Hub).
+"""
+import asyncio
+import time
+
+from prometheus_client import Gauge, Histogram
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.netutil import Resolver
+from traitlets.config import LoggingConfigurable
+from traitlets import Float, Integer, default
+
+from .dns import CachingResolver
+
+QUEUE_WAIT_TIME = Histogram(
+    'binderhub_http_client_queue_wait_seconds',
+    'Time requests wait for a free slot of the HTTP client of an upstream',
+    ['upstream'],
+    buckets=[0.001, 0.01, 0.1, 0.5, 1, 2, 5, 10, 30, float("inf")],
+)
+QUEUED_REQUESTS = Gauge(
+    'binderhub_http_client_queued_requests',
+    'Requests waiting for a free slot of the HTTP client of an upstream',
+    ['upstream'],
+    multiprocess_mode='livesum',
+)
+IN_FLIGHT_REQUESTS = Gauge(
+    'binderhub_http_client_in_flight_requests',
+    'Requests in progress with the HTTP client of an upstream',
+    ['upstream'],
+    multiprocess_mode='livesum',
+)
+
+
+class HTTPClient(LoggingConfigurable):
+    """An isolated HTTP client for one upstream service
+
+    Use :meth:`instance` to get the shared client of each class,
+    and ``.fetch`` like ``AsyncHTTPClient.fetch``.
+    Subclasses define the upstream and its defaults,
+    and can each be configured, e.g. ``c.GitHubHTTPClient.max_clients = 20``.
+    """
+
+    # label of the upstream in metrics
+    upstream = 'other'
+
+    # shared instances, by class
+    _instances = {}
+
+    max_clients = Integer(
+        10,
+        config=True,
+        help="""Maximum number of concurrent requests to the upstream
+
+        Further requests wait for a free slot.
+        """,
+    )
+
+    connect_timeout = Float(
+        20,
+        config=True,
+        help="""Default timeout (in seconds) for connecting to the upstream""",
+    )
+
+    request_timeout = Float(
+        20,
+        config=True,
+        help="""Default timeout (in seconds) for a whole request to the upstream
+
+        Does not include the time spent waiting for a free slot.
+        """,
+    )
+
+    @classmethod
+    def instance(cls, config=None):
+        """Return the shared client of this class"""
+        if cls not in cls._instances:
+            cls._instances[cls] = cls(config=config)
+        return cls._instances[cls]
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._client = None
+        self._semaphore = None
+        self._loop = None
+        self._resolver = None
+
+    @property
+    def client(self):
+        """The AsyncHTTPClient instance of this upstream, created on first use
+
+        Like AsyncHTTPClient instances, there is one per IOLoop.
+        """
+        loop = IOLoop.current()
+        if self._client is None or self._loop is not loop:
+            self._loop = loop
+            self._client = AsyncHTTPClient(
+                force_instance=True,
+                max_clients=self.max_clients,
+                defaults=dict(
+                    connect_timeout=self.connect_timeout,
+                    request_timeout=self.request_timeout,
+                ),
+            )
+            self._semaphore = asyncio.Semaphore(self.max_clients)
+            self._resolver = None
+            if issubclass(Resolver.configured_class(), CachingResolver) and hasattr(
+                self._client, "_curls"
+            ):
+                # curl doesn't use tornado's resolver,
+                # so pin each request to the addresses resolved by the caching resolver
+                self._resolver = Resolver()
+        return self._client
+
+    def close(self):
+        if self._client is not None:
+            self._client.close()
+            self._client = None
+
+    async def fetch(self, request, **kwargs):
+        """Make a request with the client of this upstream
+
+        Same arguments as ``AsyncHTTPClient.fetch``.
+        """
+        client = self.client
+        if self._resolver is not None:
+            if not isinstance(request, HTTPRequest):
+                # raise_error is an argument of fetch, not of the request
+                raise_error = kwargs.pop('raise_error', True)
+                request = HTTPRequest(url=request, **kwargs)
+                kwargs = dict(raise_error=raise_error)
+            request = await self._resolver.pin_request(request)
+        labels = dict(upstream=self.upstream)
+        QUEUED_REQUESTS.labels(**labels).inc()
+        queued = time.perf_counter()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            QUEUED_REQUESTS.labels(**labels).dec()
+        QUEUE_WAIT_TIME.labels(**labels).observe(time.perf_counter() - queued)
+
+        IN_FLIGHT_REQUESTS.labels(**labels).inc()
+        try:
+            return await client.fetch(request, **kwargs)
+        finally:
+            IN_FLIGHT_REQUESTS.labels(**labels).dec()
+            self._semaphore.release()
+
+
+class HubHTTPClient(HTTPClient):
+    """HTTP client for the JupyterHub API, used to launch servers"""
+
+    upstream = 'hub'
+
+    @default('max_clients')
+    def _default_max_clients(self):
+        return 64
+
+
+class RegistryHTTPClient(HTTPClient):
+    """HTTP client for the docker registry"""
+
+    upstream = 'registry'
+
+    @default('max_clients')
+    def _default_max_clients(self):
+        return 32
+
+
+class GitHubHTTPClient(HTTPClient):
+    """HTTP client for the GitHub API"""
+
+    upstream = 'github'
+
+    @default('max_clients')
+    def _default_max_clients(self):
+        return 32
+
+
+class GitLabHTTPClient(HTTPClient):
+    """HTTP client for the GitLab API"""
+
+    upstream = 'gitlab'
+
+
+class DOIHTTPClient(HTTPClient):
+    """HTTP client for DOI resolution and archive APIs (Zenodo, Figshare, Dataverse, Hydroshare)"""
+
+    upstream = 'doi'
+
+
+class OAuthHTTPClient(HTTPClient):
+    """HTTP client for OAuth token exchanges with repository hosts (RDM, WEKO3)"""
+
+    upstream = 'oauth'
+
+    @default('request_timeout')
+    def _default_request_timeout(self):
+        # a user is waiting on the callback
+        return 10
+
+
+class NbviewerHTTPClient(HTTPClient):
+    """HTTP client for checking nbviewer links"""
+
+    upstream = 'nbviewer'
+
+    @default('max_clients')
+    def _default_max_clients(self):
+        return 4
+
+    @default('request_timeout')
+    def _default_request_timeout(self):
+        # only used to decide whether to show a link while loading
+        return 5
+
+
+class JobCallbackHTTPClient(HTTPClient):
+    """HTTP client for notifying the callback URLs of launch jobs"""
+
+    upstream = 'job_callback'
+
+    @default('request_timeout')
+    def _default_request_timeout(self):
+        return 10
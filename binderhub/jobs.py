@@ -0,0 +1,291 @@
+"""
+Launch jobs, building and launching independently of the client's connection
+"""
+import asyncio
+import json
+import sys
+import time
+import uuid
+from urllib.parse import urlparse
+
+from tornado.httpclient import HTTPRequest
+from tornado.log import app_log
+from tornado.web import Finish, HTTPError, authenticated
+
+from .base import APIHandler, BaseHandler
+from .builder import BuildHandler
+from .httpclient import JobCallbackHTTPClient
+from .utils import Cache
+
+# longest long-poll of GET /api/jobs/{id}
+MAX_WAIT = 60
+
+
+class LaunchJob:
+    """State and journal of events of a launch
+
+    status is one of:
+
+    - running: building and launching
+    - ready: launched, the last event has the server's url and token
+    - auth: authorization required, the last event has the authorization_url
+    - failed: the last event has the error message
+    """
+
+    def __init__(self, provider_prefix, spec, user=None, callback_url=None):
+        self.id = uuid.uuid4().hex
+        self.provider_prefix = provider_prefix
+        self.spec = spec
+        self.user = user
+        self.callback_url = callback_url
+        self.created = time.time()
+        self.finished = None
+        self.status = 'running'
+        self.events = []
+        self._changed = asyncio.Event()
+
+    @property
+    def done(self):
+        return self.status != 'running'
+
+    def add_event(self, event):
+        self.events.append(event)
+        self._notify()
+
+    def finish(self):
+        """Set the final status, from the last event"""
+        last_phase = self.events[-1].get('phase') if self.events else None
+        self.status = last_phase if last_phase in ('ready', 'auth') else 'failed'
+        self.finished = time.time()
+        self._notify()
+
+    def _notify(self):
+        # wake up long-polls
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self, since, timeout):
+        """Wait for events after `since`, or the end of the job, for at most `timeout`"""
+        if self.done or len(self.events) > since or timeout <= 0:
+            return
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def model(self, since=0):
+        """The JSON model of the job, with the events after `since`"""
+        return {
+            'id': self.id,
+            'provider': self.provider_prefix,
+            'spec': self.spec,
+            'status': self.status,
+            'created': self.created,
+            'finished': self.finished,
+            'events': self.events[since:],
+            # `since` to use for the next request
+            'next': len(self.events),
+        }
+
+
+class LaunchJobHandler(BuildHandler):
+    """POST /api/launch: start building and launching a repo
+
+    The body is JSON: ``{"provider": "gh", "spec": "org/repo/ref"}``,
+    with an optional ``"callback_url"`` (if enabled), notified with the job
+    when it is done.
+    Responds (202) with the job, to be followed with GET /api/jobs/{id}.
+    The job goes on if the client disconnects.
+    """
+
+    # shared stores of jobs, by id
+    # running jobs are kept until they finish
+    running_jobs = {}
+    # finished jobs are forgotten after an hour
+    jobs = Cache(4096, max_age=3600)
+
+    job = None
+
+    # responds right away, the job goes on in the background
+    streaming = False
+
+    def set_default_headers(self):
+        # not an event stream
+        BaseHandler.set_default_headers(self)
+        self.set_header('Content-Type', 'application/json')
+
+    def send_error(self, status_code=500, **kwargs):
+        BaseHandler.send_error(self, status_code, **kwargs)
+
+    def write_error(self, status_code, **kwargs):
+        self.set_retry_after(kwargs.get('exc_info'))
+        self.finish(json.dumps(self.error_event(status_code, kwargs.get('exc_info'))))
+
+    def check_xsrf_cookie(self):
+        # API request, not a form
+        pass
+
+    @classmethod
+    def get_job(cls, job_id):
+        """Return the running or finished job with id `job_id`, if any"""
+        job = cls.running_jobs.get(job_id)
+        if job is None:
+            job = cls.jobs.get(job_id)
+        return job
+
+    def get(self, *args):
+        # only POST, not BuildHandler's event stream
+        raise HTTPError(405)
+
+    def check_rate_limit(self, bucket, count=1):
+        if bucket == 'launch' and self.job is not None:
+            # already taken by post, before creating the job
+            return
+        super().check_rate_limit(bucket, count)
+
+    @authenticated
+    async def post(self):
+        try:
+            body = json.loads(self.request.body or b'{}')
+        except ValueError:
+            raise HTTPError(400, "Request body must be JSON")
+        if not isinstance(body, dict):
+            raise HTTPError(400, "Request body must be a JSON object")
+        provider_prefix = body.get('provider')
+        spec = body.get('spec')
+        if not isinstance(provider_prefix, str) or not isinstance(spec, str):
+            raise HTTPError(400, "provider and spec are required")
+        if provider_prefix not in self.settings['repo_providers']:
+            raise HTTPError(404, "No provider found for prefix %s" % provider_prefix)
+
+        callback_url = body.get('callback_url')
+        if callback_url is not None:
+            if not self.settings.get('job_callbacks_enabled'):
+                raise HTTPError(400, "Callbacks are not enabled")
+            if not isinstance(callback_url, str) or urlparse(callback_url).scheme not in (
+                'http',
+                'https',
+            ):
+                raise HTTPError(400, "callback_url must be an http(s) URL")
+
+        # before accepting the job, so that the client gets the 429
+        self.check_rate_limit('launch')
+
+        self.job = LaunchJob(
+            provider_prefix,
+            spec.rstrip('/'),
+            user=job_user(self),
+            callback_url=callback_url,
+        )
+        self.running_jobs[self.job.id] = self.job
+        asyncio.ensure_future(self._run())
+
+        self.set_status(202)
+        self.set_header('Location', self.reverse_job_url(self.job.id))
+        self.finish(json.dumps(self.job.model()))
+
+    def reverse_job_url(self, job_id):
+        return self.settings['base_url'] + 'api/jobs/' + job_id
+
+    def get_spec_from_request(self, prefix):
+        # from the body, not the path
+        return self.job.spec
+
+    def on_finish(self):
+        # the job goes on after the response
+        pass
+
+    def start_stream(self):
+        pass
+
+    async def end_stream(self):
+        pass
+
+    async def emit(self, data):
+        """Add an event to the journal of the job"""
+        if isinstance(data, str):
+            data = json.loads(data)
+        self.job.add_event(data)
+
+    async def _run(self):
+        """Build and launch, after the response was sent
+
+        The handler outlives its request here. BuildHandler's pipeline still uses:
+
+        - self.settings, self.current_user and self.request (host, protocol, remote_ip),
+          which don't change after finish
+        - self.build, stopped at the end
+        - the methods overridden above (get_spec_from_request, emit, start_stream,
+          end_stream, on_finish), so that nothing is written to the connection
+        """
+        job = self.job
+        try:
+            await self.build_and_launch(job.provider_prefix, job.spec)
+        except Finish:
+            pass
+        except Exception as e:
+            exc_info = sys.exc_info()
+            if isinstance(e, HTTPError):
+                status_code = e.status_code
+            else:
+                app_log.error("Launch job %s failed", job.id, exc_info=exc_info)
+                status_code = 500
+            job.add_event(self.error_event(status_code, exc_info))
+        finally:
+            if self.build:
+                self.build.stop()
+            job.finish()
+            # keep finished jobs for max_age
+            self.jobs.set(job.id, job)
+            self.running_jobs.pop(job.id, None)
+        if job.callback_url:
+            await self._callback(job)
+
+    async def _callback(self, job):
+        """Notify the callback URL of the job that it's done"""
+        request = HTTPRequest(
+            job.callback_url,
+            method='POST',
+            headers={'Content-Type': 'application/json'},
+            body=json.dumps(job.model()),
+            follow_redirects=False,
+        )
+        client = JobCallbackHTTPClient.instance(config=self.settings.get('traitlets_config'))
+        try:
+            await client.fetch(request)
+        except Exception as e:
+            app_log.warning("Failed to notify %s of job %s: %s", job.callback_url, job.id, e)
+
+
+def job_user(handler):
+    """Return the name of the user making a request, the owner of jobs"""
+    user = handler.current_user
+    if isinstance(user, dict):
+        return user.get('name')
+    return user
+
+
+class JobHandler(APIHandler):
+    """GET /api/jobs/{id}: status and events of a launch job
+
+    Query parameters:
+
+    - since: index of the first event to return (the `next` of a previous response)
+    - wait: wait up to this many seconds for new events (long-poll)
+    """
+
+    @authenticated
+    async def get(self, job_id):
+        job = LaunchJobHandler.get_job(job_id)
+        if job is None or (
+            self.settings['auth_enabled'] and job.user != job_user(self)
+        ):
+            raise HTTPError(404, "No such job: %s" % job_id)
+        try:
+            since = max(int(self.get_argument('since', '0')), 0)
+            wait = min(float(self.get_argument('wait', '0')), MAX_WAIT)
+        except ValueError:
+            raise HTTPError(400, "since and wait must be numbers")
+        await job.wait(since, wait)
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps(job.model(since)))
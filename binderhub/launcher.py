@@ -12,12 +12,14 @@ import os
 
 from tornado.log import app_log
 from tornado import web, gen
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest, HTTPError
+from tornado.httpclient import HTTPRequest, HTTPError
 from traitlets.config import LoggingConfigurable
 from traitlets import Integer, Unicode, Bool, default
 from jupyterhub.traitlets import Callable
 from jupyterhub.utils import maybe_future
 
+from .httpclient import HubHTTPClient
+
 # pattern for checking if it's an ssh repo and not a URL
 # used only after verifying that `://` is not present
 _ssh_repo_pat = re.compile(r'.*@.*\:')
@@ -91,7 +93,7 @@ class Launcher(LoggingConfigurable):
         retry_delay = self.retry_delay
         for i in range(1, self.retries + 1):
             try:
-                return await AsyncHTTPClient().fetch(req)
+                return await HubHTTPClient.instance(config=self.config).fetch(req)
             except HTTPError as e:
                 # swallow 409 errors on retry only (not first attempt)
                 if i > 1 and e.code == 409 and e.response:
@@ -11,12 +11,76 @@ from http.cookies import SimpleCookie
 from urllib.parse import urlparse
 from urllib.parse import urlunparse
 
+from prometheus_client import Histogram
+from tornado.escape import json_encode
+from tornado.escape import utf8
 from tornado.log import access_log
 from tornado.log import LogFormatter
 from tornado.web import HTTPError
 from tornado.web import StaticFileHandler
 
 
+REQUEST_DURATION = Histogram(
+    'binderhub_request_duration_seconds',
+    'Time to respond to requests, by handler, method and status family',
+    ['handler', 'method', 'code'],
+    buckets=[0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf")],
+)
+RESPONSE_SIZE = Histogram(
+    'binderhub_response_size_bytes',
+    'Size of response bodies, by handler, method and status family',
+    ['handler', 'method', 'code'],
+    buckets=[100, 1e3, 1e4, 1e5, 1e6, 1e7, float("inf")],
+)
+STREAM_DURATION = Histogram(
+    'binderhub_stream_duration_seconds',
+    'Duration of event streams (build and launch progress), by handler and status family',
+    ['handler', 'code'],
+    buckets=[1, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float("inf")],
+)
+
+# other methods are counted as 'other', to keep the number of labels bounded
+METRIC_METHODS = {"GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"}
+
+
+class ResponseSizeMixin:
+    """Count the bytes of the response body written by a handler, as `response_size`"""
+
+    response_size = 0
+
+    def write(self, chunk):
+        super().write(chunk)
+        # encoded like RequestHandler.write
+        if isinstance(chunk, dict):
+            chunk = json_encode(chunk)
+        self.response_size += len(utf8(chunk))
+
+    def clear(self):
+        super().clear()
+        self.response_size = 0
+
+
+def record_request_metrics(handler, request_time):
+    """Record the duration and size of a request in prometheus
+
+    Handlers with `streaming = True` (event streams, whose duration is that of
+    a build and launch) are recorded in a separate histogram.
+    """
+    name = type(handler).__name__
+    code = "{}xx".format(handler.get_status() // 100)
+    if getattr(handler, "streaming", False):
+        STREAM_DURATION.labels(handler=name, code=code).observe(request_time)
+        return
+    method = handler.request.method
+    if method not in METRIC_METHODS:
+        method = "other"
+    REQUEST_DURATION.labels(handler=name, method=method, code=code).observe(request_time)
+    # only known for handlers with ResponseSizeMixin
+    size = getattr(handler, "response_size", None)
+    if size is not None:
+        RESPONSE_SIZE.labels(handler=name, method=method, code=code).observe(size)
+
+
 # url params to be scrubbed if seen
 # any url param that *contains* one of these
 # will be scrubbed from logs
@@ -79,7 +143,8 @@ def log_request(handler):
     """
     status = handler.get_status()
     request = handler.request
-    request_time = 1000.0 * request.request_time()  # seconds to milliseconds
+    record_request_metrics(handler, request.request_time())
+    request_time = 1000.0 * request.request_time()  # seconds to milliseconds, for the log
 
     if status == 304 or (
         status < 300
@@ -1,14 +1,19 @@
 """
 Main handler classes for requests
 """
+import asyncio
+import json
 import urllib.parse
 
-from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.httpclient import HTTPRequest
 from tornado.web import HTTPError, authenticated
 from tornado.httputil import url_concat
 from tornado.log import app_log
 
 from .base import BaseHandler
+from .builder import BuildHandler
+from .httpclient import NbviewerHTTPClient
+from .utils import Cache, url_path_join
 
 SPEC_NAMES = {
     "gh": "GitHub",
@@ -24,14 +29,75 @@ SPEC_NAMES = {
 }
 
 
+# shared cache of nbviewer checks: url -> whether nbviewer shows something useful
+nbviewer_cache = Cache(4096)
+
+# in-progress nbviewer checks, by url
+_nbviewer_checks = {}
+
+
+def get_nbviewer_url(org, repo_name, ref, filepath):
+    """Return the nbviewer URL for a file (or the tree) of a GitHub repo"""
+    blob_or_tree = 'blob' if filepath else 'tree'
+    return f'https://nbviewer.jupyter.org/github/{org}/{repo_name}/{blob_or_tree}/{ref}/{filepath}'
+
+
+class NbviewerMixin:
+    """Check (and cache) whether nbviewer would display something useful for a URL"""
+
+    def get_cached_nbviewer_check(self, nbviewer_url):
+        """Return the cached result of checking nbviewer_url, or None if unknown"""
+        available = nbviewer_cache.get(nbviewer_url)
+        if available is None:
+            return None
+        if nbviewer_cache.age(nbviewer_url) >= self.settings.get('nbviewer_cache_ttl', 600):
+            return None
+        return available
+
+    def check_nbviewer(self, nbviewer_url):
+        """Return a future resolving to whether nbviewer_url is available
+
+        Concurrent checks of the same URL share a single request.
+        """
+        future = _nbviewer_checks.get(nbviewer_url)
+        if future is None:
+            future = asyncio.ensure_future(self._check_nbviewer(nbviewer_url))
+            _nbviewer_checks[nbviewer_url] = future
+            future.add_done_callback(lambda f: _nbviewer_checks.pop(nbviewer_url, None))
+        return future
+
+    async def _check_nbviewer(self, nbviewer_url):
+        client = NbviewerHTTPClient.instance(config=self.settings.get('traitlets_config'))
+        # quote any unicode characters in the URL
+        proto, rest = nbviewer_url.split("://")
+        rest = urllib.parse.quote(rest)
+
+        request = HTTPRequest(proto + "://" + rest,
+                              method="HEAD",
+                              user_agent="BinderHub",
+                              )
+        try:
+            response = await client.fetch(request, raise_error=False)
+        except Exception as e:
+            # e.g. a timeout: don't show the link, but don't cache it either
+            app_log.warning("Failed to check nbviewer URL %s: %s", nbviewer_url, e)
+            return False
+        available = response.code < 400
+        nbviewer_cache.set(nbviewer_url, available)
+        return available
+
+
 class MainHandler(BaseHandler):
     """Main handler for requests"""
 
     @authenticated
     def get(self):
-        self.render_template(
+        badge_base_url = self.get_badge_base_url()
+        self.render_cached_template(
             "index.html",
-            badge_base_url=self.get_badge_base_url(),
+            # badge_base_url may be computed from the request
+            cache_key=badge_base_url,
+            badge_base_url=badge_base_url,
             base_url=self.settings['base_url'],
             submit=False,
             google_analytics_code=self.settings['google_analytics_code'],
@@ -41,11 +107,12 @@ class MainHandler(BaseHandler):
         )
 
 
-class ParameterizedMainHandler(BaseHandler):
+class ParameterizedMainHandler(NbviewerMixin, BaseHandler):
     """Main handler that allows different parameter settings"""
 
     @authenticated
     async def get(self, provider_prefix, _unescaped_spec):
+        self.check_rate_limit('page')
         prefix = '/v2/' + provider_prefix
         spec = self.get_spec_from_request(prefix)
         spec = spec.rstrip("/")
@@ -62,12 +129,16 @@ class ParameterizedMainHandler(BaseHandler):
             # maybe we should catch a special InvalidSpecError here
             raise HTTPError(400, str(e))
 
+        if self.settings.get('speculative_resolution'):
+            # get a head start on the build request the page is about to make
+            BuildHandler.speculate(self.settings, provider_prefix, spec)
+
         provider_spec = f'{provider_prefix}/{spec}'
         social_desc = f"{SPEC_NAMES[provider_prefix]}: {spec}"
         nbviewer_url = None
+        nbviewer_check_url = None
         if provider_prefix == "gh":
             # we can only produce an nbviewer URL for github right now
-            nbviewer_url = 'https://nbviewer.jupyter.org/github'
             org, repo_name, ref = spec.split('/', 2)
             # NOTE: tornado unquotes query arguments too -> notebooks%2Findex.ipynb becomes notebooks/index.ipynb
             filepath = self.get_argument('filepath', '').lstrip('/')
@@ -77,23 +148,20 @@ class ParameterizedMainHandler(BaseHandler):
             if urlpath.startswith("lab") and "/tree/" in urlpath:
                 filepath = urlpath.split('tree/', 1)[-1]
 
-            blob_or_tree = 'blob' if filepath else 'tree'
-            nbviewer_url = f'{nbviewer_url}/{org}/{repo_name}/{blob_or_tree}/{ref}/{filepath}'
-
             # Check if the nbviewer URL is valid and would display something
-            # useful to the reader, if not we don't show it
-            client = AsyncHTTPClient()
-            # quote any unicode characters in the URL
-            proto, rest = nbviewer_url.split("://")
-            rest = urllib.parse.quote(rest)
-
-            request = HTTPRequest(proto + "://" + rest,
-                                  method="HEAD",
-                                  user_agent="BinderHub",
-                                  )
-            response = await client.fetch(request, raise_error=False)
-            if response.code >= 400:
-                nbviewer_url = None
+            # useful to the reader, if not we don't show it.
+            # Don't wait for nbviewer to render the page:
+            # if unknown, check in the background and let the page ask for the result.
+            url = get_nbviewer_url(org, repo_name, ref, filepath)
+            available = self.get_cached_nbviewer_check(url)
+            if available is None:
+                self.check_nbviewer(url)
+                nbviewer_check_url = url_concat(
+                    url_path_join(self.settings['base_url'], '_nbviewer'),
+                    dict(org=org, repo=repo_name, ref=ref, filepath=filepath),
+                )
+            elif available:
+                nbviewer_url = url
 
         self.render_template(
             "loading.html",
@@ -102,6 +170,7 @@ class ParameterizedMainHandler(BaseHandler):
             provider_spec=provider_spec,
             social_desc=social_desc,
             nbviewer_url=nbviewer_url,
+            nbviewer_check_url=nbviewer_check_url,
             # urlpath=self.get_argument('urlpath', None),
             submit=True,
             google_analytics_code=self.settings['google_analytics_code'],
@@ -110,6 +179,38 @@ class ParameterizedMainHandler(BaseHandler):
         )
 
 
+class NbviewerHandler(NbviewerMixin, BaseHandler):
+    """Report whether nbviewer shows something useful for a GitHub repo
+
+    Polled by the loading page when the result wasn't known when it was rendered.
+    """
+
+    @authenticated
+    async def get(self):
+        self.check_rate_limit('page')
+        org = self.get_argument('org')
+        repo_name = self.get_argument('repo')
+        ref = self.get_argument('ref')
+        # only the GitHub repos the loading page would link to
+        if not (org and repo_name and ref) or '/' in org or '/' in repo_name:
+            raise HTTPError(400, "Invalid GitHub repo: %s/%s/%s" % (org, repo_name, ref))
+        try:
+            self.get_provider('gh', spec=f'{org}/{repo_name}/{ref}')
+        except HTTPError:
+            raise
+        except Exception as e:
+            raise HTTPError(400, str(e))
+        url = get_nbviewer_url(
+            org, repo_name, ref, self.get_argument('filepath', '').lstrip('/')
+        )
+        available = self.get_cached_nbviewer_check(url)
+        if available is None:
+            # shared with other requests, which still need it if this one is closed
+            available = await asyncio.shield(self.check_nbviewer(url))
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'nbviewer_url': url if available else None}))
+
+
 class LegacyRedirectHandler(BaseHandler):
     """Redirect handler from legacy Binder"""
 
@@ -1,5 +1,62 @@
+import glob
+import os
+import re
+
 from .base import BaseHandler
-from prometheus_client import REGISTRY, generate_latest, CONTENT_TYPE_LATEST
+from .builder import BUILD_COUNT, LAUNCH_COUNT
+from .utils import multiprocess_dir
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    generate_latest,
+    multiprocess,
+    CONTENT_TYPE_LATEST,
+)
+
+
+def metrics_registry():
+    """Return the registry of the metrics to report
+
+    In multiprocess mode (see BinderHub.num_workers),
+    metrics are aggregated across the worker processes.
+    """
+    if not multiprocess_dir():
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    # not prometheus_client metrics, they aggregate their own files
+    registry.register(BUILD_COUNT)
+    registry.register(LAUNCH_COUNT)
+    return registry
+
+
+def clear_multiprocess_dir(keep_pid=None):
+    """Remove the metrics of a previous run
+
+    The files of process `keep_pid` are kept: its metrics already write to them,
+    and would be lost if they were removed.
+    """
+    path = multiprocess_dir()
+    for pattern in ("*.db", "repo_counts_*.json"):
+        for f in glob.glob(os.path.join(path, pattern)):
+            if keep_pid is not None and re.search(r"_%i\.(db|json)$" % keep_pid, f):
+                continue
+            os.remove(f)
+
+
+def mark_dead_workers():
+    """Remove the live gauges of worker processes that exited"""
+    pids = set()
+    for f in glob.glob(os.path.join(multiprocess_dir(), "gauge_live*_*.db")):
+        pids.add(int(re.search(r"_(\d+)\.db$", f).group(1)))
+    for pid in pids:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            multiprocess.mark_process_dead(pid)
+        except PermissionError:
+            # exists
+            pass
 
 
 class MetricsHandler(BaseHandler):
@@ -8,4 +65,4 @@ class MetricsHandler(BaseHandler):
 
     async def get(self):
         self.set_header("Content-Type", CONTENT_TYPE_LATEST)
-        self.write(generate_latest(REGISTRY))
+        self.write(generate_latest(metrics_registry()))
@@ -0,0 +1,190 @@
+"""
+Token-bucket rate limits for clients
+"""
+from ipaddress import ip_address, ip_network
+import math
+import time
+
+from prometheus_client import Counter
+from tornado.web import HTTPError
+from traitlets.config import LoggingConfigurable
+from traitlets import Dict, Integer, TraitError, Unicode, validate
+
+from .utils import Cache
+
+RATE_LIMITED = Counter(
+    'binderhub_rate_limited_requests',
+    'Requests rejected because the client exceeded a rate limit',
+    ['bucket'],
+)
+
+
+class RateLimitExceeded(HTTPError):
+    """Raised when a client exceeds a rate limit (429 Too Many Requests)"""
+
+    def __init__(self, bucket, retry_after):
+        self.bucket = bucket
+        # in whole seconds, for the Retry-After header
+        self.retry_after = max(math.ceil(retry_after), 1)
+        super().__init__(
+            429, "Too many requests, try again in %i seconds.", self.retry_after
+        )
+
+
+class RateLimiter(LoggingConfigurable):
+    """Token-bucket rate limits, per client
+
+    Each client gets a bucket of `burst` tokens for each kind of request
+    (e.g. ``launch``), refilled at `rate` tokens per second.
+    Each request takes a token, and is rejected when the bucket is empty.
+
+    Buckets are kept for the `max_clients` most recently seen clients,
+    so memory is bounded.
+    """
+
+    # shared instance
+    _instance = None
+
+    limits = Dict(
+        config=True,
+        help="""Rate limits, by kind of request: {'rate': tokens per second, 'burst': tokens}
+
+        Kinds of requests are:
+
+        - page: loading a launch page (/v2/...)
+        - launch: a request to build (if needed) and launch a repo (/build/..., /api/launch)
+        - build: starting a new build of an image, on top of `launch`
+        - status: each repo of a request to /api/status
+
+        For example, to allow a client 6 launches per minute, in bursts of up to 20,
+        and 1 build per minute in bursts of 5::
+
+            c.RateLimiter.limits = {
+                'launch': {'rate': 0.1, 'burst': 20},
+                'build': {'rate': 1 / 60, 'burst': 5},
+            }
+
+        Kinds of requests without a limit are not limited (the default).
+        """,
+    )
+
+    @validate('limits')
+    def _validate_limits(self, proposal):
+        limits = proposal.value
+        for bucket, limit in limits.items():
+            if not isinstance(limit, dict) or set(limit) != {'rate', 'burst'}:
+                raise TraitError(
+                    "Rate limit for {} must be {{'rate': float, 'burst': int}}, not {!r}".format(
+                        bucket, limit
+                    )
+                )
+            if limit['rate'] <= 0 or limit['burst'] < 1:
+                raise TraitError("Rate limit for {} must allow some requests".format(bucket))
+        return limits
+
+    key = Unicode(
+        'ip',
+        config=True,
+        help="""What identifies a client:
+
+        - ip: its IP address
+        - network: its network, with prefixes `ipv4_prefix_len` and `ipv6_prefix_len`
+        - user: the authenticated user, or the IP address without authentication
+        """,
+    )
+
+    @validate('key')
+    def _validate_key(self, proposal):
+        if proposal.value not in ('ip', 'network', 'user'):
+            raise TraitError("key must be 'ip', 'network' or 'user', not %r" % proposal.value)
+        return proposal.value
+
+    ipv4_prefix_len = Integer(
+        24,
+        config=True,
+        help="""Prefix length of IPv4 networks, when key is 'network'""",
+    )
+
+    ipv6_prefix_len = Integer(
+        64,
+        config=True,
+        help="""Prefix length of IPv6 networks, when key is 'network'""",
+    )
+
+    max_clients = Integer(
+        10000,
+        config=True,
+        help="""Number of clients for which to keep the buckets of each kind
+
+        The buckets of the least recently seen clients are forgotten (reset).
+        """,
+    )
+
+    @classmethod
+    def instance(cls, config=None):
+        """Return the shared rate limiter"""
+        if cls._instance is None:
+            cls._instance = cls(config=config)
+        return cls._instance
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # by kind of request: {client: [tokens, last update]}
+        self.buckets = {}
+
+    def _now(self):
+        return time.monotonic()
+
+    def client_key(self, handler):
+        """Return the client making the request of `handler`"""
+        if self.key == 'user' and handler.settings.get('auth_enabled'):
+            user = handler.current_user
+            if isinstance(user, dict):
+                return 'user:' + user['name']
+            if user:
+                return 'user:' + user
+        remote_ip = handler.request.remote_ip
+        if self.key == 'network':
+            try:
+                ip = ip_address(remote_ip)
+            except ValueError:
+                return remote_ip
+            prefix_len = self.ipv4_prefix_len if ip.version == 4 else self.ipv6_prefix_len
+            return str(ip_network('{}/{}'.format(ip, prefix_len), strict=False))
+        return remote_ip
+
+    def check(self, handler, bucket, count=1):
+        """Take `count` tokens for the request of `handler` from its client's `bucket`
+
+        Raises RateLimitExceeded if there are not enough left.
+        """
+        if bucket in self.limits:
+            self.take(bucket, self.client_key(handler), count)
+
+    def take(self, bucket, client, count=1):
+        """Take `count` tokens from the bucket of `client`
+
+        At most `burst` tokens are taken, so that any request can eventually pass.
+        Raises RateLimitExceeded if there are not enough left.
+        """
+        limit = self.limits.get(bucket)
+        if not limit:
+            return
+        count = min(count, limit['burst'])
+        buckets = self.buckets.get(bucket)
+        if buckets is None:
+            buckets = self.buckets[bucket] = Cache(self.max_clients)
+
+        now = self._now()
+        state = buckets.get(client)
+        if state is None:
+            tokens = limit['burst']
+        else:
+            tokens, last = state
+            tokens = min(limit['burst'], tokens + (now - last) * limit['rate'])
+        if tokens < count:
+            buckets.set(client, [tokens, now])
+            RATE_LIMITED.labels(bucket).inc()
+            self.log.info("Rate limit of %s exceeded by %s", bucket, client)
+            raise RateLimitExceeded(bucket, (count - tokens) / limit['rate'])
+        buckets.set(client, [tokens - count, now])
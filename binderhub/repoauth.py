@@ -3,10 +3,14 @@ import logging
 import sqlite3
 import uuid
 
+from oauthlib.oauth2 import InsecureTransportError, WebApplicationClient
+from oauthlib.oauth2.rfc6749.utils import is_secure_transport
+from tornado.httpclient import HTTPRequest
 from tornado.web import authenticated
 from requests_oauthlib import OAuth2Session
 
 from .base import BaseHandler
+from .httpclient import OAuthHTTPClient
 from .utils import url_path_join
 
 
@@ -96,17 +100,43 @@ class OAuth2Client(object):
                                                 state=state)
         return auth_url
 
-    def fetch_token(self, authorization_response, binderhub_url):
-        session = self._create_session(binderhub_url)
-        return session.fetch_token(self.host['oauth_token_url'],
-                                   authorization_response=authorization_response,
-                                   client_secret=self.host['client_secret'],
-                                   include_client_id=True)
+    async def fetch_token(self, authorization_response, binderhub_url, config=None):
+        """Exchange the authorization code in authorization_response for a token
+
+        Same as OAuth2Session.fetch_token, but without blocking the event loop.
+        """
+        token_url = self.host['oauth_token_url']
+        if not is_secure_transport(token_url):
+            raise InsecureTransportError()
+        client = WebApplicationClient(self.host['client_id'])
+        client.parse_request_uri_response(authorization_response)
+        body = client.prepare_request_body(
+            code=client.code,
+            redirect_uri=self._redirect_uri(binderhub_url),
+            include_client_id=True,
+            client_secret=self.host['client_secret'],
+        )
+        req = HTTPRequest(
+            token_url,
+            method='POST',
+            body=body,
+            headers={
+                'Accept': 'application/json',
+                'Content-Type': 'application/x-www-form-urlencoded',
+            },
+            user_agent='BinderHub',
+        )
+        resp = await OAuthHTTPClient.instance(config=config).fetch(req)
+        return client.parse_request_body_response(
+            resp.body.decode('utf-8'), scope=self.host['scope']
+        )
+
+    def _redirect_uri(self, binderhub_url):
+        return url_path_join(binderhub_url, '/repoauth/callback')
 
     def _create_session(self, binderhub_url):
-        redirect_uri = url_path_join(binderhub_url, '/repoauth/callback')
         return OAuth2Session(self.host['client_id'],
-                             redirect_uri=redirect_uri,
+                             redirect_uri=self._redirect_uri(binderhub_url),
                              scope=self.host['scope'])
 
 
@@ -126,7 +156,7 @@ class RepoAuthCallbackHandler(BaseHandler):
         user = self.get_current_user()
         provider_name, spec = self.tokenstore.get_session(user, state)
         provider = self.get_provider(provider_name, spec)
-        token = provider.fetch_authorized_token(auth_resp, self.binderhub_url)
+        token = await provider.fetch_authorized_token(auth_resp, self.binderhub_url)
         expires = datetime.utcfromtimestamp(token['expires_at'])
         logger.info('Token: {}'.format(expires))
         spec = self.tokenstore.register_token(user, state,
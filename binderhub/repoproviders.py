@@ -7,29 +7,36 @@ control services and providers.
 .. note:: When adding a new repo provider, add it to the allowed values for
           repo providers in event-schemas/launch.json.
 """
+import asyncio
 from copy import deepcopy
 from datetime import timedelta, datetime, timezone
+import hashlib
 import json
 import os
 import time
 import urllib.parse
 import re
-import subprocess
 from uuid import uuid1
 
 import escapism
 from prometheus_client import Gauge
 
-from tornado.httpclient import AsyncHTTPClient, HTTPError, HTTPRequest
+from tornado.httpclient import HTTPError, HTTPRequest
 from tornado.httputil import url_concat
 
-from traitlets import Dict, Unicode, Bool, default, List
+from traitlets import Dict, Float, Integer, Unicode, Bool, default, List
 from traitlets.config import LoggingConfigurable
 
-from .utils import Cache
+from .httpclient import DOIHTTPClient, GitHubHTTPClient, GitLabHTTPClient, HTTPClient
+from .upstream import Upstream, is_upstream_error
+from .utils import Cache, url_path_join
 from .repoauth import OAuth2Client
 
-GITHUB_RATE_LIMIT = Gauge('binderhub_github_rate_limit_remaining', 'GitHub rate limit remaining')
+GITHUB_RATE_LIMIT = Gauge(
+    'binderhub_github_rate_limit_remaining',
+    'GitHub rate limit remaining',
+    ['credential'],
+)
 SHA1_PATTERN = re.compile(r'[0-9a-f]{40}')
 
 
@@ -52,6 +59,102 @@ def strip_suffix(text, suffix):
     return text
 
 
+def hash_listing(entries):
+    """Return a stable ref for a listing of file metadata
+
+    `entries` is a list of JSON-serializable items (e.g. path, size and modified time of each file).
+    The ref only depends on the items, not their order,
+    so that unchanged contents always get the same ref (and image).
+    """
+    items = sorted(json.dumps(entry, sort_keys=True) for entry in entries)
+    return hashlib.sha256("\n".join(items).encode("utf8")).hexdigest()[:40]
+
+
+class GitHubCredentialPool:
+    """Pool of GitHub API credentials, tracking the rate limit of each
+
+    Each credential is a dict with optional `token`, `client_id` and `client_secret` keys,
+    and a `name` that is safe to use in logs and metrics.
+    Requests are routed to the credential with the most headroom,
+    based on the `x-ratelimit-*` headers of previous responses.
+    """
+
+    def __init__(self, credentials):
+        self.credentials = []
+        for credential in credentials:
+            credential = dict(credential, remaining=None, limit=None, reset=0)
+            self.credentials.append(credential)
+
+    @staticmethod
+    def _headroom(credential, now):
+        if credential['remaining'] is None:
+            # not used yet, assume a full budget
+            return float('inf')
+        if credential['reset'] <= now:
+            # budget has been reset since the last response
+            return credential['limit']
+        return credential['remaining']
+
+    def budget(self):
+        """Return the combined (remaining, limit) of credentials with a known limit"""
+        now = time.time()
+        remaining = limit = 0
+        for credential in self.credentials:
+            if credential['limit'] is None:
+                continue
+            remaining += self._headroom(credential, now)
+            limit += credential['limit']
+        return remaining, limit
+
+    def choose(self, low_priority=False, low_priority_reserve=0):
+        """Return the credential with the most headroom
+
+        Raises ValueError if all credentials are exhausted,
+        or if `low_priority` and less than `low_priority_reserve`
+        (fraction) of the combined budget remains.
+        """
+        now = time.time()
+        credential = max(self.credentials, key=lambda c: self._headroom(c, now))
+        if self._headroom(credential, now) <= 0:
+            raise self.exceeded()
+        if low_priority and low_priority_reserve:
+            remaining, limit = self.budget()
+            if limit and remaining < low_priority_reserve * limit:
+                raise ValueError(
+                    "GitHub rate limit low ({}/{}), skipping low-priority request".format(
+                        remaining, limit
+                    )
+                )
+        return credential
+
+    def exceeded(self):
+        """Return the error for when all credentials are rate limited
+
+        with the time until the earliest reset.
+        """
+        reset_seconds = min(c['reset'] for c in self.credentials) - time.time()
+        # round expiry up to nearest 5 minutes
+        minutes_until_reset = 5 * (1 + (max(int(reset_seconds), 0) // 60 // 5))
+        return ValueError("GitHub rate limit exceeded. Try again in %i minutes."
+            % minutes_until_reset
+        )
+
+    def update(self, credential, headers):
+        """Record the rate limit of `credential` from response headers
+
+        Returns (remaining, limit, reset_timestamp), or None if no rate limit info was found.
+        """
+        if 'x-ratelimit-remaining' not in headers:
+            return None
+        remaining = int(headers['x-ratelimit-remaining'])
+        rate_limit = int(headers['x-ratelimit-limit'])
+        reset_timestamp = int(headers['x-ratelimit-reset'])
+        credential.update(remaining=remaining, limit=rate_limit, reset=reset_timestamp)
+        # record with prometheus
+        GITHUB_RATE_LIMIT.labels(credential=credential['name']).set(remaining)
+        return remaining, rate_limit, reset_timestamp
+
+
 class RepoProvider(LoggingConfigurable):
     """Base class for a repo provider"""
     name = Unicode(
@@ -101,6 +204,31 @@ class RepoProvider(LoggingConfigurable):
 
     unresolved_ref = Unicode()
 
+    user_access_token = Unicode(
+        None,
+        allow_none=True,
+        help="""Access token of the user launching the repository
+
+        Set for providers requiring authorization,
+        to access the repository on behalf of the user.
+        """,
+    )
+
+    max_ref_staleness = Integer(
+        0,
+        config=True,
+        help="""Maximum time (in seconds) to use a cached resolved ref without revalidating it
+
+        For providers that cache resolved refs (GitHub, GitLab, Gist):
+        when a ref was resolved or revalidated less than this long ago,
+        its cached sha is returned without making a (conditional) API request.
+        For GitHub, combine with BinderHub.ref_refresh_interval to revalidate popular refs
+        in the background, so that they rarely go stale on the request path.
+
+        0 (default) always revalidates with a conditional request.
+        """
+    )
+
     git_credentials = Unicode(
         "",
         help="""
@@ -127,7 +255,7 @@ class RepoProvider(LoggingConfigurable):
         """
         return None
 
-    def fetch_authorized_token(self, authorization_response, hub_url):
+    async def fetch_authorized_token(self, authorization_response, hub_url):
         """
         Return a token using authorization_response
         """
@@ -190,6 +318,26 @@ class RepoProvider(LoggingConfigurable):
     async def get_resolved_ref(self):
         raise NotImplementedError("Must be overridden in child class")
 
+    # HTTPClient subclass for requests made by this provider
+    http_client_class = HTTPClient
+
+    def get_http_client(self):
+        """Return the shared HTTPClient for requests made by this provider"""
+        return self.http_client_class.instance(config=self.config)
+
+    def get_upstream(self):
+        """Return the Upstream tracking the service used to resolve refs"""
+        return Upstream.instance_for(self.name, config=self.config)
+
+    async def fetch(self, *args, **kwargs):
+        """Make a request to the upstream service with HTTPClient.fetch
+
+        Requests are hedged and fail fast while the service keeps failing,
+        see :class:`~binderhub.upstream.Upstream`.
+        """
+        client = self.get_http_client()
+        return await self.get_upstream().fetch(lambda: client.fetch(*args, **kwargs))
+
     async def get_resolved_spec(self):
         """Return the spec with resolved ref."""
         raise NotImplementedError("Must be overridden in child class")
@@ -211,6 +359,11 @@ class RepoProvider(LoggingConfigurable):
         if not SHA1_PATTERN.match(sha1):
             raise ValueError("resolved_ref is not a valid sha1 hexadecimal hash")
 
+    @staticmethod
+    def is_commit_sha(ref):
+        """Return true if `ref` is a full commit sha, which never changes"""
+        return bool(SHA1_PATTERN.fullmatch(ref))
+
 
 class FakeProvider(RepoProvider):
     """Fake provider for local testing of the UI
@@ -232,7 +385,112 @@ class FakeProvider(RepoProvider):
         return '{user}-{repo}'.format(user='Rick', repo='Morty')
 
 
-class ZenodoProvider(RepoProvider):
+class DoiProvider(RepoProvider):
+    """Base class for providers of archives identified by a DOI
+
+    Resolving a DOI usually takes one or more slow round-trips
+    (following doi.org redirects, then querying the archive's API),
+    so resolved records are cached and shared between requests,
+    and concurrent lookups of the same spec share a single resolution.
+
+    Subclasses implement :meth:`resolve_record`.
+    """
+
+    http_client_class = DOIHTTPClient
+
+    # shared cache of resolved records, by (provider name, spec)
+    record_cache = Cache(1024)
+
+    # shared cache of doi.org redirect targets, by DOI
+    redirect_cache = Cache(1024)
+
+    # in-progress resolutions, by (provider name, spec)
+    _record_futures = {}
+
+    record_cache_ttl = Integer(
+        3600,
+        config=True,
+        help="""Time (in seconds) to reuse a resolved record
+
+        Records of specific versions never change and are cached for as long as possible.
+        Other records (e.g. a DOI representing all versions, resolving to the latest one)
+        are resolved again after this time.
+
+        0 disables caching.
+        """,
+    )
+
+    redirect_cache_ttl = Integer(
+        86400,
+        config=True,
+        help="""Time (in seconds) to reuse the target of a doi.org redirect
+
+        0 disables caching.
+        """,
+    )
+
+    async def doi2url(self, doi, max_age=None):
+        """Return the URL `doi` redirects to, following all redirects
+
+        Cached for `max_age` seconds (default: redirect_cache_ttl).
+        """
+        if max_age is None:
+            max_age = self.redirect_cache_ttl
+        cached = self.redirect_cache.get(doi)
+        if cached and self.redirect_cache.age(doi) < max_age:
+            self.log.debug("Cache hit for DOI %s: %s", doi, cached)
+            return cached
+        req = HTTPRequest("https://doi.org/{}".format(doi),
+                          user_agent="BinderHub")
+        r = await self.fetch(req)
+        if max_age:
+            self.redirect_cache.set(doi, r.effective_url)
+        return r.effective_url
+
+    async def resolve_record(self):
+        """Resolve the spec, returning a dict of attributes to set on the provider
+
+        The dict must include `record_id`, and may include `immutable`
+        to indicate that the record never changes.
+        Values must be JSON-serializable, so that they can be included in cache snapshots.
+        """
+        raise NotImplementedError("Must be overridden in child class")
+
+    async def get_resolved_ref(self):
+        key = (self.name, self.spec)
+        record = self.record_cache.get(key)
+        if record is not None and (
+            record.get('immutable') or self.record_cache.age(key) < self.record_cache_ttl
+        ):
+            self.log.debug("Cache hit for %s %s: %s", self.name, self.spec, record['record_id'])
+        else:
+            future = self._record_futures.get(key)
+            if future is None:
+                future = asyncio.ensure_future(self.resolve_record())
+                self._record_futures[key] = future
+                future.add_done_callback(
+                    lambda f: self._record_futures.pop(key, None)
+                )
+            try:
+                resolved = await asyncio.shield(future)
+            except Exception as e:
+                if record is None or not is_upstream_error(e):
+                    raise
+                self.log.warning(
+                    "Using stale record for %s %s after error: %s", self.name, self.spec, e
+                )
+            else:
+                record = resolved
+                if self.record_cache_ttl:
+                    self.record_cache.set(key, record)
+
+        for name, value in record.items():
+            if name != 'immutable':
+                setattr(self, name, value)
+        return self.record_id
+
+
+class ZenodoProvider(DoiProvider):
     """Provide contents of a Zenodo record
 
     Users must provide a spec consisting of the Zenodo DOI.
@@ -248,13 +506,16 @@ class ZenodoProvider(RepoProvider):
         "label_prop_disabled": True,
     }
 
-    async def get_resolved_ref(self):
-        client = AsyncHTTPClient()
-        req = HTTPRequest("https://doi.org/{}".format(self.spec),
-                          user_agent="BinderHub")
-        r = await client.fetch(req)
-        self.record_id = r.effective_url.rsplit("/", maxsplit=1)[1]
-        return self.record_id
+    async def resolve_record(self):
+        # a DOI representing all versions redirects to the latest version,
+        # so don't reuse the redirect for longer than the record
+        url = await self.doi2url(self.spec, max_age=0)
+        record_id = url.rsplit("/", maxsplit=1)[1]
+        return {
+            'record_id': record_id,
+            # the DOI of a specific version resolves to itself
+            'immutable': self.spec.endswith("zenodo." + record_id),
+        }
 
     async def get_resolved_spec(self):
         if not hasattr(self, 'record_id'):
@@ -279,7 +540,7 @@ class ZenodoProvider(RepoProvider):
         return "zenodo-{}".format(self.record_id)
 
 
-class FigshareProvider(RepoProvider):
+class FigshareProvider(DoiProvider):
     """Provide contents of a Figshare article
 
     Users must provide a spec consisting of the Figshare DOI.
@@ -297,20 +558,19 @@ class FigshareProvider(RepoProvider):
         "label_prop_disabled": True,
     }
 
-    async def get_resolved_ref(self):
-        client = AsyncHTTPClient()
-        req = HTTPRequest("https://doi.org/{}".format(self.spec),
-                          user_agent="BinderHub")
-        r = await client.fetch(req)
+    async def resolve_record(self):
+        url = await self.doi2url(self.spec, max_age=0)
 
-        match = self.url_regex.match(r.effective_url)
+        match = self.url_regex.match(url)
         article_id = match.groups()[3]
         article_version = match.groups()[5]
         if not article_version:
             article_version = "1"
-        self.record_id = "{}.v{}".format(article_id, article_version)
-
-        return self.record_id
+        return {
+            'record_id': "{}.v{}".format(article_id, article_version),
+            # spec without version is always accepted as version 1
+            'immutable': True,
+        }
 
     async def get_resolved_spec(self):
         if not hasattr(self, 'record_id'):
@@ -335,7 +595,7 @@ class FigshareProvider(RepoProvider):
         return "figshare-{}".format(self.record_id)
 
 
-class DataverseProvider(RepoProvider):
+class DataverseProvider(DoiProvider):
     name = Unicode("Dataverse")
 
     display_name = "Dataverse DOI"
@@ -347,38 +607,41 @@ class DataverseProvider(RepoProvider):
         "label_prop_disabled": True,
     }
 
-    async def get_resolved_ref(self):
-        client = AsyncHTTPClient()
-        req = HTTPRequest("https://doi.org/{}".format(self.spec),
-                          user_agent="BinderHub")
-        r = await client.fetch(req)
+    @default('record_cache_ttl')
+    def _default_record_cache_ttl(self):
+        # datasets resolve to their latest version
+        return 600
+
+    async def resolve_record(self):
+        # the DOI of a dataset always redirects to the same dataset page
+        url = await self.doi2url(self.spec)
 
         search_url = urllib.parse.urlunparse(
-            urllib.parse.urlparse(r.effective_url)._replace(
+            urllib.parse.urlparse(url)._replace(
                 path="/api/datasets/:persistentId"
             )
         )
         req = HTTPRequest(search_url, user_agent="BinderHub")
-        r = await client.fetch(req)
+        r = await self.fetch(req)
         resp = json.loads(r.body)
 
         assert resp["status"] == "OK"
 
-        self.identifier = resp["data"]["identifier"]
-        self.record_id = "{datasetId}.v{major}.{minor}".format(
-            datasetId=resp["data"]["id"],
-            major=resp["data"]["latestVersion"]["versionNumber"],
-            minor=resp["data"]["latestVersion"]["versionMinorNumber"],
-        )
-
-        # NOTE: data.protocol should be potentially prepended here
-        #  {protocol}:{authority}/{identifier}
-        self.resolved_spec = "{authority}/{identifier}".format(
-            authority=resp["data"]["authority"],
-            identifier=resp["data"]["identifier"],
-        )
-        self.resolved_ref_url = resp["data"]["persistentUrl"]
-        return self.record_id
+        return {
+            'identifier': resp["data"]["identifier"],
+            'record_id': "{datasetId}.v{major}.{minor}".format(
+                datasetId=resp["data"]["id"],
+                major=resp["data"]["latestVersion"]["versionNumber"],
+                minor=resp["data"]["latestVersion"]["versionMinorNumber"],
+            ),
+            # NOTE: data.protocol should be potentially prepended here
+            #  {protocol}:{authority}/{identifier}
+            'resolved_spec': "{authority}/{identifier}".format(
+                authority=resp["data"]["authority"],
+                identifier=resp["data"]["identifier"],
+            ),
+            'resolved_ref_url': resp["data"]["persistentUrl"],
+        }
 
     async def get_resolved_spec(self):
         if not hasattr(self, 'resolved_spec'):
@@ -399,7 +662,7 @@ class DataverseProvider(RepoProvider):
         return "dataverse-" + escapism.escape(self.identifier, escape_char="-").lower()
 
 
-class HydroshareProvider(RepoProvider):
+class HydroshareProvider(DoiProvider):
     """Provide contents of a Hydroshare resource
     Users must provide a spec consisting of the Hydroshare resource id.
     """
@@ -416,6 +679,11 @@ class HydroshareProvider(RepoProvider):
         "label_prop_disabled": True,
     }
 
+    @default('record_cache_ttl')
+    def _default_record_cache_ttl(self):
+        # resources resolve to their latest modification
+        return 60
+
     def _parse_resource_id(self, spec):
         match = self.url_regex.match(spec)
         if not match:
@@ -423,12 +691,11 @@ class HydroshareProvider(RepoProvider):
         resource_id = match.groups()[0]
         return resource_id
 
-    async def get_resolved_ref(self):
-        client = AsyncHTTPClient()
-        self.resource_id = self._parse_resource_id(self.spec)
-        req = HTTPRequest("https://www.hydroshare.org/hsapi/resource/{}/scimeta/elements".format(self.resource_id),
+    async def resolve_record(self):
+        resource_id = self._parse_resource_id(self.spec)
+        req = HTTPRequest("https://www.hydroshare.org/hsapi/resource/{}/scimeta/elements".format(resource_id),
                           user_agent="BinderHub")
-        r = await client.fetch(req)
+        r = await self.fetch(req)
 
         def parse_date(json_body):
             json_response = json.loads(json_body)
@@ -442,8 +709,10 @@ class HydroshareProvider(RepoProvider):
             # truncate the timestamp
             return str(int(epoch))
         # date last updated is only good for the day... probably need something finer eventually
-        self.record_id = "{}.v{}".format(self.resource_id, parse_date(r.body))
-        return self.record_id
+        return {
+            'resource_id': resource_id,
+            'record_id': "{}.v{}".format(resource_id, parse_date(r.body)),
+        }
 
     async def get_resolved_spec(self):
         # Hydroshare does not provide a history, resolves to repo url
@@ -488,6 +757,38 @@ class GitRepoProvider(RepoProvider):
         "label_prop_disabled": False,
     }
 
+    # shared cache of `git ls-remote` results (all refs), by repo url
+    ls_remote_cache = Cache(256)
+
+    # in-progress `git ls-remote` calls, by repo url
+    _ls_remote_futures = {}
+    _ls_remote_semaphore = None
+
+    ls_remote_timeout = Integer(
+        30,
+        config=True,
+        help="""Timeout (in seconds) for `git ls-remote` when resolving refs""",
+    )
+
+    ls_remote_concurrency = Integer(
+        8,
+        config=True,
+        help="""Maximum number of concurrent `git ls-remote` processes""",
+    )
+
+    ls_remote_cache_ttl = Integer(
+        60,
+        config=True,
+        help="""Time (in seconds) to reuse the refs listed by `git ls-remote` for a repo
+
+        All refs of a repo are listed at once,
+        so lookups of other branches or tags of the same repo
+        within this time do not run `git ls-remote` again.
+
+        0 disables caching.
+        """,
+    )
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.url, unresolved_ref = self.spec.split('/', 1)
@@ -496,6 +797,93 @@ class GitRepoProvider(RepoProvider):
         if not self.unresolved_ref:
             raise ValueError("`unresolved_ref` must be specified as a query parameter for the basic git provider")
 
+    async def _run_ls_remote(self):
+        """Run `git ls-remote` for all refs of the repo
+
+        Returns a dict of {ref name: sha}, in the order listed by git.
+        """
+        cls = GitRepoProvider
+        if cls._ls_remote_semaphore is None:
+            cls._ls_remote_semaphore = asyncio.Semaphore(self.ls_remote_concurrency)
+
+        async with cls._ls_remote_semaphore:
+            self.log.debug("Running git ls-remote %s", self.repo)
+            proc = await asyncio.create_subprocess_exec(
+                "git", "ls-remote", self.repo,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(
+                    proc.communicate(), timeout=self.ls_remote_timeout
+                )
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                raise RuntimeError(
+                    "Timeout running git ls-remote to get the `resolved_ref` "
+                    "after {}s".format(self.ls_remote_timeout)
+                )
+
+        if proc.returncode:
+            raise RuntimeError(
+                "Unable to run git ls-remote to get the `resolved_ref`: {}".format(
+                    stderr.decode('utf8', 'replace')
+                )
+            )
+        refs = {}
+        for line in stdout.decode('utf8', 'replace').splitlines():
+            if not line.strip():
+                continue
+            sha, name = line.split(None, 1)
+            refs.setdefault(name, sha)
+        return refs
+
+    def _cached_ls_remote(self):
+        """Return the cached refs of the repo, if not older than ls_remote_cache_ttl"""
+        cached = self.ls_remote_cache.get(self.repo)
+        if cached is not None and self.ls_remote_cache.age(self.repo) < self.ls_remote_cache_ttl:
+            self.log.debug("Using cached git ls-remote for %s", self.repo)
+            return cached
+        return None
+
+    async def ls_remote(self, refresh=False):
+        """Return all refs of the repo as a dict of {ref name: sha}
+
+        Results are cached for ls_remote_cache_ttl seconds,
+        unless `refresh`, and concurrent calls for the same repo
+        share one `git ls-remote`.
+        """
+        if not refresh:
+            cached = self._cached_ls_remote()
+            if cached is not None:
+                return cached
+
+        future = self._ls_remote_futures.get(self.repo)
+        if future is None:
+            future = asyncio.ensure_future(self._run_ls_remote())
+            self._ls_remote_futures[self.repo] = future
+            future.add_done_callback(
+                lambda f, repo=self.repo: self._ls_remote_futures.pop(repo, None)
+            )
+        # shielded: the other callers still wait for it if this one is cancelled
+        refs = await asyncio.shield(future)
+        if self.ls_remote_cache_ttl:
+            self.ls_remote_cache.set(self.repo, refs)
+        return refs
+
+    @staticmethod
+    def match_ref(refs, ref):
+        """Return the sha of the first ref in `refs` matching `ref`, or None
+
+        Matches like `git ls-remote <repo> <ref>`,
+        i.e. `ref` matches full ref names that are equal to it or end with `/<ref>`.
+        """
+        for name, sha in refs.items():
+            if name == ref or name.endswith('/' + ref):
+                return sha
+        return None
+
     async def get_resolved_ref(self):
         if hasattr(self, 'resolved_ref'):
             return self.resolved_ref
@@ -505,13 +893,16 @@ class GitRepoProvider(RepoProvider):
             self.sha1_validate(self.unresolved_ref)
         except ValueError:
             # The ref is a head/tag and we resolve it using `git ls-remote`
-            command = ["git", "ls-remote", self.repo, self.unresolved_ref]
-            result = subprocess.run(command, universal_newlines=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            if result.returncode:
-                raise RuntimeError("Unable to run git ls-remote to get the `resolved_ref`: {}".format(result.stderr))
-            if not result.stdout:
+            resolved_ref = None
+            refs = self._cached_ls_remote()
+            if refs is not None:
+                resolved_ref = self.match_ref(refs, self.unresolved_ref)
+            if resolved_ref is None:
+                # not cached, or created since the refs were cached
+                refs = await self.ls_remote(refresh=True)
+                resolved_ref = self.match_ref(refs, self.unresolved_ref)
+            if resolved_ref is None:
                 return None
-            resolved_ref = result.stdout.split(None, 1)[0]
             self.sha1_validate(resolved_ref)
             self.resolved_ref = resolved_ref
         else:
@@ -550,6 +941,8 @@ class GitLabRepoProvider(RepoProvider):
 
     name = Unicode('GitLab')
 
+    http_client_class = GitLabHTTPClient
+
     display_name = "GitLab.com"
 
     hostname = Unicode('gitlab.com', config=True,
@@ -601,6 +994,12 @@ class GitLabRepoProvider(RepoProvider):
             return r'username=binderhub\npassword={token}'.format(token=self.private_token)
         return ""
 
+    # shared cache for resolved refs
+    cache = Cache(1024)
+
+    # separate cache with max age for 404 results
+    cache_404 = Cache(1024, max_age=300)
+
     labels = {
         "text": "GitLab.com repository or URL",
         "tag_text": "Git ref (branch, tag, or commit)",
@@ -620,29 +1019,83 @@ class GitLabRepoProvider(RepoProvider):
         if hasattr(self, 'resolved_ref'):
             return self.resolved_ref
 
+        if self.is_commit_sha(self.unresolved_ref):
+            # commits are immutable, no need to ask GitLab
+            self.resolved_ref = self.unresolved_ref
+            return self.resolved_ref
+
         namespace = urllib.parse.quote(self.namespace, safe='')
-        client = AsyncHTTPClient()
         api_url = "https://{hostname}/api/v4/projects/{namespace}/repository/commits/{ref}".format(
             hostname=self.hostname,
             namespace=namespace,
             ref=urllib.parse.quote(self.unresolved_ref, safe=''),
         )
         self.log.debug("Fetching %s", api_url)
+        cached = self.cache.get(api_url)
+        if cached:
+            age = self.cache.age(api_url)
+            if self.max_ref_staleness and age < self.max_ref_staleness:
+                self.log.debug(
+                    "Using cached ref for %s without revalidation (%is old): %s",
+                    api_url, age, cached['sha'],
+                )
+                self.resolved_ref = cached['sha']
+                return self.resolved_ref
+            etag = cached['etag']
+            self.log.debug("Cache hit for %s: %s", api_url, etag)
+        else:
+            if self.cache_404.get(api_url):
+                self.log.debug("Cache hit for 404 on %s", api_url)
+                return None
+            etag = None
 
+        # cache by the url without auth params
+        request_url = api_url
         if self.auth:
             # Add auth params. After logging!
-            api_url = url_concat(api_url, self.auth)
+            request_url = url_concat(api_url, self.auth)
 
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
         try:
-            resp = await client.fetch(api_url, user_agent="BinderHub")
+            resp = await self.fetch(request_url, headers=headers, user_agent="BinderHub")
         except HTTPError as e:
-            if e.code == 404:
+            if e.code == 304:
+                resp = e.response
+            elif e.code == 404:
+                self.log.debug("Caching 404 on %s", api_url)
+                self.cache_404.set(api_url, True)
                 return None
+            elif cached and is_upstream_error(e):
+                self.log.warning("Using stale ref for %s after error: %s", api_url, e)
+                self.resolved_ref = cached['sha']
+                return self.resolved_ref
             else:
                 raise
+        except Exception as e:
+            if cached and is_upstream_error(e):
+                self.log.warning("Using stale ref for %s after error: %s", api_url, e)
+                self.resolved_ref = cached['sha']
+                return self.resolved_ref
+            raise
+
+        if resp.code == 304:
+            self.log.info("Using cached ref for %s: %s", api_url, cached['sha'])
+            self.resolved_ref = cached['sha']
+            # refresh cache entry, which also records when it was last validated
+            self.cache.set(api_url, cached)
+            return self.resolved_ref
 
         ref_info = json.loads(resp.body.decode('utf-8'))
         self.resolved_ref = ref_info['id']
+        self.cache.set(
+            api_url,
+            {
+                'etag': resp.headers.get('ETag'),
+                'sha': self.resolved_ref,
+            },
+        )
         return self.resolved_ref
 
     async def get_resolved_spec(self):
@@ -669,6 +1122,8 @@ class GitHubRepoProvider(RepoProvider):
 
     display_name = 'GitHub'
 
+    http_client_class = GitHubHTTPClient
+
     # shared cache for resolved refs
     cache = Cache(1024)
 
@@ -678,6 +1133,14 @@ class GitHubRepoProvider(RepoProvider):
     # may be created later
     cache_404 = Cache(1024, max_age=300)
 
+    # recent lookups of resolved refs, used to pick the hottest refs
+    # to revalidate in the background.
+    # Maps api url to {'spec': spec, 'hits': number of recent lookups}
+    ref_hits = Cache(1024)
+
+    # shared credential pools, by configured credentials
+    _credential_pools = {}
+
     hostname = Unicode('github.com',
         config=True,
         help="""The GitHub hostname to use
@@ -729,6 +1192,71 @@ class GitHubRepoProvider(RepoProvider):
     def _access_token_default(self):
         return os.getenv('GITHUB_ACCESS_TOKEN', '')
 
+    access_tokens = List(
+        Unicode(),
+        config=True,
+        help="""Additional GitHub access tokens for authentication with the GitHub API
+
+        Requests are spread over these tokens and access_token (if set),
+        routing each request to the token with the most rate limit remaining,
+        so that the combined rate limit of all tokens is available.
+
+        Loaded from GITHUB_ACCESS_TOKENS env (comma-separated) by default.
+        """
+    )
+    @default('access_tokens')
+    def _access_tokens_default(self):
+        return [t for t in os.getenv('GITHUB_ACCESS_TOKENS', '').split(',') if t]
+
+    low_priority_rate_limit_reserve = Float(
+        0.2,
+        config=True,
+        help="""Fraction of the combined GitHub rate limit reserved for user requests
+
+        Low-priority requests (e.g. background revalidation of refs)
+        are skipped when less than this fraction of the combined rate limit
+        of all credentials remains.
+        """
+    )
+
+    @property
+    def credential_pool(self):
+        """The shared GitHubCredentialPool for the configured credentials"""
+        key = (self.access_token, self.client_id, self.client_secret, tuple(self.access_tokens))
+        pool = self._credential_pools.get(key)
+        if pool is None:
+            pool = self._credential_pools[key] = GitHubCredentialPool(self._credentials())
+        return pool
+
+    def _credentials(self):
+        """Return the configured credentials, with their names"""
+        credentials = []
+        if self.access_token or (self.client_id and self.client_secret):
+            credential = {}
+            if self.access_token:
+                credential['token'] = self.access_token
+            if self.client_id and self.client_secret:
+                credential['client_id'] = self.client_id
+                credential['client_secret'] = self.client_secret
+            credentials.append(credential)
+        for token in self.access_tokens:
+            if token != self.access_token:
+                credentials.append({'token': token})
+        if not credentials:
+            # unauthenticated requests
+            credentials.append({})
+
+        for credential in credentials:
+            if 'token' in credential:
+                digest = hashlib.sha256(credential['token'].encode('utf8')).hexdigest()
+                credential['name'] = 'token-' + digest[:8]
+            elif 'client_id' in credential:
+                credential['name'] = credential['client_id']
+            else:
+                credential['name'] = 'anonymous'
+
+        return credentials
+
     @default('git_credentials')
     def _default_git_credentials(self):
         if self.access_token:
@@ -762,67 +1290,77 @@ class GitHubRepoProvider(RepoProvider):
             self.resolved_ref = await self.get_resolved_ref()
         return f"https://{self.hostname}/{self.user}/{self.repo}/tree/{self.resolved_ref}"
 
-    async def github_api_request(self, api_url, etag=None):
-        client = AsyncHTTPClient()
+    async def github_api_request(self, api_url, etag=None, low_priority=False):
+        pool = self.credential_pool
 
-        request_kwargs = {}
-        if self.client_id and self.client_secret:
-            request_kwargs.update(
-                dict(auth_username=self.client_id, auth_password=self.client_secret)
+        # try each credential at most once
+        for _ in range(len(pool.credentials)):
+            # raises if all credentials are exhausted
+            credential = pool.choose(
+                low_priority=low_priority,
+                low_priority_reserve=self.low_priority_rate_limit_reserve,
             )
 
-        headers = {}
-        # based on: https://developer.github.com/v3/#oauth2-token-sent-in-a-header
-        if self.access_token:
-            headers['Authorization'] = "token {token}".format(token=self.access_token)
-
-        if etag:
-            headers['If-None-Match'] = etag
-        req = HTTPRequest(
-            api_url, headers=headers, user_agent="BinderHub", **request_kwargs
-        )
-
-        try:
-            resp = await client.fetch(req)
-        except HTTPError as e:
-            if e.code == 304:
-                resp = e.response
-            elif (
-                e.code == 403
-                and e.response
-                and 'x-ratelimit-remaining' in e.response.headers
-                and e.response.headers.get('x-ratelimit-remaining') == '0'
-            ):
-                rate_limit = e.response.headers['x-ratelimit-limit']
-                reset_timestamp = int(e.response.headers['x-ratelimit-reset'])
-                reset_seconds = int(reset_timestamp - time.time())
-                self.log.error(
-                    "GitHub Rate limit ({limit}) exceeded. Reset in {delta}.".format(
-                        limit=rate_limit,
-                        delta=timedelta(seconds=reset_seconds),
+            request_kwargs = {}
+            if credential.get('client_id') and credential.get('client_secret'):
+                request_kwargs.update(
+                    dict(
+                        auth_username=credential['client_id'],
+                        auth_password=credential['client_secret'],
                     )
                 )
-                # round expiry up to nearest 5 minutes
-                minutes_until_reset = 5 * (1 + (reset_seconds // 60 // 5))
 
-                raise ValueError("GitHub rate limit exceeded. Try again in %i minutes."
-                    % minutes_until_reset
-                )
-            # Status 422 is returned by the API when we try and resolve a non
-            # existent reference
-            elif e.code in (404, 422):
-                return None
-            else:
-                raise
+            headers = {}
+            # based on: https://developer.github.com/v3/#oauth2-token-sent-in-a-header
+            if credential.get('token'):
+                headers['Authorization'] = "token {token}".format(token=credential['token'])
 
-        if 'x-ratelimit-remaining' in resp.headers:
-            # record and log github rate limit
-            remaining = int(resp.headers['x-ratelimit-remaining'])
-            rate_limit = int(resp.headers['x-ratelimit-limit'])
-            reset_timestamp = int(resp.headers['x-ratelimit-reset'])
+            if etag:
+                headers['If-None-Match'] = etag
+            req = HTTPRequest(
+                api_url, headers=headers, user_agent="BinderHub", **request_kwargs
+            )
 
-            # record with prometheus
-            GITHUB_RATE_LIMIT.set(remaining)
+            try:
+                resp = await self.fetch(req)
+            except HTTPError as e:
+                if e.code == 304:
+                    resp = e.response
+                elif (
+                    e.code == 403
+                    and e.response
+                    and 'x-ratelimit-remaining' in e.response.headers
+                    and e.response.headers.get('x-ratelimit-remaining') == '0'
+                ):
+                    _, rate_limit, reset_timestamp = pool.update(
+                        credential, e.response.headers
+                    )
+                    reset_seconds = int(reset_timestamp - time.time())
+                    self.log.error(
+                        "GitHub Rate limit ({limit}) exceeded for {name}. Reset in {delta}.".format(
+                            limit=rate_limit,
+                            name=credential['name'],
+                            delta=timedelta(seconds=reset_seconds),
+                        )
+                    )
+                    # retry with the credential with the most headroom left
+                    continue
+                # Status 422 is returned by the API when we try and resolve a non
+                # existent reference
+                elif e.code in (404, 422):
+                    if e.response:
+                        pool.update(credential, e.response.headers)
+                    return None
+                else:
+                    raise
+            break
+        else:
+            raise pool.exceeded()
+
+        rate_limit_info = pool.update(credential, resp.headers)
+        if rate_limit_info:
+            # log github rate limit
+            remaining, rate_limit, reset_timestamp = rate_limit_info
 
             # log at different levels, depending on remaining fraction
             fraction = remaining / rate_limit
@@ -835,20 +1373,56 @@ class GitHubRepoProvider(RepoProvider):
 
             # str(timedelta) looks like '00:32'
             delta = timedelta(seconds=int(reset_timestamp - time.time()))
-            log("GitHub rate limit remaining {remaining}/{limit}. Reset in {delta}.".format(
-                remaining=remaining, limit=rate_limit, delta=delta,
+            log("GitHub rate limit remaining {remaining}/{limit} for {name}. Reset in {delta}.".format(
+                remaining=remaining, limit=rate_limit, name=credential['name'], delta=delta,
             ))
 
         return resp
 
+    def get_commit_api_url(self):
+        """Return the API URL used to resolve the unresolved ref"""
+        return "{api_base_path}/repos/{user}/{repo}/commits/{ref}".format(
+            api_base_path=self.api_base_path.format(hostname=self.hostname),
+            user=self.user, repo=self.repo, ref=self.unresolved_ref
+        )
+
     async def get_resolved_ref(self):
         if hasattr(self, 'resolved_ref'):
             return self.resolved_ref
 
-        api_url = "{api_base_path}/repos/{user}/{repo}/commits/{ref}".format(
-            api_base_path=self.api_base_path.format(hostname=self.hostname),
-            user=self.user, repo=self.repo, ref=self.unresolved_ref
-        )
+        api_url = self.get_commit_api_url()
+        hits = self.ref_hits.get(api_url)
+        if hits:
+            hits['hits'] += 1
+        else:
+            self.ref_hits.set(api_url, {'spec': self.spec, 'hits': 1})
+
+        cached = self.cache.get(api_url)
+        if cached and self.max_ref_staleness:
+            age = self.cache.age(api_url)
+            if age < self.max_ref_staleness:
+                self.log.debug(
+                    "Using cached ref for %s without revalidation (%is old): %s",
+                    api_url, age, cached['sha'],
+                )
+                self.resolved_ref = cached['sha']
+                return self.resolved_ref
+
+        try:
+            return await self.fetch_resolved_ref()
+        except Exception as e:
+            if not (cached and is_upstream_error(e)):
+                raise
+            self.log.warning("Using stale ref for %s after error: %s", api_url, e)
+            self.resolved_ref = cached['sha']
+            return self.resolved_ref
+
+    async def fetch_resolved_ref(self, low_priority=False):
+        """Resolve the ref with a (conditional) GitHub API request
+
+        Updates the shared cache of resolved refs.
+        """
+        api_url = self.get_commit_api_url()
         self.log.debug("Fetching %s", api_url)
         cached = self.cache.get(api_url)
         if cached:
@@ -861,7 +1435,7 @@ class GitHubRepoProvider(RepoProvider):
                 return None
             etag = None
 
-        resp = await self.github_api_request(api_url, etag=etag)
+        resp = await self.github_api_request(api_url, etag=etag, low_priority=low_priority)
         if resp is None:
             self.log.debug("Caching 404 on %s", api_url)
             self.cache_404.set(api_url, True)
@@ -869,8 +1443,8 @@ class GitHubRepoProvider(RepoProvider):
         if resp.code == 304:
             self.log.info("Using cached ref for %s: %s", api_url, cached['sha'])
             self.resolved_ref = cached['sha']
-            # refresh cache entry
-            self.cache.move_to_end(api_url)
+            # refresh cache entry, which also records when it was last validated
+            self.cache.set(api_url, cached)
             return self.resolved_ref
         elif cached:
             self.log.debug("Cache outdated for %s", api_url)
@@ -897,6 +1471,39 @@ class GitHubRepoProvider(RepoProvider):
             self.resolved_ref = await self.get_resolved_ref()
         return f"{self.user}/{self.repo}/{self.resolved_ref}"
 
+    @classmethod
+    async def refresh_hot_refs(cls, config, count, min_age=0):
+        """Revalidate the `count` most requested cached refs in the background
+
+        Only refs that were last validated at least `min_age` seconds ago
+        are revalidated. Hit counts are halved after each call,
+        so that the hottest refs are the most requested recently.
+        """
+        hot = sorted(
+            cls.ref_hits.items(), key=lambda item: item[1]['hits'], reverse=True
+        )[:count]
+        providers = []
+        for api_url, hits in hot:
+            if api_url not in cls.cache or cls.cache.age(api_url) < min_age:
+                continue
+            providers.append(cls(config=config, spec=hits['spec']))
+
+        results = await asyncio.gather(
+            *(provider.fetch_resolved_ref(low_priority=True) for provider in providers),
+            return_exceptions=True,
+        )
+        for provider, result in zip(providers, results):
+            if isinstance(result, Exception):
+                provider.log.warning(
+                    "Failed to refresh ref for %s: %s", provider.spec, result
+                )
+
+        for api_url, hits in list(cls.ref_hits.items()):
+            hits['hits'] //= 2
+            if not hits['hits']:
+                cls.ref_hits.pop(api_url)
+        return len(providers)
+
     def get_build_slug(self):
         return '{user}-{repo}'.format(user=self.user, repo=self.repo)
 
@@ -921,6 +1528,12 @@ class GistRepoProvider(GitHubRepoProvider):
 
     hostname = Unicode("gist.github.com")
 
+    # shared cache for gist metadata, separate from GitHubRepoProvider's
+    cache = Cache(1024)
+
+    # separate cache with max age for 404 results
+    cache_404 = Cache(1024, max_age=300)
+
     allow_secret_gist = Bool(
         default_value=False,
         config=True,
@@ -958,19 +1571,16 @@ class GistRepoProvider(GitHubRepoProvider):
 
         api_url = f"https://api.github.com/gists/{self.gist_id}"
         self.log.debug("Fetching %s", api_url)
-
-        resp = await self.github_api_request(api_url)
-        if resp is None:
+        ref_info = await self.get_gist_info(api_url)
+        if ref_info is None:
             return None
 
-        ref_info = json.loads(resp.body.decode('utf-8'))
-
         if (not self.allow_secret_gist) and (not ref_info['public']):
             raise ValueError("You seem to want to use a secret Gist, but do not have permission to do so. "
                              "To enable secret Gist support, set (or have an administrator set) "
                              "'GistRepoProvider.allow_secret_gist = True'")
 
-        all_versions = [e['version'] for e in ref_info['history']]
+        all_versions = ref_info['versions']
         if self.unresolved_ref in {"", "HEAD", "master"}:
             self.resolved_ref = all_versions[0]
         else:
@@ -981,6 +1591,59 @@ class GistRepoProvider(GitHubRepoProvider):
 
         return self.resolved_ref
 
+    def get_upstream(self):
+        # gists are resolved with the GitHub API
+        return Upstream.instance_for('GitHub', config=self.config)
+
+    async def get_gist_info(self, api_url):
+        """Return {'public': bool, 'versions': [sha]} for the gist, or None if not found
+
+        Uses the shared cache, revalidated with the cached ETag.
+        """
+        cached = self.cache.get(api_url)
+        if cached:
+            age = self.cache.age(api_url)
+            if self.is_commit_sha(self.unresolved_ref) and self.unresolved_ref in cached['versions']:
+                # versions are immutable, no need to revalidate
+                self.log.debug("Cache hit for version %s of %s", self.unresolved_ref, api_url)
+                return cached
+            if self.max_ref_staleness and age < self.max_ref_staleness:
+                self.log.debug("Using cached gist info for %s without revalidation (%is old)", api_url, age)
+                return cached
+            etag = cached['etag']
+            self.log.debug("Cache hit for %s: %s", api_url, etag)
+        else:
+            if self.cache_404.get(api_url):
+                self.log.debug("Cache hit for 404 on %s", api_url)
+                return None
+            etag = None
+
+        try:
+            resp = await self.github_api_request(api_url, etag=etag)
+        except Exception as e:
+            if not (cached and is_upstream_error(e)):
+                raise
+            self.log.warning("Using stale gist info for %s after error: %s", api_url, e)
+            return cached
+        if resp is None:
+            self.log.debug("Caching 404 on %s", api_url)
+            self.cache_404.set(api_url, True)
+            return None
+        if resp.code == 304:
+            self.log.debug("Using cached gist info for %s", api_url)
+            # refresh cache entry, which also records when it was last validated
+            self.cache.set(api_url, cached)
+            return cached
+
+        gist = json.loads(resp.body.decode('utf-8'))
+        info = {
+            'etag': resp.headers.get('ETag'),
+            'public': gist['public'],
+            'versions': [e['version'] for e in gist['history']],
+        }
+        self.cache.set(api_url, info)
+        return info
+
     async def get_resolved_spec(self):
         if not hasattr(self, 'resolved_ref'):
             self.resolved_ref = await self.get_resolved_ref()
@@ -1022,7 +1685,8 @@ class RDMProvider(RepoProvider):
             ref = None
         else:
             url, ref = self.spec.split('/', 1)
-        self.ref = str(uuid1()) if ref == 'master' or ref == '' or ref is None else ref
+        # resolved from the contents in get_resolved_ref
+        self.ref = None if ref == 'master' or ref == '' or ref is None else ref
         self.repo = urllib.parse.unquote(url)
         self.hostname = urllib.parse.urlparse(self.repo).netloc.split(':')[0]
 
@@ -1041,13 +1705,77 @@ class RDMProvider(RepoProvider):
         client = OAuth2Client(self._find_host(self.hostname))
         return client.get_authorization_url(state, hub_url)
 
-    def fetch_authorized_token(self, authorization_response, hub_url):
+    async def fetch_authorized_token(self, authorization_response, hub_url):
         client = OAuth2Client(self._find_host(self.hostname))
-        return client.fetch_token(authorization_response, hub_url)
+        return await client.fetch_token(authorization_response, hub_url, config=self.config)
 
     async def get_resolved_ref(self):
+        if self.ref is None:
+            # the same contents resolve to the same ref, so their image can be reused;
+            # fall back to a unique ref (always rebuilding) if they can't be listed
+            self.ref = await self.get_content_ref() or str(uuid1())
         return self.ref
 
+    async def get_content_ref(self):
+        """Return a ref derived from the files of the project, or None
+
+        Files are listed through the `api` (OSF API v2) of the host,
+        with the user's token if available.
+        Only the files below the folder in the URL (if any) are considered.
+        """
+        try:
+            host = self._find_host(self.hostname)
+        except ValueError:
+            return None
+        if not host.get('api'):
+            return None
+
+        path = urllib.parse.urlparse(self.repo).path.strip('/').split('/')
+        url = url_path_join(host['api'], 'nodes', path[0], 'files', '/')
+        prefix = '/'
+        if len(path) >= 3 and path[1] == 'files':
+            url = url_path_join(url, path[2], '/')
+            prefix = url_path_join('/', *path[3:], '/')
+
+        try:
+            entries = await self._list_files(url, prefix)
+        except (HTTPError, OSError, KeyError, ValueError) as e:
+            self.log.warning("Failed to list files of %s: %s", self.repo, e)
+            return None
+        return hash_listing(entries)
+
+    async def _list_files(self, url, prefix):
+        """List the metadata of all files below `prefix`, starting from the folder at `url`"""
+        client = self.get_http_client()
+        headers = {}
+        if self.user_access_token:
+            headers['Authorization'] = 'Bearer {}'.format(self.user_access_token)
+        entries = []
+        folders = [url]
+        while folders:
+            next_url = folders.pop()
+            while next_url:
+                req = HTTPRequest(next_url, headers=headers, user_agent="BinderHub")
+                resp = await client.fetch(req)
+                body = json.loads(resp.body)
+                for item in body['data']:
+                    attrs = item['attributes']
+                    path = attrs.get('materialized_path') or attrs.get('path', '/')
+                    if attrs['kind'] == 'folder':
+                        # only descend into folders leading to, or inside, prefix
+                        if prefix.startswith(path) or path.startswith(prefix):
+                            folders.append(item['relationships']['files']['links']['related']['href'])
+                    elif path.startswith(prefix):
+                        entries.append([
+                            attrs.get('provider'),
+                            path,
+                            attrs.get('size'),
+                            attrs.get('date_modified'),
+                            attrs.get('extra', {}).get('hashes'),
+                        ])
+                next_url = body.get('links', {}).get('next')
+        return entries
+
     async def get_resolved_spec(self):
         return self.spec
 
@@ -1102,7 +1830,8 @@ class WEKO3Provider(RepoProvider):
             ref = None
         else:
             url, ref = self.spec.split('/', 1)
-        self.ref = str(uuid1()) if ref == 'master' or ref == '' or ref is None else ref
+        # resolved from the contents in get_resolved_ref
+        self.ref = None if ref == 'master' or ref == '' or ref is None else ref
         self.repo = urllib.parse.unquote(url)
         self.hostname = urllib.parse.urlparse(self.repo).netloc.split(':')[0]
 
@@ -1121,13 +1850,49 @@ class WEKO3Provider(RepoProvider):
         client = OAuth2Client(self._find_host(self.hostname))
         return client.get_authorization_url(state, hub_url)
 
-    def fetch_authorized_token(self, authorization_response, hub_url):
+    async def fetch_authorized_token(self, authorization_response, hub_url):
         client = OAuth2Client(self._find_host(self.hostname))
-        return client.fetch_token(authorization_response, hub_url)
+        return await client.fetch_token(authorization_response, hub_url, config=self.config)
 
     async def get_resolved_ref(self):
+        if self.ref is None:
+            # the same contents resolve to the same ref, so their image can be reused;
+            # fall back to a unique ref (always rebuilding) if they can't be looked up
+            self.ref = await self.get_content_ref() or str(uuid1())
         return self.ref
 
+    async def get_content_ref(self):
+        """Return a ref derived from the revision of the record, or None
+
+        The record is looked up through the records API of the host,
+        with the user's token if available.
+        Its revision changes whenever its files (or metadata) change.
+        """
+        try:
+            self._find_host(self.hostname)
+        except ValueError:
+            return None
+        parsed = urllib.parse.urlparse(self.repo)
+        match = re.search(r'/records/(\d+)', parsed.path)
+        if not match:
+            return None
+        record_id = match.group(1)
+
+        client = self.get_http_client()
+        headers = {'Accept': 'application/json'}
+        if self.user_access_token:
+            headers['Authorization'] = 'Bearer {}'.format(self.user_access_token)
+        url = '{}://{}/api/records/{}'.format(parsed.scheme, parsed.netloc, record_id)
+        try:
+            resp = await client.fetch(HTTPRequest(url, headers=headers, user_agent="BinderHub"))
+            body = json.loads(resp.body)
+        except (HTTPError, OSError, ValueError) as e:
+            self.log.warning("Failed to look up record %s: %s", self.repo, e)
+            return None
+        if body.get('revision') is None and body.get('updated') is None:
+            return None
+        return hash_listing([[self.repo, body.get('revision'), body.get('updated')]])
+
     async def get_resolved_spec(self):
         return self.spec
 
@@ -0,0 +1,124 @@
+"""
+Persist in-process caches across restarts
+"""
+import gzip
+import json
+import os
+import time
+
+from traitlets.config import LoggingConfigurable
+from traitlets import Integer, Unicode
+
+SNAPSHOT_VERSION = 1
+
+
+class CacheSnapshot(LoggingConfigurable):
+    """Save and load snapshots of named :class:`~binderhub.utils.Cache` objects
+
+    Snapshots are gzipped JSON documents mapping cache names
+    to the output of :meth:`~binderhub.utils.Cache.snapshot`.
+    Caches that are not in the snapshot are left untouched on load,
+    and entries for caches that no longer exist are ignored.
+    """
+
+    path = Unicode(
+        "",
+        help="""
+        Path of the cache snapshot file.
+
+        When set, in-process caches (e.g. resolved refs and ETags,
+        cached 404s and images known to exist) are saved to this file
+        on shutdown and every `interval` seconds,
+        and loaded again at startup so that a fresh process starts warm.
+        With BinderHub.num_workers > 1, only the caches of the first worker are saved.
+
+        Empty (default) disables cache snapshots.
+        """,
+        config=True,
+    )
+
+    interval = Integer(
+        300,
+        help="""
+        Interval (in seconds) for how often to save a cache snapshot.
+
+        0 disables periodic snapshots; a snapshot is still saved on shutdown.
+        """,
+        config=True,
+    )
+
+    max_age = Integer(
+        3600,
+        help="""
+        Maximum age (in seconds) of a cache snapshot to load at startup.
+
+        Older snapshots are ignored. 0 means no limit.
+        Individual entries also respect the max age of their own cache.
+        """,
+        config=True,
+    )
+
+    def save(self, caches):
+        """Save a snapshot of `caches` (dict of name: Cache)"""
+        if not self.path:
+            return
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "timestamp": time.time(),
+            "caches": {name: cache.snapshot() for name, cache in caches.items()},
+        }
+        tmp_path = self.path + ".tmp"
+        with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+            json.dump(snapshot, f, separators=(",", ":"))
+        # atomic replace, so a crash never leaves a partial snapshot behind
+        os.replace(tmp_path, self.path)
+        self.log.debug(
+            "Saved cache snapshot to %s (%i entries)",
+            self.path,
+            sum(len(items) for items in snapshot["caches"].values()),
+        )
+
+    def load(self, caches):
+        """Restore `caches` (dict of name: Cache) from the snapshot, if any
+
+        Returns the number of restored entries.
+        """
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError) as e:
+            self.log.warning("Failed to load cache snapshot %s: %s", self.path, e)
+            return 0
+
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            self.log.warning(
+                "Ignoring cache snapshot %s with version %s",
+                self.path,
+                snapshot.get("version"),
+            )
+            return 0
+
+        elapsed = max(time.time() - snapshot["timestamp"], 0)
+        if self.max_age and elapsed > self.max_age:
+            self.log.info(
+                "Ignoring cache snapshot %s older than %is", self.path, self.max_age
+            )
+            return 0
+
+        restored = 0
+        for name, items in snapshot["caches"].items():
+            if name not in caches:
+                continue
+            cache = caches[name]
+            before = len(cache)
+            cache.restore(items, elapsed=elapsed)
+            restored += len(cache) - before
+        self.log.info(
+            "Loaded %i cache entries from snapshot %s (%is old)",
+            restored,
+            self.path,
+            elapsed,
+        )
+        return restored
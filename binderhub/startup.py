@@ -0,0 +1,136 @@
+"""
+Profiling of startup time: module imports and initialization steps
+
+Enabled with ``python -m binderhub --profile-startup``.
+Only uses the standard library, so that it can be started before other imports.
+"""
+import sys
+import time
+
+# the active StartupProfile, if any
+_profile = None
+
+
+class _TimedLoader:
+    """Wrap a module loader to time the execution of modules"""
+
+    def __init__(self, loader, profile):
+        self._loader = loader
+        self._profile = profile
+
+    def __getattr__(self, name):
+        return getattr(self._loader, name)
+
+    def create_module(self, spec):
+        return self._loader.create_module(spec)
+
+    def exec_module(self, module):
+        profile = self._profile
+        # time spent importing submodules, not counted in this module's own time
+        profile._import_stack.append(0)
+        start = time.perf_counter()
+        try:
+            self._loader.exec_module(module)
+        finally:
+            duration = time.perf_counter() - start
+            nested = profile._import_stack.pop()
+            if profile._import_stack:
+                profile._import_stack[-1] += duration
+            profile.imports[module.__name__] = (duration - nested, duration)
+            # don't leave the wrapper on the module
+            module.__loader__ = self._loader
+            if module.__spec__ is not None:
+                module.__spec__.loader = self._loader
+
+
+class _ImportTimer:
+    """Meta path finder timing the imports found by the other finders"""
+
+    def __init__(self, profile):
+        self.profile = profile
+
+    def find_spec(self, name, path, target=None):
+        for finder in sys.meta_path:
+            if finder is self or not hasattr(finder, 'find_spec'):
+                continue
+            spec = finder.find_spec(name, path, target)
+            if spec is None:
+                continue
+            if hasattr(spec.loader, 'exec_module'):
+                spec.loader = _TimedLoader(spec.loader, self.profile)
+            return spec
+        return None
+
+
+class StartupProfile:
+    """Time spent importing each module, and in each step of initialization
+
+    Steps are timed between calls to `mark`.
+    """
+
+    def __init__(self):
+        self.start = self._last_mark = time.perf_counter()
+        # module name: (own time, time including the modules it imported)
+        self.imports = {}
+        # [(step, time)]
+        self.steps = []
+        self._import_stack = []
+        self._finder = None
+
+    def install(self):
+        """Start timing imports"""
+        self._finder = _ImportTimer(self)
+        sys.meta_path.insert(0, self._finder)
+
+    def uninstall(self):
+        if self._finder in sys.meta_path:
+            sys.meta_path.remove(self._finder)
+
+    def mark(self, step):
+        """Record the time since the previous mark as the time of `step`"""
+        now = time.perf_counter()
+        self.steps.append((step, now - self._last_mark))
+        self._last_mark = now
+
+    def report(self, top=25):
+        """Return the report, as a list of lines"""
+        lines = [
+            "Startup took %.3fs" % (time.perf_counter() - self.start),
+            "Initialization steps:",
+        ]
+        for step, duration in self.steps:
+            lines.append("  %8.3fs  %s" % (duration, step))
+        if self.imports:
+            lines.append(
+                "Slowest of %i imports (own time, cumulative time):" % len(self.imports)
+            )
+            slowest = sorted(self.imports.items(), key=lambda item: item[1][1], reverse=True)
+            for name, (own, cumulative) in slowest[:top]:
+                lines.append("  %8.3fs %8.3fs  %s" % (own, cumulative, name))
+        return lines
+
+
+def start_profile(time_imports=True):
+    """Start profiling startup, returning the StartupProfile"""
+    global _profile
+    if _profile is None:
+        _profile = StartupProfile()
+        if time_imports:
+            _profile.install()
+    return _profile
+
+
+def mark(step):
+    """Mark the end of an initialization step, if profiling startup"""
+    if _profile is not None:
+        _profile.mark(step)
+
+
+def report(log):
+    """Log the startup profile and stop profiling, if profiling startup"""
+    global _profile
+    if _profile is None:
+        return
+    _profile.uninstall()
+    log.info("\n".join(_profile.report()))
+    _profile = None
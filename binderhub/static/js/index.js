@@ -338,6 +338,18 @@ function loadingMain(providerSpec) {
   }
   build(providerSpec, log, path, pathType);
 
+  // Show the nbviewer preview once we know it is available,
+  // if it wasn't known when the page was rendered
+  var $preview = $('.preview[data-nbviewer-check-url]');
+  if ($preview.length > 0) {
+    $.getJSON($preview.data('nbviewer-check-url'), function(data) {
+      if (data.nbviewer_url) {
+        $('#nbviewer-preview iframe').attr('src', data.nbviewer_url);
+        $preview.removeClass('hidden');
+      }
+    });
+  }
+
   // Looping through help text every few seconds
   const launchMessageInterval = 6 * 1000
   setInterval(nextHelpText, launchMessageInterval);
@@ -0,0 +1,207 @@
+"""
+Static files served from memory, with precompressed variants
+"""
+import gzip
+import os
+
+from tornado import web
+from tornado.log import app_log
+
+from .log import ResponseSizeMixin
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# file extensions worth compressing
+COMPRESSIBLE_EXTENSIONS = {
+    '.css',
+    '.eot',
+    '.html',
+    '.ico',
+    '.js',
+    '.json',
+    '.map',
+    '.otf',
+    '.svg',
+    '.ttf',
+    '.txt',
+    '.xml',
+}
+
+# Content-Encoding: extension of the variant, in order of preference
+ENCODINGS = {
+    'br': '.br',
+    'gzip': '.gz',
+}
+
+# smaller files are not compressed, the headers are bigger than the savings
+MIN_COMPRESS_SIZE = 256
+
+
+def parse_accept_encoding(header):
+    """Return the set of codings accepted by an Accept-Encoding header"""
+    accepted = set()
+    for item in header.split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        params = params.strip().replace(' ', '')
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(coding)
+    return accepted
+
+
+class StaticFileHandler(ResponseSizeMixin, web.StaticFileHandler):
+    """StaticFileHandler serving preloaded files from memory
+
+    Files loaded with :meth:`preload` are served without reading them again,
+    compressed with gzip (or brotli, if installed) when the client accepts it.
+    Files are compressed once, when they are loaded.
+    Compressed variants written next to the files at build time
+    (e.g. ``bundle.js.br``) are used as well.
+
+    Versioned URLs (``static_url(...)?v=...``) are cached by browsers
+    and proxies as immutable.
+    """
+
+    # contents of preloaded files, by absolute path
+    # compressed variants are stored as path + extension, e.g. `index.css.gz`
+    _contents = {}
+
+    # available compressed variants, by absolute path: {encoding: variant path}
+    _variants = {}
+
+    @classmethod
+    def preload(cls, root, memory_max_size=512 * 1024, precompress=True):
+        """Load the files in `root` (recursively) in memory, and compress them
+
+        Files larger than `memory_max_size` are served from disk.
+        Compressed variants are kept in memory regardless of their size,
+        or use the variants found on disk.
+        """
+        root = os.path.abspath(root)
+        loaded = compressed = 0
+        for dirpath, dirnames, filenames in os.walk(root):
+            # variants compressed at build time first
+            for filename in sorted(
+                filenames, key=lambda f: os.path.splitext(f)[1] not in ENCODINGS.values()
+            ):
+                path = os.path.join(dirpath, filename)
+                base, ext = os.path.splitext(path)
+                if ext in ENCODINGS.values() and os.path.isfile(base):
+                    # variant compressed at build time
+                    encoding = next(e for e, x in ENCODINGS.items() if x == ext)
+                    cls._variants.setdefault(base, {})[encoding] = path
+                    if os.path.getsize(path) <= memory_max_size:
+                        with open(path, 'rb') as f:
+                            cls._contents[path] = f.read()
+                    continue
+
+                size = os.path.getsize(path)
+                compress = (
+                    precompress
+                    and ext.lower() in COMPRESSIBLE_EXTENSIONS
+                    and size >= MIN_COMPRESS_SIZE
+                )
+                if size > memory_max_size and not compress:
+                    continue
+                with open(path, 'rb') as f:
+                    content = f.read()
+                if size <= memory_max_size:
+                    cls._contents[path] = content
+                    loaded += 1
+                if compress:
+                    compressed += cls._compress(path, content)
+
+        app_log.info(
+            "Loaded %i static files from %s in memory, compressed %i", loaded, root, compressed
+        )
+
+    @classmethod
+    def _compress(cls, path, content):
+        """Store the compressed variants of `content` worth serving
+
+        Returns the number of variants stored.
+        """
+        compressors = {'gzip': lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            compressors['br'] = lambda data: brotli.compress(data, quality=11)
+        variants = cls._variants.setdefault(path, {})
+        stored = 0
+        for encoding, compress in compressors.items():
+            if encoding in variants:
+                # already compressed at build time
+                continue
+            data = compress(content)
+            if len(data) < 0.9 * len(content):
+                variant_path = path + ENCODINGS[encoding]
+                cls._contents[variant_path] = data
+                variants[encoding] = variant_path
+                stored += 1
+        return stored
+
+    @classmethod
+    def get_content(cls, abspath, start=None, end=None):
+        content = cls._contents.get(abspath)
+        if content is None:
+            return super().get_content(abspath, start, end)
+        return content[start:end]
+
+    def validate_absolute_path(self, root, absolute_path):
+        absolute_path = super().validate_absolute_path(root, absolute_path)
+        self.original_path = absolute_path
+        self.content_encoding = None
+        variants = self._variants.get(absolute_path)
+        if absolute_path is None or not variants:
+            return absolute_path
+
+        accepted = parse_accept_encoding(self.request.headers.get('Accept-Encoding', ''))
+        for encoding in ENCODINGS:
+            if encoding in variants and encoding in accepted:
+                self.content_encoding = encoding
+                return variants[encoding]
+        return absolute_path
+
+    def _for_original(self, method):
+        """Call `method` for the original file, instead of the compressed variant"""
+        absolute_path = self.absolute_path
+        self.absolute_path = self.original_path
+        try:
+            return method()
+        finally:
+            self.absolute_path = absolute_path
+
+    def get_content_size(self):
+        content = self._contents.get(self.absolute_path)
+        if content is not None:
+            return len(content)
+        if self.content_encoding:
+            # the stat result of the original file may be cached
+            return os.stat(self.absolute_path).st_size
+        return super().get_content_size()
+
+    def get_modified_time(self):
+        return self._for_original(super().get_modified_time)
+
+    def get_content_type(self):
+        return self._for_original(super().get_content_type)
+
+    def set_extra_headers(self, path):
+        if self._variants.get(self.original_path):
+            self.set_header('Vary', 'Accept-Encoding')
+        if self.content_encoding:
+            self.set_header('Content-Encoding', self.content_encoding)
+        if self.settings.get('static_hash_cache', True) and 'v' in self.request.arguments:
+            # the URL changes with the content
+            self.set_header(
+                'Cache-Control',
+                'public, max-age=%i, immutable' % self.CACHE_MAX_AGE,
+            )
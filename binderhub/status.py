@@ -0,0 +1,103 @@
+"""
+Batch status of repos: their resolved ref, and whether their image is built
+"""
+import asyncio
+import json
+
+from tornado.log import app_log
+from tornado.web import HTTPError, authenticated
+
+from .base import APIHandler
+from .builder import BuildHandler, _get_image_name, _image_exists
+
+
+class RepoStatusHandler(APIHandler):
+    """Report the resolved ref and image status of several repos
+
+    GET /api/status?repo=gh/org/repo/ref&repo=...
+    or POST /api/status with ``{"repos": ["gh/org/repo/ref", ...]}``
+
+    Responds with ``{"repos": [...]}``, one result per entry, in order::
+
+        {
+            "repo": "gh/org/repo/ref",
+            "ref": "<resolved ref>",
+            "image": "<image name>",
+            "image_found": true
+        }
+
+    or ``{"repo": ..., "error": "<message>"}``.
+
+    Read-only: nothing is built. Refs are resolved concurrently,
+    at most `status_api_concurrency` at a time for each request.
+    Each repo takes a token of the client's ``status`` rate limit.
+    Repos that need the user's authorization are not resolved.
+    """
+
+    def check_xsrf_cookie(self):
+        # read-only API request, not a form
+        pass
+
+    @authenticated
+    async def get(self):
+        await self.respond(self.get_arguments('repo'))
+
+    @authenticated
+    async def post(self):
+        try:
+            body = json.loads(self.request.body or b'{}')
+        except ValueError:
+            raise HTTPError(400, "Request body must be JSON")
+        repos = body.get('repos') if isinstance(body, dict) else None
+        if not isinstance(repos, list) or not all(isinstance(r, str) for r in repos):
+            raise HTTPError(400, "repos must be a list of provider/spec")
+        await self.respond(repos)
+
+    async def respond(self, repos):
+        max_repos = self.settings['status_api_max_repos']
+        if len(repos) > max_repos:
+            raise HTTPError(400, "At most %i repos per request" % max_repos)
+        self.check_rate_limit('status', len(repos))
+
+        semaphore = asyncio.Semaphore(self.settings['status_api_concurrency'])
+
+        async def status(repo):
+            async with semaphore:
+                try:
+                    return await self.get_repo_status(repo)
+                except Exception as e:
+                    app_log.warning("Failed to get the status of %s: %s", repo, e)
+                    return {'repo': repo, 'error': str(e) or type(e).__name__}
+
+        results = await asyncio.gather(*(status(repo) for repo in repos))
+        self.set_header('Content-Type', 'application/json')
+        self.write(json.dumps({'repos': results}))
+
+    async def get_repo_status(self, repo):
+        """Return the status of one repo, given as provider/spec"""
+        provider_prefix, _, spec = repo.strip('/').partition('/')
+        if provider_prefix not in self.settings['repo_providers'] or not spec:
+            return {'repo': repo, 'error': "No provider found for %s" % repo}
+
+        provider = self.get_provider(provider_prefix, spec=spec)
+        if provider.is_banned():
+            return {'repo': repo, 'error': "Launching %s is disabled" % spec}
+        if provider.get_authorization_provider() is not None:
+            return {'repo': repo, 'error': "Authorization required"}
+
+        ref = await provider.get_resolved_ref()
+        if ref is None:
+            return {'repo': repo, 'error': "Could not resolve ref for %s" % repo}
+
+        image_name = _get_image_name(provider, ref, self.settings['image_prefix'])
+        image_found = bool(BuildHandler.image_cache.get(image_name))
+        if not image_found:
+            image_found = await _image_exists(self.settings, image_name)
+            if image_found:
+                BuildHandler.image_cache.set(image_name, True)
+        return {
+            'repo': repo,
+            'ref': ref,
+            'image': image_name,
+            'image_found': image_found,
+        }
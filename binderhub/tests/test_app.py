@@ -1,6 +1,7 @@
 """Exercise the binderhub entrypoint"""
 
-from subprocess import check_output
+from subprocess import check_output, run, PIPE
+import os
 import sys
 import pytest
 
@@ -36,3 +37,40 @@ def test_repo_providers():
     for repo_providers in wrong_repo_providers:
         with pytest.raises(TraitError):
             b.repo_providers = repo_providers
+
+def test_workers_with_launch_jobs():
+    # launch jobs are kept in the memory of one worker
+    p = run(
+        [sys.executable, '-m', 'binderhub', '--BinderHub.num_workers=2'],
+        stdout=PIPE, stderr=PIPE,
+    )
+    assert p.returncode != 0
+    assert b'num_workers must be 1 with launch_jobs_enabled' in p.stderr
+
+def test_lazy_imports():
+    # heavy dependencies of disabled features aren't imported on startup
+    out = check_output([
+        sys.executable, '-c',
+        'import sys, binderhub.app; '
+        'print(sorted(m for m in ("kubernetes", "docker", "jsonschema") if m in sys.modules))'
+    ])
+    assert out.decode().strip() == '[]'
+
+def test_clear_multiprocess_dir(tmp_path):
+    # metrics of a previous run are removed, not those of the running process
+    (tmp_path / "counter_1.db").write_bytes(b"")
+    out = check_output(
+        [
+            sys.executable, '-c',
+            'import os; '
+            'from prometheus_client import generate_latest; '
+            'from binderhub.builder import BUILDS_INPROGRESS; '
+            'from binderhub.metrics import clear_multiprocess_dir, metrics_registry; '
+            'clear_multiprocess_dir(keep_pid=os.getpid()); '
+            'BUILDS_INPROGRESS.inc(); '
+            'print(generate_latest(metrics_registry()).decode())'
+        ],
+        env=dict(os.environ, PROMETHEUS_MULTIPROC_DIR=str(tmp_path)),
+    )
+    assert 'binderhub_inprogress_builds 1.0' in out.decode()
+    assert not (tmp_path / "counter_1.db").exists()
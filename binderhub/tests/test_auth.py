@@ -89,10 +89,7 @@ async def test_ban_networks(request, app, use_session, path, banned, prefixlen,
     request.addfinalizer(reset)
     with mock.patch.dict(
         app.tornado_app.settings,
-        {
-            "ban_networks": app.ban_networks,
-            "ban_networks_min_prefix_len": app.ban_networks_min_prefix_len,
-        },
+        {"ban_networks": app.ban_networks},
     ):
         r = await async_requests.get(url)
     if isinstance(status, int):
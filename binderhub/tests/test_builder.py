@@ -1,6 +1,20 @@
+import asyncio
+import ipaddress
+import json
+from unittest import mock
+
 import pytest
+from tornado.httpclient import HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.tcpclient import TCPClient
+from tornado.testing import bind_unused_port
+from tornado.web import Application
+from tornado.websocket import websocket_connect
 
-from binderhub.builder import _generate_build_name
+from binderhub.builder import BuildHandler, BuildWebSocketHandler, _generate_build_name
+from binderhub.eventstream import EventStreams
+from binderhub.repoproviders import FakeProvider
+from binderhub.utils import Cache
 
 
 @pytest.mark.parametrize('ref,build_slug', [
@@ -19,3 +33,121 @@ def test_build_name(build_slug, ref):
 
     last_char = build_name[-1]
     assert last_char not in ("-", "_", ".")
+
+
+async def test_speculative_resolution():
+    registry = mock.Mock()
+    registry.get_image_manifest = mock.AsyncMock(return_value={'manifest': True})
+    settings = {
+        'repo_providers': {'fake': FakeProvider},
+        'traitlets_config': None,
+        'image_prefix': 'binder-',
+        'use_registry': True,
+        'registry': registry,
+    }
+    with mock.patch.object(BuildHandler, 'speculative_cache', Cache(8, max_age=60)):
+        BuildHandler.speculate(settings, 'fake', 'fake/repo/master')
+        # only started once
+        BuildHandler.speculate(settings, 'fake', 'fake/repo/master')
+        speculation = await BuildHandler.pop_speculation('fake:fake/repo/master')
+        assert speculation['ref'] == '1a2b3c4d5e6f'
+        assert speculation['image_name'].startswith('binder-rick')
+        assert speculation['image_name'].endswith(':1a2b3c4d5e6f')
+        assert speculation['image_found']
+        registry.get_image_manifest.assert_called_once()
+
+        # results are only used once
+        assert await BuildHandler.pop_speculation('fake:fake/repo/master') is None
+
+
+class FakeBuildHandler(BuildHandler):
+    async def build_and_launch(self, provider_prefix, _unescaped_spec):
+        self.start_stream()
+        await self.emit({'phase': 'waiting', 'message': 'Waiting...\n'})
+        await self.emit('{"phase": "building", "message": "' + 'Step 1/2\\n' * 100 + '"}')
+        await self.emit({'phase': 'ready', 'url': 'http://hub/user/x/', 'token': 'abc'})
+        await self.end_stream()
+
+
+class FakeBuildWebSocketHandler(FakeBuildHandler, BuildWebSocketHandler):
+    pass
+
+
+async def test_websocket_events(tmpdir):
+    settings = {
+        'auth_enabled': False,
+        'use_registry': False,
+        'event_log': None,
+        'repo_token_store': str(tmpdir.join('tokens.sqlite')),
+        'traitlets_config': None,
+    }
+    app = Application(
+        [
+            (r"/build/([^/]+)/(.+)", FakeBuildHandler),
+            (r"/ws/build/([^/]+)/(.+)", FakeBuildWebSocketHandler),
+        ],
+        **settings,
+    )
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+
+    # the client closes the event stream after the last event
+    stream = await TCPClient().connect("127.0.0.1", port)
+    await stream.write(b"GET /build/gh/owner/repo/main HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    data = await stream.read_until(b'"phase": "ready"')
+    data += await stream.read_until(b"\n\n")
+    sse_events = [
+        json.loads(line.split(':', 1)[1])
+        for line in data.decode().splitlines()
+        if line.startswith('data:')
+    ]
+    assert len(EventStreams.instance().lingering) == 1
+    stream.close()
+    for _ in range(100):
+        if not EventStreams.instance().streams:
+            break
+        await asyncio.sleep(0.01)
+    # stopped waiting for the client to close the connection
+    assert not EventStreams.instance().lingering
+
+    ws = await websocket_connect(
+        f"ws://127.0.0.1:{port}/ws/build/gh/owner/repo/main",
+        compression_options={},
+    )
+    # permessage-deflate was negotiated
+    assert "permessage-deflate" in ws.headers.get("Sec-WebSocket-Extensions", "")
+    ws_events = []
+    while True:
+        message = await ws.read_message()
+        if message is None:
+            # closed by the server after the last event
+            break
+        ws_events.append(json.loads(message))
+
+    assert [e['phase'] for e in ws_events] == ['waiting', 'building', 'ready']
+    assert ws_events == sse_events
+    server.stop()
+
+
+async def test_websocket_banned(tmpdir):
+    settings = {
+        'auth_enabled': False,
+        'use_registry': False,
+        'event_log': None,
+        'repo_token_store': str(tmpdir.join('tokens.sqlite')),
+        'traitlets_config': None,
+        'ban_networks': {ipaddress.ip_network('127.0.0.0/8'): 'localhost'},
+    }
+    app = Application(
+        [(r"/ws/build/([^/]+)/(.+)", FakeBuildWebSocketHandler)], **settings
+    )
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    try:
+        with pytest.raises(HTTPClientError) as e:
+            await websocket_connect(f"ws://127.0.0.1:{port}/ws/build/gh/owner/repo/main")
+        assert e.value.code == 403
+    finally:
+        server.stop()
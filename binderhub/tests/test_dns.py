@@ -0,0 +1,59 @@
+"""Tests for the caching DNS resolver"""
+import socket
+from unittest import mock
+
+import pytest
+from tornado.httpclient import HTTPRequest
+
+from binderhub import dns
+from binderhub.dns import DNS_LOOKUPS, CachingResolver
+from binderhub.utils import Cache
+
+
+def _count(result):
+    return DNS_LOOKUPS.labels(result)._value.get()
+
+
+async def test_caching_resolver():
+    resolver = CachingResolver(max_ttl=60)
+    with mock.patch.object(CachingResolver, "cache", Cache(8)):
+        hits, misses = _count("hit"), _count("miss")
+        addresses = await resolver.resolve("localhost", 80, socket.AF_INET)
+        assert addresses == [(socket.AF_INET, ("127.0.0.1", 80))]
+        assert _count("miss") == misses + 1
+
+        # cached, with the requested port
+        addresses = await resolver.resolve("localhost", 8080, socket.AF_INET)
+        assert addresses == [(socket.AF_INET, ("127.0.0.1", 8080))]
+        assert _count("hit") == hits + 1
+
+        # failures are cached too
+        negative_hits = _count("negative_hit")
+        for _ in range(2):
+            with pytest.raises(IOError):
+                await resolver.resolve("nosuchhost.invalid", 80)
+        assert _count("negative_hit") == negative_hits + 1
+
+
+async def test_pin_request():
+    resolver = CachingResolver()
+    with mock.patch.object(CachingResolver, "cache", Cache(8)):
+        request = await resolver.pin_request(HTTPRequest("http://localhost:8080/hub/api"))
+        curl = mock.Mock()
+        request.prepare_curl_callback(curl)
+        option = curl.setopt.call_args[0][1]
+        assert option[0].startswith("localhost:8080:")
+        assert "127.0.0.1" in option[0]
+
+        # unresolvable hosts are left to curl
+        request = HTTPRequest("https://nosuchhost.invalid/")
+        assert (await resolver.pin_request(request)).prepare_curl_callback is None
+
+
+async def test_caching_resolver_without_aiodns():
+    resolver = CachingResolver(max_ttl=30)
+    with mock.patch.object(CachingResolver, "cache", Cache(8)), \
+            mock.patch.object(dns, "aiodns", None):
+        addresses = await resolver.resolve("localhost", 80, socket.AF_INET)
+        assert addresses == [(socket.AF_INET, ("127.0.0.1", 80))]
+        assert CachingResolver.cache.get(("localhost", socket.AF_INET))["ttl"] == 30
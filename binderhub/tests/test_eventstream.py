@@ -0,0 +1,86 @@
+"""Tests for the registry of event streams"""
+import asyncio
+import time
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.tcpclient import TCPClient
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+
+from binderhub.eventstream import EventStreams, OPEN_STREAMS
+
+
+class StreamHandler(RequestHandler):
+    def initialize(self, event_streams, lingered):
+        self.event_streams = event_streams
+        self.lingered = lingered
+
+    async def get(self):
+        self.event_streams.register(self)
+        await asyncio.sleep(0.3)
+        self.write('data: {"phase": "ready"}\n\n')
+        self.event_streams.touch(self)
+        await self.flush()
+        await self.event_streams.linger(self)
+        self.lingered.set()
+
+    def on_connection_close(self):
+        self.event_streams.closed(self)
+
+    def on_finish(self):
+        self.event_streams.unregister(self)
+
+
+@pytest.fixture
+def stream_server(io_loop, request):
+    event_streams = EventStreams(
+        keepalive_interval=0.1, tick_interval=0.05, linger_timeout=0.5
+    )
+    lingered = asyncio.Event()
+    app = Application(
+        [
+            (
+                "/stream",
+                StreamHandler,
+                {"event_streams": event_streams, "lingered": lingered},
+            )
+        ]
+    )
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    request.addfinalizer(server.stop)
+    return event_streams, lingered, port
+
+
+async def test_keepalive_and_linger(stream_server):
+    event_streams, lingered, port = stream_server
+    start = time.monotonic()
+    r = await AsyncHTTPClient().fetch(f"http://127.0.0.1:{port}/stream")
+    duration = time.monotonic() - start
+    body = r.body.decode()
+    # keepalives while idle, before and after the event
+    before, after = body.split('data: {"phase": "ready"}\n\n')
+    assert ":keepalive\n\n" in before
+    assert ":keepalive\n\n" in after
+    # closed by the server after linger_timeout
+    assert 0.7 < duration < 2
+    assert lingered.is_set()
+    assert event_streams.streams == {}
+    assert OPEN_STREAMS._value.get() == 0
+
+
+async def test_client_closes(stream_server):
+    event_streams, lingered, port = stream_server
+    stream = await TCPClient().connect("127.0.0.1", port)
+    await stream.write(b"GET /stream HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    await stream.read_until(b'data: {"phase": "ready"}\n\n')
+    assert len(event_streams.lingering) == 1
+    start = time.monotonic()
+    stream.close()
+    await asyncio.wait_for(lingered.wait(), timeout=1)
+    # didn't wait for linger_timeout
+    assert time.monotonic() - start < 0.4
+    assert event_streams.lingering == {}
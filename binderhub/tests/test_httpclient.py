@@ -0,0 +1,78 @@
+"""Tests for isolated HTTP clients"""
+import asyncio
+
+from tornado.httpclient import HTTPRequest
+from tornado.ioloop import IOLoop
+
+from binderhub.httpclient import (
+    GitHubHTTPClient,
+    HTTPClient,
+    HubHTTPClient,
+    IN_FLIGHT_REQUESTS,
+    NbviewerHTTPClient,
+)
+
+
+def test_instances():
+    assert HubHTTPClient.instance() is HubHTTPClient.instance()
+    assert HubHTTPClient.instance() is not GitHubHTTPClient.instance()
+    assert HubHTTPClient().max_clients > HTTPClient().max_clients
+    assert NbviewerHTTPClient().request_timeout < HTTPClient().request_timeout
+
+
+async def test_concurrency_limit():
+    started = []
+    release = asyncio.Event()
+
+    class MockClient:
+        async def fetch(self, request, **kwargs):
+            started.append(request)
+            await release.wait()
+            return request
+
+    def make_client(cls):
+        http_client = cls(max_clients=1)
+        # create the semaphore, then replace the underlying client
+        http_client.client
+        http_client._client = MockClient()
+        return http_client
+
+    github = make_client(GitHubHTTPClient)
+    hub = make_client(HubHTTPClient)
+    assert hub._loop is IOLoop.current()
+
+    slow = [asyncio.ensure_future(github.fetch(f"github-{i}")) for i in range(2)]
+    await asyncio.sleep(0)
+    # the second github request waits for a free slot
+    assert started == ["github-0"]
+    assert IN_FLIGHT_REQUESTS.labels(upstream="github")._value.get() == 1
+
+    # but requests to other upstreams don't
+    hub_request = asyncio.ensure_future(hub.fetch("hub"))
+    await asyncio.sleep(0)
+    assert started == ["github-0", "hub"]
+
+    release.set()
+    assert await asyncio.gather(*slow, hub_request) == ["github-0", "github-1", "hub"]
+
+
+async def test_pinned_request_fetch_arguments():
+    fetched = []
+
+    class MockClient:
+        async def fetch(self, request, **kwargs):
+            fetched.append((request, kwargs))
+
+    class MockResolver:
+        async def pin_request(self, request):
+            return request
+
+    http_client = GitHubHTTPClient()
+    http_client.client
+    http_client._client = MockClient()
+    http_client._resolver = MockResolver()
+    await http_client.fetch("https://example.org", method="HEAD", raise_error=False)
+    [(request, kwargs)] = fetched
+    assert isinstance(request, HTTPRequest)
+    assert request.method == "HEAD"
+    assert kwargs == {"raise_error": False}
@@ -0,0 +1,225 @@
+"""Tests for launch jobs"""
+import asyncio
+import json
+from unittest import mock
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+
+from binderhub.jobs import JobHandler, LaunchJob, LaunchJobHandler
+from binderhub.ratelimit import RateLimiter
+from binderhub.utils import Cache
+
+
+class FakeLaunchJobHandler(LaunchJobHandler):
+    async def build_and_launch(self, provider_prefix, _unescaped_spec):
+        spec = self.get_spec_from_request('/build/' + provider_prefix)
+        # as BuildHandler does
+        self.check_rate_limit('launch')
+        await self.emit({'phase': 'waiting', 'message': 'Waiting...\n'})
+        await asyncio.sleep(0.2)
+        await self.emit('{"phase": "building", "message": "Step 1/2\\n"}')
+        await asyncio.sleep(0.2)
+        if spec.endswith('/fail'):
+            raise ValueError("oops")
+        await self.emit({'phase': 'ready', 'url': 'http://hub/user/x/', 'token': 'abc'})
+
+
+class CallbackHandler(RequestHandler):
+    def initialize(self, received):
+        self.received = received
+
+    def post(self):
+        self.received.set_result(json.loads(self.request.body))
+
+
+def test_job_status():
+    job = LaunchJob('gh', 'org/repo/main')
+    assert job.status == 'running'
+    assert not job.done
+    job.add_event({'phase': 'auth', 'authorization_url': 'https://example.org'})
+    job.finish()
+    assert job.status == 'auth'
+    assert job.done
+
+    job = LaunchJob('gh', 'org/repo/main')
+    job.add_event({'phase': 'launching'})
+    job.finish()
+    assert job.status == 'failed'
+    assert job.model(1)['events'] == []
+    assert job.model()['next'] == 1
+
+
+@pytest.fixture
+def job_api(io_loop, tmpdir, request):
+    received = io_loop.asyncio_loop.create_future()
+    settings = {
+        'auth_enabled': False,
+        'use_registry': False,
+        'event_log': None,
+        'repo_token_store': str(tmpdir.join('tokens.sqlite')),
+        'repo_providers': {'gh': None},
+        'traitlets_config': None,
+        'base_url': '/',
+        'job_callbacks_enabled': True,
+    }
+    app = Application(
+        [
+            (r"/api/launch", FakeLaunchJobHandler),
+            (r"/api/jobs/([^/]+)", JobHandler),
+            (r"/callback", CallbackHandler, {'received': received}),
+        ],
+        **settings,
+    )
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    request.addfinalizer(server.stop)
+    return f"http://127.0.0.1:{port}", app, received
+
+
+async def fetch(url, **kwargs):
+    try:
+        r = await AsyncHTTPClient().fetch(url, **kwargs)
+    except HTTPClientError as e:
+        r = e.response
+    return r.code, json.loads(r.body) if r.body else None
+
+
+async def test_launch_job(job_api):
+    url, app, received = job_api
+    code, job = await fetch(
+        url + "/api/launch",
+        method="POST",
+        body=json.dumps(
+            {
+                "provider": "gh",
+                "spec": "org/repo/main",
+                "callback_url": url + "/callback",
+            }
+        ),
+    )
+    assert code == 202
+    assert job['status'] == 'running'
+
+    # long-poll for events until done
+    events = []
+    since = 0
+    while True:
+        code, model = await fetch(url + f"/api/jobs/{job['id']}?since={since}&wait=5")
+        assert code == 200
+        events.extend(model['events'])
+        since = model['next']
+        if model['status'] != 'running':
+            break
+    assert model['status'] == 'ready'
+    assert [e['phase'] for e in events] == ['waiting', 'building', 'ready']
+
+    # the full journal is kept
+    code, model = await fetch(url + f"/api/jobs/{job['id']}")
+    assert model['events'] == events
+
+    notified = await asyncio.wait_for(received, timeout=5)
+    assert notified['id'] == job['id']
+    assert notified['status'] == 'ready'
+
+
+async def test_launch_job_failed(job_api):
+    url, app, received = job_api
+    code, job = await fetch(
+        url + "/api/launch",
+        method="POST",
+        body=json.dumps({"provider": "gh", "spec": "org/repo/fail"}),
+    )
+    assert code == 202
+    code, model = await fetch(url + f"/api/jobs/{job['id']}?wait=5")
+    while model['status'] == 'running':
+        code, model = await fetch(url + f"/api/jobs/{job['id']}?wait=5")
+    assert model['status'] == 'failed'
+    assert model['events'][-1]['status_code'] == 500
+    # like BuildHandler, details of unexpected errors are only logged
+    assert model['events'][-1]['message'] == 'Internal Server Error\n'
+
+
+@pytest.mark.parametrize(
+    "body, status_code",
+    [
+        ("not json", 400),
+        ({"provider": "gh"}, 400),
+        ({"provider": "nope", "spec": "org/repo/main"}, 404),
+        ({"provider": "gh", "spec": "org/repo/main", "callback_url": "file:///etc/passwd"}, 400),
+    ],
+)
+async def test_launch_job_invalid(job_api, body, status_code):
+    url, app, received = job_api
+    if not isinstance(body, str):
+        body = json.dumps(body)
+    code, error = await fetch(url + "/api/launch", method="POST", body=body)
+    assert code == status_code
+    assert error['status_code'] == status_code
+
+
+async def test_unknown_job(job_api):
+    url, app, received = job_api
+    code, error = await fetch(url + "/api/jobs/nope")
+    assert code == 404
+    assert error['message'] == "No such job: nope"
+
+
+async def test_running_jobs_kept(job_api):
+    url, app, received = job_api
+    # no room for finished jobs
+    with mock.patch.object(LaunchJobHandler, 'jobs', Cache(1)):
+        ids = []
+        for i in range(3):
+            code, job = await fetch(
+                url + "/api/launch",
+                method="POST",
+                body=json.dumps({"provider": "gh", "spec": f"org/repo-{i}/main"}),
+            )
+            ids.append(job['id'])
+        for job_id in ids:
+            code, model = await fetch(url + f"/api/jobs/{job_id}")
+            assert code == 200
+            assert model['status'] == 'running'
+        for job_id in ids:
+            code, model = await fetch(url + f"/api/jobs/{job_id}?wait=5")
+            while model['status'] == 'running':
+                code, model = await fetch(url + f"/api/jobs/{job_id}?wait=5")
+            assert job_id not in LaunchJobHandler.running_jobs
+        # only the last finished job is kept
+        code, model = await fetch(url + f"/api/jobs/{ids[0]}")
+        assert code == 404
+
+
+async def test_launch_get_not_allowed(job_api):
+    url, app, received = job_api
+    code, error = await fetch(url + "/api/launch")
+    assert code == 405
+
+
+async def test_launch_job_rate_limited(job_api):
+    url, app, received = job_api
+    limiter = RateLimiter(limits={'launch': {'rate': 0.01, 'burst': 1}})
+    body = json.dumps({"provider": "gh", "spec": "org/repo/main"})
+    with mock.patch.object(RateLimiter, '_instance', limiter):
+        code, job = await fetch(url + "/api/launch", method="POST", body=body)
+        assert code == 202
+        running = len(LaunchJobHandler.running_jobs)
+        try:
+            await AsyncHTTPClient().fetch(url + "/api/launch", method="POST", body=body)
+        except HTTPClientError as e:
+            r = e.response
+        assert r.code == 429
+        assert int(r.headers['Retry-After']) >= 99
+        # no job was created
+        assert len(LaunchJobHandler.running_jobs) == running
+
+        # the accepted job isn't limited again
+        code, model = await fetch(url + f"/api/jobs/{job['id']}?wait=5")
+        while model['status'] == 'running':
+            code, model = await fetch(url + f"/api/jobs/{job['id']}?wait=5")
+    assert model['status'] == 'ready'
@@ -0,0 +1,78 @@
+"""Tests for request logging and metrics"""
+import pytest
+from prometheus_client import REGISTRY
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application, RequestHandler
+
+from binderhub.log import ResponseSizeMixin, log_request
+
+
+class PageHandler(ResponseSizeMixin, RequestHandler):
+    def get(self):
+        self.write("x" * 500)
+
+
+class FlushedHandler(ResponseSizeMixin, RequestHandler):
+    async def get(self):
+        self.write({"x": "y" * 100})
+        await self.flush()
+        self.write("z" * 100)
+
+
+class StreamHandler(RequestHandler):
+    streaming = True
+
+    def get(self):
+        self.write("data: {}\n\n")
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+async def test_request_metrics():
+    app = Application(
+        [
+            (r"/page", PageHandler),
+            (r"/flushed", FlushedHandler),
+            (r"/stream", StreamHandler),
+        ],
+        log_function=log_request,
+    )
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    url = f"http://127.0.0.1:{port}"
+
+    page = dict(handler="PageHandler", method="GET", code="2xx")
+    count = sample("binderhub_request_duration_seconds_count", **page)
+    size = sample("binderhub_response_size_bytes_sum", **page)
+    flushed = dict(handler="FlushedHandler", method="GET", code="2xx")
+    flushed_size = sample("binderhub_response_size_bytes_sum", **flushed)
+    stream = dict(handler="StreamHandler", code="2xx")
+    stream_count = sample("binderhub_stream_duration_seconds_count", **stream)
+    try:
+        await AsyncHTTPClient().fetch(url + "/page")
+        with pytest.raises(HTTPClientError):
+            await AsyncHTTPClient().fetch(url + "/page", method="HEAD")
+        await AsyncHTTPClient().fetch(url + "/flushed")
+        await AsyncHTTPClient().fetch(url + "/stream")
+    finally:
+        server.stop()
+
+    assert sample("binderhub_request_duration_seconds_count", **page) == count + 1
+    assert sample("binderhub_response_size_bytes_sum", **page) == size + 500
+    # without Content-Length
+    assert sample("binderhub_response_size_bytes_sum", **flushed) == flushed_size + 109 + 100
+    assert sample(
+        "binderhub_request_duration_seconds_count",
+        handler="PageHandler", method="HEAD", code="4xx",
+    ) >= 1
+    # event streams are measured separately
+    assert sample("binderhub_stream_duration_seconds_count", **stream) == stream_count + 1
+    assert not sample(
+        "binderhub_request_duration_seconds_count",
+        handler="StreamHandler", method="GET", code="2xx",
+    )
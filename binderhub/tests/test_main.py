@@ -1,12 +1,15 @@
 """Test main handlers"""
 
-from urllib.parse import urlparse
+from unittest import mock
+from urllib.parse import urljoin, urlparse
 
 from bs4 import BeautifulSoup
 import pytest
 
 from binderhub import __version__ as binder_version
+from binderhub.ratelimit import RateLimiter
 
+from .conftest import skip_remote
 from .utils import async_requests
 
 
@@ -94,6 +97,19 @@ async def test_versions_handler(app):
     assert data['binderhub'].split("+")[0] == binder_version.split("+")[0]
 
 
+@pytest.mark.remote
+@pytest.mark.parametrize("path", ["/", "/about", "/versions", "/_config"])
+async def test_not_modified(app, path):
+    r = await async_requests.get(app.url + path)
+    assert r.status_code == 200
+    etag = r.headers['Etag']
+
+    r = await async_requests.get(app.url + path, headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.headers['Etag'] == etag
+    assert r.content == b''
+
+
 @pytest.mark.parametrize(
     'provider_prefix,repo,ref,path,path_type,status_code',
     [
@@ -120,6 +136,63 @@ async def test_loading_page(app, provider_prefix, repo, ref, path, path_type, st
     if status_code == 200:
         soup = BeautifulSoup(r.text, 'html5lib')
         assert soup.find(id='log-container')
-        nbviewer_url = soup.find(id='nbviewer-preview').find('iframe').attrs['src']
+        preview = soup.find(class_='preview')
+        check_url = preview.attrs.get('data-nbviewer-check-url')
+        if check_url:
+            # not checked yet: the page asks whether nbviewer is available
+            r = await async_requests.get(urljoin(app.url, check_url))
+            assert r.status_code == 200
+            nbviewer_url = r.json()['nbviewer_url']
+        else:
+            nbviewer_url = soup.find(id='nbviewer-preview').find('iframe').attrs['src']
         r = await async_requests.get(nbviewer_url)
         assert r.status_code == 200, f"{r.status_code} {nbviewer_url}"
+
+
+async def test_nbviewer_check(app):
+    """The loading page doesn't wait for nbviewer, but the result is cached"""
+    from binderhub import main
+
+    uri = '/v2/gh/binderhub-ci-repos/requirements/20c4fe55a9b2c5011d228545e821b1c7b1723652'
+    nbviewer_url = main.get_nbviewer_url(
+        'binderhub-ci-repos', 'requirements', '20c4fe55a9b2c5011d228545e821b1c7b1723652', ''
+    )
+    if nbviewer_url in main.nbviewer_cache:
+        main.nbviewer_cache.pop(nbviewer_url)
+    r = await async_requests.get(app.url + uri)
+    soup = BeautifulSoup(r.text, 'html5lib')
+    check_url = soup.find(class_='preview').attrs['data-nbviewer-check-url']
+
+    r = await async_requests.get(urljoin(app.url, check_url))
+    assert r.json() == {'nbviewer_url': nbviewer_url}
+
+    # once known, the link is in the page
+    r = await async_requests.get(app.url + uri)
+    soup = BeautifulSoup(r.text, 'html5lib')
+    assert soup.find(id='nbviewer-preview').find('iframe').attrs['src'] == nbviewer_url
+@pytest.mark.parametrize(
+    "query, status_code",
+    [
+        ("org=a/b&repo=c&ref=master", 400),
+        ("org=a&repo=&ref=master", 400),
+        ("org=a&repo=b&ref=", 400),
+        ("org=a&repo=b", 400),
+    ]
+)
+async def test_nbviewer_check_invalid(app, query, status_code):
+    r = await async_requests.get(app.url + "/_nbviewer?" + query)
+    assert r.status_code == status_code
+
+
+@skip_remote
+async def test_nbviewer_check_rate_limit(app):
+    limiter = RateLimiter(limits={'page': {'rate': 0.01, 'burst': 1}})
+    url = app.url + "/_nbviewer?org=a/b&repo=c&ref=master"
+    with mock.patch.object(RateLimiter, '_instance', limiter):
+        r = await async_requests.get(url)
+        assert r.status_code == 400
+        r = await async_requests.get(url)
+        assert r.status_code == 429
+        assert 'Retry-After' in r.headers
+
+
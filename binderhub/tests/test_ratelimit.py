@@ -0,0 +1,123 @@
+"""Tests for rate limits"""
+from unittest import mock
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application
+from traitlets import TraitError
+
+from binderhub.base import APIHandler
+from binderhub.ratelimit import RATE_LIMITED, RateLimiter, RateLimitExceeded
+
+
+def test_token_bucket():
+    limiter = RateLimiter(limits={'launch': {'rate': 0.5, 'burst': 2}})
+    now = 1000
+    with mock.patch.object(limiter, '_now', lambda: now):
+        limiter.take('launch', 'a')
+        limiter.take('launch', 'a')
+        before = RATE_LIMITED.labels('launch')._value.get()
+        with pytest.raises(RateLimitExceeded) as exc_info:
+            limiter.take('launch', 'a')
+        assert exc_info.value.status_code == 429
+        assert exc_info.value.retry_after == 2
+        assert RATE_LIMITED.labels('launch')._value.get() == before + 1
+
+        # other clients and buckets are independent
+        limiter.take('launch', 'b')
+        limiter.take('build', 'a')
+
+        # refilled at `rate`
+        now += 2
+        limiter.take('launch', 'a')
+        with pytest.raises(RateLimitExceeded):
+            limiter.take('launch', 'a')
+        # up to `burst`
+        now += 100
+        limiter.take('launch', 'a')
+        limiter.take('launch', 'a')
+        with pytest.raises(RateLimitExceeded):
+            limiter.take('launch', 'a')
+
+
+def test_take_several():
+    limiter = RateLimiter(limits={'status': {'rate': 1, 'burst': 10}})
+    now = 1000
+    with mock.patch.object(limiter, '_now', lambda: now):
+        limiter.take('status', 'a', 6)
+        with pytest.raises(RateLimitExceeded) as exc_info:
+            limiter.take('status', 'a', 6)
+        assert exc_info.value.retry_after == 2
+        limiter.take('status', 'a', 4)
+        # at most a full bucket
+        now += 100
+        limiter.take('status', 'a', 20)
+        with pytest.raises(RateLimitExceeded):
+            limiter.take('status', 'a')
+
+
+def test_bounded_memory():
+    limiter = RateLimiter(limits={'launch': {'rate': 1, 'burst': 1}}, max_clients=10)
+    for i in range(100):
+        limiter.take('launch', str(i))
+    assert len(limiter.buckets['launch']) == 10
+
+
+@pytest.mark.parametrize(
+    "limits",
+    [
+        {'launch': {'rate': 1}},
+        {'launch': {'rate': 0, 'burst': 10}},
+        {'launch': 10},
+    ],
+)
+def test_invalid_limits(limits):
+    with pytest.raises(TraitError):
+        RateLimiter(limits=limits)
+
+
+@pytest.mark.parametrize(
+    "key, remote_ip, client",
+    [
+        ('ip', '10.1.2.3', '10.1.2.3'),
+        ('network', '10.1.2.3', '10.1.2.0/24'),
+        ('network', '2001:db8::1', '2001:db8::/64'),
+        # no authentication
+        ('user', '10.1.2.3', '10.1.2.3'),
+    ],
+)
+def test_client_key(key, remote_ip, client):
+    limiter = RateLimiter(key=key)
+    handler = mock.Mock(settings={'auth_enabled': False})
+    handler.request.remote_ip = remote_ip
+    assert limiter.client_key(handler) == client
+
+
+class LimitedHandler(APIHandler):
+    def get(self):
+        self.check_rate_limit('page')
+        self.write({'ok': True})
+
+
+async def test_too_many_requests():
+    limiter = RateLimiter(limits={'page': {'rate': 0.01, 'burst': 1}})
+    app = Application(
+        [(r"/limited", LimitedHandler)],
+        auth_enabled=False,
+    )
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    with mock.patch.object(RateLimiter, '_instance', limiter):
+        url = f"http://127.0.0.1:{port}/limited"
+        r = await AsyncHTTPClient().fetch(url)
+        assert r.code == 200
+        with pytest.raises(HTTPClientError) as e:
+            await AsyncHTTPClient().fetch(url)
+        r = e.value.response
+        assert r.code == 429
+        assert int(r.headers['Retry-After']) >= 99
+        assert b"Too many requests" in r.body
+    server.stop()
@@ -0,0 +1,60 @@
+"""Tests for repository authorization"""
+import io
+import json
+from unittest import mock
+from urllib.parse import parse_qs
+
+import pytest
+from oauthlib.oauth2 import InsecureTransportError
+from tornado.httpclient import HTTPResponse
+
+from binderhub.httpclient import OAuthHTTPClient
+from binderhub.repoauth import OAuth2Client
+
+HOST = {
+    'client_id': 'binderhub',
+    'client_secret': 'secret',
+    'oauth_authorize_url': 'https://rdm.test.jp/oauth2/authorize',
+    'oauth_token_url': 'https://rdm.test.jp/oauth2/token',
+    'scope': ['osf.full_read'],
+}
+
+
+async def test_fetch_token():
+    requests = []
+
+    async def fetch(self, req, **kwargs):
+        requests.append(req)
+        body = json.dumps({
+            'access_token': 'abc',
+            'token_type': 'Bearer',
+            'expires_in': 3600,
+            'scope': 'osf.full_read',
+        })
+        return HTTPResponse(req, 200, buffer=io.BytesIO(body.encode('utf8')))
+
+    client = OAuth2Client(HOST)
+    with mock.patch.object(OAuthHTTPClient, 'fetch', fetch):
+        token = await client.fetch_token(
+            'https://binder.test.jp/repoauth/callback?code=xyz&state=s1',
+            'https://binder.test.jp/',
+        )
+    assert token['access_token'] == 'abc'
+    assert 'expires_at' in token
+
+    req, = requests
+    assert req.method == 'POST'
+    assert req.url == HOST['oauth_token_url']
+    body = parse_qs(req.body.decode('utf8'))
+    assert body['code'] == ['xyz']
+    assert body['client_id'] == ['binderhub']
+    assert body['client_secret'] == ['secret']
+    assert body['redirect_uri'] == ['https://binder.test.jp/repoauth/callback']
+
+
+async def test_fetch_token_insecure():
+    client = OAuth2Client(dict(HOST, oauth_token_url='http://rdm.test.jp/oauth2/token'))
+    with pytest.raises(InsecureTransportError):
+        await client.fetch_token(
+            'https://binder.test.jp/repoauth/callback?code=xyz', 'https://binder.test.jp/'
+        )
@@ -1,10 +1,19 @@
-from unittest import TestCase
+import asyncio
+import io
+import json
+import subprocess
+import time
+from unittest import TestCase, mock
 from urllib.parse import quote
 
 import pytest
 import re
+from tornado.httpclient import HTTPError, HTTPRequest, HTTPResponse
+from tornado.httputil import HTTPHeaders
 from tornado.ioloop import IOLoop
 
+from binderhub import utils
+from binderhub.upstream import CircuitOpenError, Upstream
 from binderhub.repoproviders import (
     DataverseProvider,
     FigshareProvider,
@@ -15,6 +24,7 @@ from binderhub.repoproviders import (
     HydroshareProvider,
     ZenodoProvider,
     RDMProvider,
+    RepoProvider,
     WEKO3Provider,
     strip_suffix,
     tokenize_spec,
@@ -299,6 +309,125 @@ def test_github_ref(repo, unresolved_ref, resolved_ref):
     assert resolved_spec == f"{repo}/{ref}"
 
 
+def _github_response(url, sha, etag, code=200):
+    response = HTTPResponse(HTTPRequest(url), code, headers=HTTPHeaders({'ETag': etag}))
+    response.buffer = io.BytesIO(json.dumps({'sha': sha}).encode('utf8'))
+    return response
+
+
+async def test_github_ref_staleness():
+    sha = 'f7f3ff6d1bf708bdc12e5f10e18b2a90a4795603'
+    requests = []
+
+    async def mock_request(self, api_url, etag=None, low_priority=False):
+        requests.append((api_url, etag))
+        if etag:
+            return _github_response(api_url, sha, etag, code=304)
+        return _github_response(api_url, sha, 'W/"abc"')
+
+    with mock.patch.object(GitHubRepoProvider, 'cache', utils.Cache(8)), \
+            mock.patch.object(GitHubRepoProvider, 'ref_hits', utils.Cache(8)), \
+            mock.patch.object(GitHubRepoProvider, 'github_api_request', mock_request):
+        spec = 'jupyterhub/zero-to-jupyterhub-k8s/master'
+        for _ in range(3):
+            provider = GitHubRepoProvider(spec=spec, max_ref_staleness=60)
+            assert await provider.get_resolved_ref() == sha
+        # only the first lookup makes a request
+        assert len(requests) == 1
+
+        # without max_ref_staleness, lookups are revalidated with the etag
+        provider = GitHubRepoProvider(spec=spec)
+        assert await provider.get_resolved_ref() == sha
+        assert requests[-1][1] == 'W/"abc"'
+
+        # hot refs are revalidated in the background
+        n = await GitHubRepoProvider.refresh_hot_refs(None, 10)
+        assert n == 1
+        assert len(requests) == 3
+        assert GitHubRepoProvider.ref_hits.get(provider.get_commit_api_url())['hits'] == 2
+
+        # but not if they have been validated recently
+        n = await GitHubRepoProvider.refresh_hot_refs(None, 10, min_age=60)
+        assert n == 0
+
+
+def test_github_credential_pool():
+    provider = GitHubRepoProvider(
+        spec='jupyterhub/zero-to-jupyterhub-k8s/master',
+        access_token='secret-a',
+        access_tokens=['secret-a', 'secret-b'],
+        client_id='',
+        client_secret='',
+    )
+    pool = provider.credential_pool
+    # the pool is shared by providers with the same credentials
+    assert GitHubRepoProvider(
+        spec='jupyterhub/binderhub/master',
+        access_token='secret-a',
+        access_tokens=['secret-a', 'secret-b'],
+        client_id='',
+        client_secret='',
+    ).credential_pool is pool
+    assert [c['token'] for c in pool.credentials] == ['secret-a', 'secret-b']
+    # built once, not on every request
+    with mock.patch.object(GitHubRepoProvider, '_credentials') as credentials:
+        assert provider.credential_pool is pool
+    assert not credentials.called
+    # names don't leak tokens
+    assert all('secret-a' not in c['name'] for c in pool.credentials)
+
+    reset = str(int(time.time()) + 600)
+    a, b = pool.credentials
+    pool.update(a, {'x-ratelimit-remaining': '100', 'x-ratelimit-limit': '5000', 'x-ratelimit-reset': reset})
+    # unused credentials are tried first
+    assert pool.choose() is b
+    pool.update(b, {'x-ratelimit-remaining': '4000', 'x-ratelimit-limit': '5000', 'x-ratelimit-reset': reset})
+    assert pool.choose() is b
+    assert pool.budget() == (4100, 10000)
+
+    # low-priority requests are throttled when the combined budget is low
+    pool.update(b, {'x-ratelimit-remaining': '50', 'x-ratelimit-limit': '5000', 'x-ratelimit-reset': reset})
+    assert pool.choose() is a
+    with pytest.raises(ValueError):
+        pool.choose(low_priority=True, low_priority_reserve=0.2)
+
+    pool.update(a, {'x-ratelimit-remaining': '0', 'x-ratelimit-limit': '5000', 'x-ratelimit-reset': reset})
+    pool.update(b, {'x-ratelimit-remaining': '0', 'x-ratelimit-limit': '5000', 'x-ratelimit-reset': reset})
+    with pytest.raises(ValueError, match="rate limit exceeded"):
+        pool.choose()
+
+    # budgets are restored after the reset time
+    pool.update(b, {'x-ratelimit-remaining': '0', 'x-ratelimit-limit': '5000', 'x-ratelimit-reset': '0'})
+    assert pool.choose() is b
+
+
+async def test_github_rate_limit_exceeded():
+    provider = GitHubRepoProvider(
+        spec='jupyterhub/zero-to-jupyterhub-k8s/master',
+        access_token='secret-c',
+        access_tokens=[],
+        client_id='',
+        client_secret='',
+    )
+    reset = str(int(time.time()) + 600)
+
+    async def rate_limited(request):
+        response = HTTPResponse(
+            request,
+            403,
+            headers=HTTPHeaders({
+                'x-ratelimit-remaining': '0',
+                'x-ratelimit-limit': '5000',
+                'x-ratelimit-reset': reset,
+            }),
+        )
+        raise HTTPError(403, response=response)
+
+    with mock.patch.object(provider, 'fetch', rate_limited):
+        with pytest.raises(ValueError, match="Try again in 10 minutes"):
+            await provider.github_api_request('https://api.github.com/repos/a/b/commits/master')
+
+
 def test_not_banned():
     provider = GitHubRepoProvider(
         spec='jupyterhub/zero-to-jupyterhub-k8s/v0.4',
@@ -493,6 +622,42 @@ def test_git_ref(url, unresolved_ref, resolved_ref):
     assert resolved_spec == quote(url, safe="") + f"/{ref}"
 
 
+async def test_git_ls_remote_cache(tmpdir):
+    repo = str(tmpdir.join("repo"))
+    git = ["git", "-C", repo, "-c", "user.name=test", "-c", "user.email=test@example.com"]
+    subprocess.check_call(["git", "init", "-q", repo])
+    subprocess.check_call(git + ["commit", "-q", "--allow-empty", "-m", "first"])
+    subprocess.check_call(git + ["tag", "first"])
+    subprocess.check_call(git + ["checkout", "-q", "-b", "feature"])
+    subprocess.check_call(git + ["commit", "-q", "--allow-empty", "-m", "second"])
+    first = subprocess.check_output(git + ["rev-parse", "first"], text=True).strip()
+    second = subprocess.check_output(git + ["rev-parse", "feature"], text=True).strip()
+
+    with mock.patch.object(GitRepoProvider, 'ls_remote_cache', utils.Cache(8)):
+        provider = GitRepoProvider(spec="{}/first".format(quote(repo, safe='')))
+        assert await provider.get_resolved_ref() == first
+
+        # other refs of the same repo are resolved from the cached listing
+        with mock.patch.object(GitRepoProvider, '_run_ls_remote') as run_ls_remote:
+            provider = GitRepoProvider(spec="{}/feature".format(quote(repo, safe='')))
+            assert await provider.get_resolved_ref() == second
+        assert not run_ls_remote.called
+
+        # refs missing from the cached listing are looked up again
+        subprocess.check_call(git + ["tag", "new"])
+        provider = GitRepoProvider(spec="{}/new".format(quote(repo, safe='')))
+        assert await provider.get_resolved_ref() == second
+        provider = GitRepoProvider(spec="{}/nosuchref".format(quote(repo, safe='')))
+        assert await provider.get_resolved_ref() is None
+
+    with mock.patch.object(GitRepoProvider, 'ls_remote_cache', utils.Cache(8)):
+        provider = GitRepoProvider(
+            spec="{}/first".format(quote(str(tmpdir.join("nosuchrepo")), safe=''))
+        )
+        with pytest.raises(RuntimeError):
+            await provider.get_resolved_ref()
+
+
 @pytest.mark.parametrize(
     "unresolved_ref, resolved_ref",
     [
@@ -525,6 +690,85 @@ def test_gitlab_ref(unresolved_ref, resolved_ref):
     assert resolved_spec == quote(namespace, safe='') + f'/{ref}'
 
 
+async def test_gitlab_ref_cache():
+    sha = 'b3344b7f17c335a817c5d7608c5e47fd7cabc023'
+    requests = []
+
+    class MockClient:
+        async def fetch(self, url, headers=None, **kwargs):
+            requests.append((url, headers))
+            if 'nosuchref' in url:
+                raise HTTPError(404)
+            if headers.get('If-None-Match') == 'W/"abc"':
+                raise HTTPError(304, response=_github_response(url, sha, 'W/"abc"', code=304))
+            response = _github_response(url, sha, 'W/"abc"')
+            response.buffer = io.BytesIO(json.dumps({'id': sha}).encode('utf8'))
+            return response
+
+    namespace = quote("gitlab-org/gitlab-foss", safe="")
+    with mock.patch.object(GitLabRepoProvider, 'cache', utils.Cache(8)), \
+            mock.patch.object(GitLabRepoProvider, 'cache_404', utils.Cache(8, max_age=300)), \
+            mock.patch.object(RepoProvider, 'get_http_client', lambda self: MockClient()):
+        provider = GitLabRepoProvider(spec=f"{namespace}/v10.0.6", private_token='secret')
+        assert await provider.get_resolved_ref() == sha
+        assert requests[-1][1] == {}
+        # auth params are not part of the cache key
+        assert 'secret' not in list(GitLabRepoProvider.cache)[0]
+
+        # revalidated with the etag
+        provider = GitLabRepoProvider(spec=f"{namespace}/v10.0.6", private_token='secret')
+        assert await provider.get_resolved_ref() == sha
+        assert requests[-1][1] == {'If-None-Match': 'W/"abc"'}
+        assert len(requests) == 2
+
+        # or not at all, if fresh enough
+        provider = GitLabRepoProvider(spec=f"{namespace}/v10.0.6", max_ref_staleness=60)
+        assert await provider.get_resolved_ref() == sha
+        assert len(requests) == 2
+
+        # 404s are cached
+        for _ in range(2):
+            provider = GitLabRepoProvider(spec=f"{namespace}/nosuchref")
+            assert await provider.get_resolved_ref() is None
+        assert len(requests) == 3
+
+        # commit shas don't need a request at all
+        provider = GitLabRepoProvider(spec=f"{namespace}/{sha}")
+        assert await provider.get_resolved_ref() == sha
+        assert len(requests) == 3
+
+
+async def test_gist_ref_cache():
+    versions = ['7daa381aae8409bfe28193e2ed8f767c26371237', 'a' * 40]
+    requests = []
+
+    async def mock_request(self, api_url, etag=None, low_priority=False):
+        requests.append((api_url, etag))
+        if etag:
+            return _github_response(api_url, None, etag, code=304)
+        response = _github_response(api_url, None, 'W/"abc"')
+        response.buffer = io.BytesIO(json.dumps({
+            'public': True,
+            'history': [{'version': v} for v in versions],
+        }).encode('utf8'))
+        return response
+
+    with mock.patch.object(GistRepoProvider, 'cache', utils.Cache(8)), \
+            mock.patch.object(GistRepoProvider, 'github_api_request', mock_request):
+        spec = 'mariusvniekerk/8a658f7f63b13768d1e75fa2464f5092'
+        provider = GistRepoProvider(spec=spec)
+        assert await provider.get_resolved_ref() == versions[0]
+        provider = GistRepoProvider(spec=spec + '/master')
+        assert await provider.get_resolved_ref() == versions[0]
+        assert requests[-1][1] == 'W/"abc"'
+        assert len(requests) == 2
+
+        # known versions are immutable
+        provider = GistRepoProvider(spec=spec + '/' + versions[1])
+        assert await provider.get_resolved_ref() == versions[1]
+        assert len(requests) == 2
+
+
 @pytest.mark.github_api
 @pytest.mark.parametrize(
     "owner, gist_id, unresolved_ref, resolved_ref",
@@ -575,3 +819,154 @@ def test_gist_secret():
 
     provider = GistRepoProvider(spec=spec, allow_secret_gist=True)
     assert IOLoop().run_sync(provider.get_resolved_ref) is not None
+
+
+async def test_doi_record_cache():
+    requests = []
+
+    class MockClient:
+        async def fetch(self, req, **kwargs):
+            requests.append(req.url)
+            await asyncio.sleep(0)
+            if req.url.startswith('https://doi.org/'):
+                target = 'https://dataverse.harvard.edu/dataset.xhtml?persistentId=doi:10.7910/DVN/TJCLKP'
+                return HTTPResponse(req, 200, effective_url=target)
+            body = json.dumps({'status': 'OK', 'data': {
+                'id': 3035124,
+                'identifier': 'DVN/TJCLKP',
+                'authority': '10.7910',
+                'persistentUrl': 'https://doi.org/10.7910/DVN/TJCLKP',
+                'latestVersion': {'versionNumber': 3, 'versionMinorNumber': 0},
+            }})
+            return HTTPResponse(req, 200, buffer=io.BytesIO(body.encode('utf8')))
+
+    with mock.patch.object(DataverseProvider, 'record_cache', utils.Cache(8)), \
+            mock.patch.object(DataverseProvider, 'redirect_cache', utils.Cache(8)), \
+            mock.patch.object(RepoProvider, 'get_http_client', lambda self: MockClient()):
+        # concurrent lookups share one resolution
+        providers = [DataverseProvider(spec='10.7910/DVN/TJCLKP') for _ in range(3)]
+        refs = await asyncio.gather(*(p.get_resolved_ref() for p in providers))
+        assert refs == ['3035124.v3.0'] * 3
+        assert len(requests) == 2
+        for provider in providers:
+            assert await provider.get_resolved_spec() == '10.7910/DVN/TJCLKP'
+            assert provider.get_build_slug() == 'dataverse-dvn-2ftjclkp'
+
+        # cached records are reused
+        provider = DataverseProvider(spec='10.7910/DVN/TJCLKP')
+        assert await provider.get_resolved_ref() == '3035124.v3.0'
+        assert len(requests) == 2
+
+        # expired records are resolved again, reusing the redirect
+        provider = DataverseProvider(spec='10.7910/DVN/TJCLKP', record_cache_ttl=0)
+        assert await provider.get_resolved_ref() == '3035124.v3.0'
+        assert len(requests) == 3
+        assert not requests[-1].startswith('https://doi.org/')
+
+    assert HydroshareProvider().record_cache_ttl < DataverseProvider().record_cache_ttl
+
+
+async def test_rdm_content_ref():
+    api = 'https://api.some.host.test.jp/v2/'
+    hosts = [{'hostname': ['https://some.host.test.jp'], 'api': api}]
+    sizes = {'a.txt': 10}
+    requests = []
+
+    def folder(path, href):
+        return {'attributes': {'kind': 'folder', 'provider': 'osfstorage', 'materialized_path': path},
+                'relationships': {'files': {'links': {'related': {'href': href}}}}}
+
+    def file(path, size):
+        return {'attributes': {'kind': 'file', 'provider': 'osfstorage', 'materialized_path': path,
+                               'size': size, 'date_modified': '2021-01-01T00:00:00',
+                               'extra': {'hashes': {'sha256': 'x'}}}}
+
+    pages = {
+        api + 'nodes/pwad2/files/osfstorage/': {
+            'data': [folder('/testdir/', api + 'testdir'), folder('/other/', api + 'other')],
+            'links': {'next': api + 'page2'},
+        },
+        api + 'page2': {'data': [file('/README.md', 1)], 'links': {'next': None}},
+        api + 'testdir': {'data': [file('/testdir/b.txt', 5)], 'links': {}},
+    }
+
+    class MockClient:
+        async def fetch(self, req, **kwargs):
+            requests.append((req.url, req.headers.get('Authorization')))
+            if req.url == api + 'testdir':
+                data = pages[req.url]['data'] + [file('/testdir/a.txt', sizes['a.txt'])]
+                body = dict(pages[req.url], data=data)
+            else:
+                body = pages[req.url]
+            return HTTPResponse(req, 200, buffer=io.BytesIO(json.dumps(body).encode('utf8')))
+
+    spec = quote('https://some.host.test.jp/pwad2/files/osfstorage/testdir', safe='') + '/master'
+    with mock.patch.object(RepoProvider, 'get_http_client', lambda self: MockClient()):
+        provider = RDMProvider(spec=spec, hosts=hosts, user_access_token='secret')
+        ref = await provider.get_resolved_ref()
+        assert re.match(r'^[0-9a-f]{40}$', ref)
+        # only folders leading to the target folder are listed
+        assert [url for url, _ in requests] == [
+            api + 'nodes/pwad2/files/osfstorage/', api + 'page2', api + 'testdir'
+        ]
+        assert requests[0][1] == 'Bearer secret'
+
+        # unchanged contents resolve to the same ref
+        provider = RDMProvider(spec=spec, hosts=hosts)
+        assert await provider.get_resolved_ref() == ref
+
+        sizes['a.txt'] = 11
+        provider = RDMProvider(spec=spec, hosts=hosts)
+        assert await provider.get_resolved_ref() != ref
+
+
+async def test_weko3_content_ref():
+    hosts = [{'hostname': ['https://weko3.test.jp']}]
+    record = {'revision': 3, 'updated': '2021-01-01T00:00:00'}
+
+    class MockClient:
+        async def fetch(self, req, **kwargs):
+            assert req.url == 'https://weko3.test.jp/api/records/12'
+            return HTTPResponse(req, 200, buffer=io.BytesIO(json.dumps(record).encode('utf8')))
+
+    spec = quote('https://weko3.test.jp/records/12', safe='') + '/'
+    with mock.patch.object(RepoProvider, 'get_http_client', lambda self: MockClient()):
+        ref = await WEKO3Provider(spec=spec, hosts=hosts).get_resolved_ref()
+        assert await WEKO3Provider(spec=spec, hosts=hosts).get_resolved_ref() == ref
+        record['revision'] = 4
+        assert await WEKO3Provider(spec=spec, hosts=hosts).get_resolved_ref() != ref
+        # unknown hosts are never requested, and get a unique ref
+        spec = quote('https://other.test.jp/records/12', safe='') + '/'
+        assert await WEKO3Provider(spec=spec, hosts=hosts).get_resolved_ref() != ref
+
+
+async def test_stale_ref_if_error():
+    sha = 'b3344b7f17c335a817c5d7608c5e47fd7cabc023'
+    status = [200]
+
+    class MockClient:
+        async def fetch(self, url, headers=None, **kwargs):
+            if status[0] != 200:
+                raise HTTPError(status[0])
+            response = _github_response(url, sha, 'W/"abc"')
+            response.buffer = io.BytesIO(json.dumps({'id': sha}).encode('utf8'))
+            return response
+
+    upstream = Upstream(name='GitLab', failure_threshold=2)
+    with mock.patch.object(GitLabRepoProvider, 'cache', utils.Cache(8)), \
+            mock.patch.object(GitLabRepoProvider, 'get_upstream', lambda self: upstream), \
+            mock.patch.object(RepoProvider, 'get_http_client', lambda self: MockClient()):
+        namespace = quote("gitlab-org/gitlab-foss", safe="")
+        provider = GitLabRepoProvider(spec=f"{namespace}/v10.0.6")
+        assert await provider.get_resolved_ref() == sha
+
+        # cached refs are served while GitLab fails
+        status[0] = 503
+        for _ in range(3):
+            provider = GitLabRepoProvider(spec=f"{namespace}/v10.0.6")
+            assert await provider.get_resolved_ref() == sha
+
+        # uncached refs fail fast
+        provider = GitLabRepoProvider(spec=f"{namespace}/v10.0.7")
+        with pytest.raises(CircuitOpenError):
+            await provider.get_resolved_ref()
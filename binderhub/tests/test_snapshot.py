@@ -0,0 +1,46 @@
+"""Tests for cache snapshots"""
+import time
+from unittest import mock
+
+from binderhub.snapshot import CacheSnapshot
+from binderhub.utils import Cache
+
+
+def test_snapshot_roundtrip(tmpdir):
+    path = str(tmpdir.join("snapshot.json.gz"))
+    snapshot = CacheSnapshot(path=path)
+    cache = Cache(8)
+    cache.set("https://api.github.com/repos/a/b/commits/master", {"etag": "W/1", "sha": "abc"})
+    cache_404 = Cache(8, max_age=300)
+    cache_404.set("https://api.github.com/repos/a/b/commits/nosuchref", True)
+    snapshot.save({"github": cache, "github_404": cache_404})
+
+    restored = Cache(8)
+    restored_404 = Cache(8, max_age=300)
+    n = snapshot.load({"github": restored, "github_404": restored_404, "other": Cache()})
+    assert n == 2
+    assert restored.get("https://api.github.com/repos/a/b/commits/master")["sha"] == "abc"
+    assert restored_404.get("https://api.github.com/repos/a/b/commits/nosuchref")
+
+    # entries older than their cache's max_age are dropped
+    later = time.time() + 600
+    with mock.patch("binderhub.snapshot.time.time", lambda: later):
+        restored = Cache(8)
+        restored_404 = Cache(8, max_age=300)
+        assert snapshot.load({"github": restored, "github_404": restored_404}) == 1
+        assert len(restored_404) == 0
+
+    # snapshots older than max_age are ignored entirely
+    later = time.time() + 7200
+    with mock.patch("binderhub.snapshot.time.time", lambda: later):
+        assert snapshot.load({"github": Cache(8)}) == 0
+
+
+def test_snapshot_missing_or_invalid(tmpdir):
+    path = tmpdir.join("snapshot.json.gz")
+    snapshot = CacheSnapshot(path=str(path))
+    assert snapshot.load({"github": Cache()}) == 0
+    path.write("not gzip")
+    assert snapshot.load({"github": Cache()}) == 0
+    # disabled
+    CacheSnapshot().save({"github": Cache()})
@@ -0,0 +1,47 @@
+"""Tests for startup profiling"""
+import sys
+
+from binderhub import startup
+
+
+def test_profile_startup(tmp_path, monkeypatch):
+    (tmp_path / "startup_test_pkg").mkdir()
+    (tmp_path / "startup_test_pkg" / "__init__.py").write_text(
+        "import time\ntime.sleep(0.02)\nfrom . import sub\n"
+    )
+    (tmp_path / "startup_test_pkg" / "sub.py").write_text(
+        "import time\ntime.sleep(0.05)\n"
+    )
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    profile = startup.start_profile()
+    try:
+        import startup_test_pkg
+        startup.mark("importing")
+        startup.mark("nothing")
+    finally:
+        profile.uninstall()
+        startup._profile = None
+        sys.modules.pop("startup_test_pkg", None)
+        sys.modules.pop("startup_test_pkg.sub", None)
+
+    # the real loader is left on the module
+    assert not isinstance(startup_test_pkg.__loader__, startup._TimedLoader)
+    own, cumulative = profile.imports["startup_test_pkg"]
+    sub_own, sub_cumulative = profile.imports["startup_test_pkg.sub"]
+    assert sub_own >= 0.05
+    assert 0.02 <= own < sub_own
+    assert cumulative >= own + sub_own
+    assert [step for step, duration in profile.steps] == ["importing", "nothing"]
+    assert profile.steps[0][1] >= 0.07
+
+    report = profile.report()
+    assert report[0].startswith("Startup took")
+    assert any(line.endswith("  startup_test_pkg.sub") for line in report)
+
+
+def test_no_profile():
+    assert startup._profile is None
+    # no-ops
+    startup.mark("step")
+    startup.report(None)
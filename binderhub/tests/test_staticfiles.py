@@ -0,0 +1,89 @@
+"""Tests for serving static files"""
+import gzip
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application
+
+from binderhub.staticfiles import StaticFileHandler, parse_accept_encoding
+
+
+def test_parse_accept_encoding():
+    assert parse_accept_encoding("") == set()
+    assert parse_accept_encoding("gzip, deflate, br") == {"gzip", "deflate", "br"}
+    assert parse_accept_encoding("br;q=0, GZIP;q=0.5") == {"gzip"}
+
+
+@pytest.fixture
+def static_url(io_loop, tmpdir, request):
+    css = "body { color: red; }\n" * 100
+    tmpdir.join("index.css").write(css)
+    tmpdir.mkdir("images").join("small.svg").write("<svg/>")
+    # compressed at build time
+    tmpdir.join("bundle.js").write("var x = 1;\n" * 100)
+    tmpdir.join("bundle.js.gz").write_binary(gzip.compress(b"prebuilt"))
+    StaticFileHandler.preload(str(tmpdir))
+
+    app = Application(
+        [], static_path=str(tmpdir), static_handler_class=StaticFileHandler
+    )
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    request.addfinalizer(server.stop)
+    return f"http://127.0.0.1:{port}/static/"
+
+
+async def fetch(url, **headers):
+    try:
+        return await AsyncHTTPClient().fetch(
+            url, headers=headers, decompress_response=False
+        )
+    except HTTPClientError as e:
+        return e.response
+
+
+async def test_precompressed(static_url, tmpdir):
+    css = tmpdir.join("index.css").read_binary()
+
+    r = await fetch(static_url + "index.css")
+    assert r.code == 200
+    assert r.body == css
+    assert "Content-Encoding" not in r.headers
+    assert r.headers["Vary"] == "Accept-Encoding"
+
+    r = await fetch(static_url + "index.css", **{"Accept-Encoding": "gzip, deflate"})
+    assert r.code == 200
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert r.headers["Content-Type"] == "text/css"
+    assert len(r.body) < len(css)
+    assert gzip.decompress(r.body) == css
+
+    # the compressed response has its own ETag
+    r2 = await fetch(
+        static_url + "index.css",
+        **{"Accept-Encoding": "gzip", "If-None-Match": r.headers["Etag"]},
+    )
+    assert r2.code == 304
+
+    # variants on disk are preferred
+    r = await fetch(static_url + "bundle.js", **{"Accept-Encoding": "gzip"})
+    assert r.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(r.body) == b"prebuilt"
+
+    # too small to compress
+    r = await fetch(static_url + "images/small.svg", **{"Accept-Encoding": "gzip"})
+    assert r.body == b"<svg/>"
+    assert "Content-Encoding" not in r.headers
+    assert "Vary" not in r.headers
+
+
+async def test_immutable(static_url):
+    r = await fetch(static_url + "index.css?v=abc")
+    assert r.code == 200
+    assert "immutable" in r.headers["Cache-Control"]
+
+    r = await fetch(static_url + "index.css")
+    assert "Cache-Control" not in r.headers
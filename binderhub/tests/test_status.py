@@ -0,0 +1,131 @@
+"""Tests for the batch repo status API"""
+import asyncio
+import json
+from unittest import mock
+
+import pytest
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.web import Application
+
+from binderhub.builder import _get_image_name
+from binderhub.ratelimit import RateLimiter
+from binderhub.repoproviders import FakeProvider
+from binderhub.status import RepoStatusHandler
+
+
+class SlowProvider(FakeProvider):
+    running = 0
+    max_running = 0
+
+    async def get_resolved_ref(self):
+        cls = type(self)
+        cls.running += 1
+        cls.max_running = max(cls.max_running, cls.running)
+        await asyncio.sleep(0.05)
+        cls.running -= 1
+        if self.spec.endswith('/missing'):
+            return None
+        return self.spec.rsplit('/', 1)[-1]
+
+    def get_build_slug(self):
+        return self.spec.rsplit('/', 1)[0].replace('/', '')
+
+
+class FakeRegistry:
+    def __init__(self, images):
+        self.images = images
+        self.lookups = []
+
+    async def get_image_manifest(self, image, tag):
+        self.lookups.append((image, tag))
+        if '%s:%s' % (image, tag) in self.images:
+            return {'image': image, 'tag': tag}
+        return None
+
+
+def image_name(spec):
+    return _get_image_name(SlowProvider(spec=spec), spec.rsplit('/', 1)[-1], 'binder-')
+
+
+@pytest.fixture
+def status_url(io_loop, request):
+    registry = FakeRegistry({image_name('org/built/abc')})
+    settings = {
+        'auth_enabled': False,
+        'repo_providers': {'gh': SlowProvider},
+        'traitlets_config': None,
+        'image_prefix': 'binder-',
+        'use_registry': True,
+        'registry': registry,
+        'status_api_concurrency': 2,
+        'status_api_max_repos': 10,
+    }
+    app = Application([(r"/api/status", RepoStatusHandler)], **settings)
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    request.addfinalizer(server.stop)
+    return f"http://127.0.0.1:{port}/api/status", registry
+
+
+async def test_status(status_url):
+    url, registry = status_url
+    repos = [
+        "gh/org/built/abc",
+        "gh/org/notbuilt/def",
+        "gh/org/repo/missing",
+        "nope/org/repo/main",
+        "gh/org/built2/abc",
+    ]
+    r = await AsyncHTTPClient().fetch(
+        url, method="POST", body=json.dumps({"repos": repos})
+    )
+    results = json.loads(r.body)['repos']
+    assert [result['repo'] for result in results] == repos
+    assert results[0] == {
+        'repo': "gh/org/built/abc",
+        'ref': 'abc',
+        'image': image_name('org/built/abc'),
+        'image_found': True,
+    }
+    assert results[1]['image_found'] is False
+    assert 'Could not resolve ref' in results[2]['error']
+    assert 'No provider found' in results[3]['error']
+    assert results[4]['image_found'] is False
+    # bounded parallelism
+    assert SlowProvider.max_running == 2
+
+    # the same with GET, built images are cached
+    lookups = len(registry.lookups)
+    r = await AsyncHTTPClient().fetch(url + "?repo=gh/org/built/abc&repo=gh/org/notbuilt/def")
+    results = json.loads(r.body)['repos']
+    assert [result['image_found'] for result in results] == [True, False]
+    assert registry.lookups[lookups:] == [tuple(image_name('org/notbuilt/def').split(':'))]
+
+
+async def test_status_invalid(status_url):
+    url, registry = status_url
+    with pytest.raises(HTTPClientError) as e:
+        await AsyncHTTPClient().fetch(
+            url, method="POST", body=json.dumps({"repos": ["gh/org/repo/main"] * 11})
+        )
+    assert e.value.code == 400
+    assert json.loads(e.value.response.body)['message'] == "At most 10 repos per request"
+
+    with pytest.raises(HTTPClientError) as e:
+        await AsyncHTTPClient().fetch(url, method="POST", body="[]")
+    assert e.value.code == 400
+
+
+async def test_status_rate_limited(status_url):
+    url, registry = status_url
+    limiter = RateLimiter(limits={'status': {'rate': 0.01, 'burst': 3}})
+    with mock.patch.object(RateLimiter, '_instance', limiter):
+        # each repo takes a token
+        await AsyncHTTPClient().fetch(url + "?repo=gh/org/built/abc&repo=gh/org/built2/abc")
+        with pytest.raises(HTTPClientError) as e:
+            await AsyncHTTPClient().fetch(url + "?repo=gh/org/built/abc&repo=gh/org/built2/abc")
+    assert e.value.code == 429
+    assert 'Retry-After' in e.value.response.headers
@@ -0,0 +1,139 @@
+"""Tests for the top-K repo counters"""
+import os
+import random
+
+from prometheus_client import CollectorRegistry
+
+from binderhub.topk import RepoCounter, SpaceSaving
+
+
+def test_space_saving():
+    sketch = SpaceSaving(3)
+    for item in "aaaaabbbbccd":
+        sketch.add(item)
+    # d replaced c, the smallest
+    assert [item for item, count, error in sketch.top()] == ["a", "b", "d"]
+    assert sketch.top()[2] == ("d", 3, 2)
+    assert "c" not in sketch
+
+    assert sketch.resize(2) == ["d"]
+    assert len(sketch) == 2
+
+
+def test_space_saving_heavy_hitters():
+    rng = random.Random(1)
+    # 5 frequent items, and many rare ones
+    stream = [f"hot{i}" for i in range(5)] * 500 + [f"rare{i}" for i in range(5000)]
+    rng.shuffle(stream)
+    sketch = SpaceSaving(50)
+    for item in stream:
+        sketch.add(item)
+    assert len(sketch) == 50
+    assert len(sketch._heap) <= 4 * 50
+    top = sketch.top(5)
+    assert sorted(item for item, count, error in top) == [f"hot{i}" for i in range(5)]
+    for item, count, error in top:
+        assert count - error <= 500 <= count
+
+
+def collect(registry):
+    return {
+        (s.labels['status'], s.labels['provider'], s.labels['repo']): s.value
+        for metric in registry.collect()
+        for s in metric.samples
+    }
+
+
+def test_repo_counter():
+    counter = RepoCounter("test_launch_count", "Launches", top_k=2)
+    registry = CollectorRegistry()
+    registry.register(counter)
+
+    def launch(repo, status="success", provider="GitHub"):
+        counter.labels(status=status, provider=provider, repo=repo).inc()
+
+    for i in range(3):
+        launch("a")
+    launch("a", status="failure")
+    launch("b")
+    launch("b")
+    assert collect(registry) == {
+        ("success", "GitHub", "a"): 3,
+        ("failure", "GitHub", "a"): 1,
+        ("success", "GitHub", "b"): 2,
+        ("success", "GitHub", "other"): 0,
+        ("failure", "GitHub", "other"): 0,
+    }
+
+    # a new repo is not exported until it's counted more than b
+    launch("x", provider="GitLab")
+    launch("x", provider="GitLab")
+    samples = collect(registry)
+    assert ("success", "GitLab", "x") not in samples
+    assert samples[("success", "GitLab", "other")] == 2
+
+    # then it replaces b, whose count moves to other
+    launch("x", provider="GitLab")
+    samples = collect(registry)
+    assert ("success", "GitHub", "b") not in samples
+    assert samples[("success", "GitHub", "other")] == 2
+    # counted since it was exported
+    assert samples[("success", "GitLab", "x")] == 1
+    assert samples[("success", "GitLab", "other")] == 2
+
+    # series only grow
+    rng = random.Random(2)
+    before = samples
+    for i in range(200):
+        launch(rng.choice("abcdefgh"), status=rng.choice(["success", "failure"]))
+        samples = collect(registry)
+        assert len(samples) <= 2 * 2 + 2 + 2
+        for key, value in samples.items():
+            if key in before:
+                assert value >= before[key]
+        before = samples
+    # all launches are counted
+    assert sum(samples.values()) == 4 + 2 + 3 + 200
+
+    counter.top_k = 1
+    assert len([key for key in collect(registry) if key[2] != "other"]) <= 2
+
+
+def test_repo_counter_long_tail():
+    counter = RepoCounter("test_tail_count", "Launches", top_k=10)
+    rng = random.Random(3)
+    hot = [f"hot{i}" for i in range(5)]
+    exported = set()
+    for i in range(20000):
+        # a few frequent repos, and many launched once
+        repo = rng.choice(hot) if i % 4 == 0 else f"rare{i}"
+        counter.labels(status="success", provider="GitHub", repo=repo).inc()
+        # once the sketch is full, only the frequent repos are exported
+        if i >= 1000:
+            exported.update(repo for status, provider, repo in counter.samples())
+    assert exported == set(hot) | {"other"}
+    assert sum(counter.samples().values()) == 20000
+
+
+def test_repo_counter_multiprocess(tmp_path):
+    # two worker processes, one of which exited
+    worker = RepoCounter("test_build_count", "Builds", multiprocess_dir=str(tmp_path))
+    worker.labels(status="success", provider="GitHub", repo="a").inc()
+    worker.labels(status="success", provider="GitHub", repo="b").inc()
+    os.rename(
+        tmp_path / f"repo_counts_test_build_count_{os.getpid()}.json",
+        tmp_path / "repo_counts_test_build_count_1.json",
+    )
+    counter = RepoCounter(
+        "test_build_count", "Builds", top_k=1, multiprocess_dir=str(tmp_path)
+    )
+    counter.labels(status="success", provider="GitHub", repo="a").inc()
+    counter.labels(status="success", provider="GitHub", repo="c").inc()
+
+    registry = CollectorRegistry()
+    registry.register(counter)
+    assert collect(registry) == {
+        ("success", "GitHub", "a"): 2,
+        ("success", "GitHub", "b"): 1,
+        ("success", "GitHub", "other"): 1,
+    }
@@ -0,0 +1,77 @@
+"""Tests for hedged requests and circuit breaking"""
+import asyncio
+
+import pytest
+from tornado.httpclient import HTTPError
+
+from binderhub.upstream import CircuitOpenError, Upstream, is_upstream_error
+
+
+def test_is_upstream_error():
+    assert is_upstream_error(HTTPError(503))
+    assert is_upstream_error(HTTPError(599))
+    assert is_upstream_error(CircuitOpenError())
+    assert is_upstream_error(ConnectionRefusedError())
+    assert not is_upstream_error(HTTPError(304))
+    assert not is_upstream_error(HTTPError(404))
+    assert not is_upstream_error(ValueError())
+
+
+async def test_hedged_request():
+    upstream = Upstream(name="test", hedge_min_samples=2, hedge_min_delay=0.01)
+    calls = []
+
+    async def fetch():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            # the first request is much slower than usual
+            await asyncio.sleep(10)
+            return "slow"
+        return "fast"
+
+    upstream.latencies.extend([0.01, 0.02])
+    result = await asyncio.wait_for(upstream.fetch(fetch), timeout=1)
+    assert result == "fast"
+    assert len(calls) == 2
+
+
+async def test_circuit_breaker():
+    upstream = Upstream(name="test", failure_threshold=2, reset_timeout=60)
+    now = [0]
+    upstream._now = lambda: now[0]
+
+    async def fail():
+        raise HTTPError(502)
+
+    async def ok():
+        return "ok"
+
+    for _ in range(2):
+        with pytest.raises(HTTPError):
+            await upstream.fetch(fail)
+    # fails fast, without calling fetch
+    with pytest.raises(CircuitOpenError) as e:
+        await upstream.fetch(ok)
+    assert "test is currently unavailable" in str(e.value)
+
+    # a failed trial request fails fast again
+    now[0] += 61
+    with pytest.raises(HTTPError):
+        await upstream.fetch(fail)
+    with pytest.raises(CircuitOpenError):
+        await upstream.fetch(ok)
+
+    # a successful trial request closes the circuit
+    now[0] += 61
+    assert await upstream.fetch(ok) == "ok"
+    assert await upstream.fetch(ok) == "ok"
+
+    # responses from a healthy upstream are not failures
+    for _ in range(3):
+        with pytest.raises(HTTPError):
+            await upstream.fetch(lambda: fail_404())
+    assert await upstream.fetch(ok) == "ok"
+
+
+async def fail_404():
+    raise HTTPError(404)
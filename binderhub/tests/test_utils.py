@@ -1,4 +1,5 @@
 import ipaddress
+import random
 from unittest import mock
 
 import pytest
@@ -108,6 +109,30 @@ def test_cache_expiry():
     assert cache._ages['a'] == before_age
 
 
+def test_cache_snapshot_restore():
+    cache = utils.Cache(4, max_age=10)
+    cache.set('a', 1)
+    cache.set(('b', 'c'), {'sha': 'abc'})
+    items = cache.snapshot()
+    assert [key for key, value, age in items] == ['a', ('b', 'c')]
+
+    restored = utils.Cache(4, max_age=10)
+    # keys round-tripped through JSON come back as lists
+    restored.restore([[list(k) if isinstance(k, tuple) else k, v, age] for k, v, age in items])
+    assert restored.get('a') == 1
+    assert restored.get(('b', 'c')) == {'sha': 'abc'}
+
+    # the age of restored items is respected
+    restored = utils.Cache(4, max_age=10)
+    restored.restore(items, elapsed=20)
+    assert len(restored) == 0
+
+    # no max age means no expiry
+    restored = utils.Cache(4)
+    restored.restore(items, elapsed=20)
+    assert restored.get('a') == 1
+
+
 @pytest.mark.parametrize(
     "ip, cidrs, found",
     [
@@ -137,3 +162,74 @@ def test_ip_in_networks(ip, cidrs, found):
 def test_ip_in_networks_invalid():
     with pytest.raises(ValueError):
         utils.ip_in_networks("1.2.3.4", {}, 0)
+
+
+@pytest.mark.parametrize(
+    "ip, found",
+    [
+        ("192.168.1.1", "192.168.1.1/32"),
+        ("192.168.1.2", "192.168.1.0/24"),
+        ("192.168.2.2", "192.168.0.0/16"),
+        ("192.169.2.2", None),
+        ("10.0.0.1", "0.0.0.0/1"),
+        ("2001:db8::1", "2001:db8::/32"),
+        ("2001:db8:1::1", "2001:db8:1::/48"),
+        ("2001:db9::1", None),
+        ("::ffff:192.168.1.1", None),
+    ],
+)
+def test_network_matcher(ip, found):
+    cidrs = [
+        "192.168.1.1/32",
+        "192.168.0.0/16",
+        "192.168.1.0/24",
+        "0.0.0.0/1",
+        "2001:db8:1::/48",
+        "2001:db8::/32",
+    ]
+    networks = {ipaddress.ip_network(cidr): f"message {cidr}" for cidr in cidrs}
+    matcher = utils.NetworkMatcher(networks)
+    for i in range(2):
+        # uncached, then cached
+        match = matcher.match(ip)
+        if found:
+            assert match == (ipaddress.ip_network(found), f"message {found}")
+        else:
+            assert match == False
+    assert match == utils.ip_in_networks(ip, networks)
+
+
+def test_network_matcher_same_as_ip_in_networks():
+    rng = random.Random(1)
+    networks = {}
+    for i in range(2000):
+        version_bits, prefix_lens = rng.choice(
+            [(32, [8, 16, 20, 24, 28, 32]), (128, [32, 48, 64, 128])]
+        )
+        prefix_len = rng.choice(prefix_lens)
+        address = rng.getrandbits(prefix_len) << (version_bits - prefix_len)
+        network = ipaddress.ip_network((address, prefix_len))
+        networks[network] = str(network)
+    matcher = utils.NetworkMatcher(networks)
+
+    network_list = list(networks)
+    for i in range(2000):
+        network = rng.choice(network_list)
+        # addresses in, and around, the banned networks
+        offset = rng.randrange(-256, min(network.num_addresses, 1 << 16) + 256)
+        try:
+            ip = str(network.network_address + offset)
+        except ipaddress.AddressValueError:
+            continue
+        assert matcher.match(ip) == utils.ip_in_networks(ip, networks), ip
+
+
+def test_network_matcher_for_networks():
+    networks = {ipaddress.ip_network("10.0.0.0/8"): "ten"}
+    matcher = utils.NetworkMatcher.for_networks(networks)
+    assert utils.NetworkMatcher.for_networks(networks) is matcher
+    # a new dict of networks is compiled again
+    networks = {ipaddress.ip_network("11.0.0.0/8"): "eleven"}
+    matcher = utils.NetworkMatcher.for_networks(networks)
+    assert matcher.match("11.1.2.3") == (ipaddress.ip_network("11.0.0.0/8"), "eleven")
+    assert matcher.match("10.1.2.3") == False
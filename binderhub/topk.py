@@ -0,0 +1,260 @@
+"""
+Per-repo counters with a bounded number of series, via a heavy-hitters sketch
+"""
+from collections import defaultdict
+import glob
+import heapq
+import json
+import os
+
+from prometheus_client.core import CounterMetricFamily
+
+
+class SpaceSaving:
+    """The Space-Saving heavy-hitters sketch
+
+    Tracks the approximate counts of the (at most) `capacity` most frequent
+    items of a stream, in bounded memory.
+    When a new item arrives and `capacity` items are already tracked,
+    it replaces the item with the smallest count, and inherits that count
+    (as its `error`, the most it may be overestimated by).
+
+    Any item occurring more than total / capacity times is tracked.
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError(f"capacity must be >= 1, got {capacity}")
+        self.capacity = capacity
+        # item: [count, error]
+        self.counters = {}
+        # min-heap of (count, item), with stale entries for updated counts
+        self._heap = []
+
+    def __len__(self):
+        return len(self.counters)
+
+    def __contains__(self, item):
+        return item in self.counters
+
+    def add(self, item, amount=1):
+        """Count `amount` occurrences of item
+
+        Returns the item evicted to make room for it, if any.
+        """
+        evicted = None
+        counter = self.counters.get(item)
+        if counter is None:
+            error = 0
+            if len(self.counters) >= self.capacity:
+                evicted, error = self._pop_min()
+            counter = self.counters[item] = [error, error]
+        counter[0] += amount
+        heapq.heappush(self._heap, (counter[0], item))
+        if len(self._heap) > 4 * self.capacity:
+            self._compact()
+        return evicted
+
+    def min_count(self):
+        """The smallest count, once full
+
+        The most any untracked item may have occurred (0 until full).
+        """
+        if len(self.counters) < self.capacity:
+            return 0
+        while True:
+            count, item = self._heap[0]
+            counter = self.counters.get(item)
+            if counter is not None and counter[0] == count:
+                return count
+            # stale
+            heapq.heappop(self._heap)
+
+    def _pop_min(self):
+        """Remove the item with the smallest count, returning (item, count)"""
+        while True:
+            count, item = heapq.heappop(self._heap)
+            counter = self.counters.get(item)
+            if counter is not None and counter[0] == count:
+                del self.counters[item]
+                return item, count
+
+    def _compact(self):
+        """Drop the stale entries of the heap"""
+        self._heap = [(counter[0], item) for item, counter in self.counters.items()]
+        heapq.heapify(self._heap)
+
+    def resize(self, capacity):
+        """Change the capacity, evicting the smallest items if it shrinks
+
+        Returns the evicted items.
+        """
+        if capacity < 1:
+            raise ValueError(f"capacity must be >= 1, got {capacity}")
+        self.capacity = capacity
+        evicted = []
+        while len(self.counters) > capacity:
+            evicted.append(self._pop_min()[0])
+        return evicted
+
+    def top(self, n=None):
+        """Return [(item, count, error)] of the n items with the largest counts"""
+        items = sorted(self.counters.items(), key=lambda kv: kv[1][0], reverse=True)
+        return [(item, count, error) for item, (count, error) in items[:n]]
+
+
+class _RepoCounterChild:
+    def __init__(self, parent, status, provider, repo):
+        self._parent = parent
+        self._labels = (status, provider, repo)
+
+    def inc(self, amount=1):
+        self._parent.inc(*self._labels, amount=amount)
+
+
+class RepoCounter:
+    """A prometheus counter by status, provider and repo, for the top repos only
+
+    Repos are counted by a SpaceSaving sketch of `sketch_factor` * `top_k` repos.
+    Counts of the (at most) `top_k` repos with the largest guaranteed counts
+    (count - error) are exported with their repo label, all the others with
+    ``repo="other"``, so the number of series is bounded however many repos
+    are launched.
+    Only repos certainly more frequent than any untracked repo are exported,
+    so that a long tail of rarely launched repos doesn't churn through labels.
+
+    Each exported series only grows: a repo's series counts the events since
+    it entered the top repos, and its count moves to "other" if it leaves them.
+
+    Used like a prometheus_client Counter::
+
+        BUILD_COUNT.labels(status='success', provider='GitHub', repo=url).inc()
+
+    Register it with the prometheus registry to export it.
+
+    In prometheus_client's multiprocess mode, each process writes its counts
+    to `multiprocess_dir` and the counts of all processes are added up,
+    so there are at most `top_k` repo series per process.
+    """
+
+    # size of the sketch, relative to top_k
+    sketch_factor = 10
+
+    def __init__(self, name, documentation, top_k=100, multiprocess_dir=None):
+        self.name = name
+        self.documentation = documentation
+        self.multiprocess_dir = multiprocess_dir
+        self._top_k = top_k
+        self.sketch = SpaceSaving(self.sketch_factor * top_k)
+        # counts of the tracked repos since they were added, by (provider, repo):
+        # {status: count}
+        self.repo_counts = {}
+        # the exported repos, by (provider, repo):
+        # {status: count when the repo was exported}
+        self.exported = {}
+        # counts of all events by (status, provider)
+        self.totals = defaultdict(float)
+
+    @property
+    def top_k(self):
+        return self._top_k
+
+    @top_k.setter
+    def top_k(self, top_k):
+        self._top_k = top_k
+        for key in self.sketch.resize(self.sketch_factor * top_k):
+            self._forget(key)
+        self._update_exported()
+
+    def _forget(self, key):
+        self.repo_counts.pop(key, None)
+        self.exported.pop(key, None)
+
+    def labels(self, status, provider, repo):
+        return _RepoCounterChild(self, status, provider, repo)
+
+    def inc(self, status, provider, repo, amount=1):
+        key = (provider, repo)
+        self.totals[(status, provider)] += amount
+        evicted = self.sketch.add(key, amount)
+        if evicted is not None:
+            self._forget(evicted)
+        counts = self.repo_counts.get(key)
+        if counts is None:
+            counts = self.repo_counts[key] = defaultdict(float)
+        # before counting, so that a newly exported repo's series has this event
+        self._update_exported()
+        counts[status] += amount
+        if self.multiprocess_dir:
+            self._write()
+
+    def _update_exported(self):
+        """Choose the repos to export, keeping the current ones on ties"""
+        threshold = self.sketch.min_count()
+        guaranteed = {
+            key: count - error
+            for key, (count, error) in self.sketch.counters.items()
+            if count - error > threshold
+        }
+        top = heapq.nlargest(
+            self.top_k,
+            guaranteed,
+            key=lambda key: (guaranteed[key], key in self.exported),
+        )
+        self.exported = {
+            key: self.exported[key] if key in self.exported else dict(self.repo_counts[key])
+            for key in top
+        }
+
+    def samples(self):
+        """Return the counts to export, {(status, provider, repo): count}"""
+        samples = {}
+        others = dict(self.totals)
+        for (provider, repo), exported_counts in self.exported.items():
+            for status, count in self.repo_counts[(provider, repo)].items():
+                count -= exported_counts.get(status, 0)
+                samples[(status, provider, repo)] = count
+                others[(status, provider)] -= count
+        for (status, provider), count in others.items():
+            samples[(status, provider, 'other')] = count
+        return samples
+
+    def _path(self, pid='*'):
+        return os.path.join(self.multiprocess_dir, f"repo_counts_{self.name}_{pid}.json")
+
+    def _write(self):
+        """Write the counts of this process, for the other processes"""
+        path = self._path(os.getpid())
+        with open(path + '.tmp', 'w') as f:
+            json.dump([list(key) + [count] for key, count in self.samples().items()], f)
+        os.replace(path + '.tmp', path)
+
+    def _read(self):
+        """Add up the counts written by all processes"""
+        samples = defaultdict(float)
+        for path in glob.glob(self._path()):
+            try:
+                with open(path) as f:
+                    process_samples = json.load(f)
+            except (OSError, ValueError):
+                # removed, or being replaced
+                continue
+            for status, provider, repo, count in process_samples:
+                samples[(status, provider, repo)] += count
+        return samples
+
+    def collect(self):
+        metric = CounterMetricFamily(
+            self.name, self.documentation, labels=['status', 'provider', 'repo']
+        )
+        samples = self._read() if self.multiprocess_dir else self.samples()
+        for (status, provider, repo), count in samples.items():
+            metric.add_metric([status, provider, repo], count)
+        yield metric
+
+    def describe(self):
+        return [
+            CounterMetricFamily(
+                self.name, self.documentation, labels=['status', 'provider', 'repo']
+            )
+        ]
@@ -0,0 +1,215 @@
+"""
+Latency tracking, hedged requests and circuit breaking for upstream services
+"""
+import asyncio
+from collections import deque
+import time
+
+from prometheus_client import Counter, Gauge
+from tornado.httpclient import HTTPError
+from traitlets.config import LoggingConfigurable
+from traitlets import Float, Integer, Unicode
+
+HEDGED_REQUESTS = Counter(
+    'binderhub_upstream_hedged_requests',
+    'Requests duplicated because the first one was slower than usual',
+    ['upstream'],
+)
+CIRCUIT_OPEN = Gauge(
+    'binderhub_upstream_circuit_open',
+    'Whether requests to the upstream are currently failing fast (1) or not (0)',
+    ['upstream'],
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of making a request to an upstream that keeps failing"""
+
+
+def is_upstream_error(e):
+    """Return whether the exception `e` means the upstream is unavailable
+
+    As opposed to a response from a healthy upstream, e.g. 304 or 404.
+    """
+    if isinstance(e, HTTPError):
+        # 599 is a timeout or connection error
+        return e.code >= 500
+    return isinstance(e, (CircuitOpenError, OSError, asyncio.TimeoutError))
+
+
+class Upstream(LoggingConfigurable):
+    """Track the health of an upstream service, e.g. an API used to resolve refs
+
+    Requests made with :meth:`fetch`:
+
+    - are hedged: when a request takes longer than the recent
+      `hedge_percentile` latency, a second identical request is made,
+      and the first successful response is used.
+    - fail fast with :class:`CircuitOpenError` after `failure_threshold`
+      consecutive upstream errors, for `reset_timeout` seconds.
+      After that, a single trial request is let through,
+      closing the circuit again if it succeeds.
+
+    There is one instance per upstream name, shared by all requests.
+    """
+
+    # shared instances, by name
+    _instances = {}
+
+    name = Unicode()
+
+    hedge_percentile = Float(
+        95,
+        config=True,
+        help="""Percentile of recent latencies after which to hedge a request
+
+        0 disables hedged requests.
+        """,
+    )
+
+    hedge_min_samples = Integer(
+        20,
+        config=True,
+        help="""Number of recent requests to track before hedging requests""",
+    )
+
+    hedge_min_delay = Float(
+        0.1,
+        config=True,
+        help="""Minimum time (in seconds) to wait before hedging a request""",
+    )
+
+    window = Integer(
+        100,
+        config=True,
+        help="""Number of recent request latencies to track""",
+    )
+
+    failure_threshold = Integer(
+        5,
+        config=True,
+        help="""Number of consecutive upstream errors after which requests fail fast
+
+        0 disables failing fast.
+        """,
+    )
+
+    reset_timeout = Float(
+        30,
+        config=True,
+        help="""Time (in seconds) to fail fast before trying the upstream again""",
+    )
+
+    @classmethod
+    def instance_for(cls, name, config=None):
+        """Return the shared instance for the upstream `name`"""
+        if name not in cls._instances:
+            cls._instances[name] = cls(name=name, config=config)
+        return cls._instances[name]
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.latencies = deque(maxlen=self.window)
+        self.failures = 0
+        self.opened_at = None
+        self._trial = None
+
+    def _now(self):
+        return time.perf_counter()
+
+    def hedge_delay(self):
+        """Return the time to wait before hedging a request, or None not to hedge"""
+        if not self.hedge_percentile or len(self.latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self.latencies)
+        index = min(int(len(latencies) * self.hedge_percentile / 100), len(latencies) - 1)
+        return max(latencies[index], self.hedge_min_delay)
+
+    def retry_in(self):
+        """Return the time (in seconds) until the next trial request, if failing fast"""
+        if self.opened_at is None:
+            return 0
+        return max(self.opened_at + self.reset_timeout - self._now(), 0)
+
+    def check(self):
+        """Raise CircuitOpenError if requests should fail fast"""
+        if self.opened_at is None:
+            return
+        retry_in = self.retry_in()
+        if retry_in > 0 or (self._trial is not None and not self._trial.done()):
+            raise CircuitOpenError(
+                "{name} is currently unavailable. Try again in {seconds} seconds.".format(
+                    name=self.name, seconds=max(int(retry_in), 1)
+                )
+            )
+
+    def record_success(self, latency=None):
+        if latency is not None:
+            self.latencies.append(latency)
+        self.failures = 0
+        if self.opened_at is not None:
+            self.log.info("Upstream %s is available again", self.name)
+            self.opened_at = None
+            CIRCUIT_OPEN.labels(self.name).set(0)
+
+    def record_failure(self):
+        self.failures += 1
+        if self.failure_threshold and self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                self.log.warning(
+                    "Upstream %s failed %i times in a row, failing fast for %is",
+                    self.name,
+                    self.failures,
+                    self.reset_timeout,
+                )
+                CIRCUIT_OPEN.labels(self.name).set(1)
+            # (re)start failing fast, also after a failed trial request
+            self.opened_at = self._now()
+
+    async def fetch(self, fetch):
+        """Make a request with `fetch`, a callable returning an awaitable
+
+        `fetch` may be called twice (when hedging),
+        so it should only make idempotent requests.
+        """
+        self.check()
+        start = self._now()
+        task = asyncio.ensure_future(self._hedged(fetch))
+        if self.opened_at is not None:
+            # trial request after reset_timeout
+            self._trial = task
+        try:
+            result = await task
+        except Exception as e:
+            if is_upstream_error(e):
+                self.record_failure()
+            else:
+                self.record_success(self._now() - start)
+            raise
+        self.record_success(self._now() - start)
+        return result
+
+    async def _hedged(self, fetch):
+        first = asyncio.ensure_future(fetch())
+        delay = self.hedge_delay()
+        if delay is None:
+            return await first
+        done, _ = await asyncio.wait([first], timeout=delay)
+        if done:
+            return first.result()
+
+        self.log.debug("Hedging request to %s after %.3fs", self.name, delay)
+        HEDGED_REQUESTS.labels(self.name).inc()
+        pending = {first, asyncio.ensure_future(fetch())}
+        while True:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for future in done:
+                error = future.exception()
+                # use the first response, unless the upstream failed
+                # and the other request may still succeed
+                if error is None or not is_upstream_error(error) or not pending:
+                    for other in pending:
+                        other.cancel()
+                    return future.result()
@@ -2,6 +2,7 @@
 from collections import OrderedDict
 from hashlib import blake2b
 import ipaddress
+import os
 import time
 
 from traitlets import Integer, TraitError
@@ -141,6 +142,45 @@ class Cache(OrderedDict):
         self._ages.pop(key)
         return result
 
+    def age(self, key):
+        """Return the time (in seconds) since `key` was last set"""
+        return self._now() - self._ages[key]
+
+    def snapshot(self):
+        """Return a list of ``[key, value, age]`` for all unexpired items
+
+        Items are ordered from least to most recently used,
+        and age is in seconds, so that the result can be serialized
+        and later passed to :meth:`restore`, e.g. in another process.
+        """
+        now = self._now()
+        items = []
+        for key in list(self):
+            if self._check_expired(key):
+                continue
+            items.append([key, self[key], now - self._ages[key]])
+        return items
+
+    def restore(self, items, elapsed=0):
+        """Restore items previously returned by :meth:`snapshot`
+
+        `elapsed` is the time (in seconds) since the snapshot was taken,
+        which is added to the age of each item so that
+        items already past `max_age` are not restored.
+
+        Keys serialized as lists (e.g. tuples round-tripped through JSON)
+        are restored as tuples.
+        """
+        now = self._now()
+        for key, value, age in items:
+            if isinstance(key, list):
+                key = tuple(key)
+            age = age + elapsed
+            if self.max_age and age > self.max_age:
+                continue
+            self.set(key, value)
+            self._ages[key] = now - age
+
 
 def url_path_join(*pieces):
     """Join components of url into a relative url.
@@ -165,6 +205,16 @@ def url_path_join(*pieces):
     return result
 
 
+def multiprocess_dir():
+    """Return the directory of prometheus metrics shared by worker processes
+
+    or None, if prometheus_client isn't in multiprocess mode.
+    """
+    return os.environ.get("PROMETHEUS_MULTIPROC_DIR") or os.environ.get(
+        "prometheus_multiproc_dir"
+    )
+
+
 def ip_in_networks(ip, networks, min_prefix_len=1):
     """Return whether `ip` is in the dict of networks
 
@@ -194,15 +244,151 @@ def ip_in_networks(ip, networks, min_prefix_len=1):
     return False
 
 
-# FIXME: remove when instantiating a kubernetes client
-# doesn't create N-CPUs threads unconditionally.
-# monkeypatch threadpool in kubernetes api_client
-# to avoid instantiating ThreadPools.
-# This is known to work for kubernetes-4.0
-# and may need updating with later kubernetes clients
+class _RadixNode:
+    """Node of a path-compressed binary radix tree
+
+    `key` is the first `length` bits of the addresses below this node.
+    """
+
+    __slots__ = ("key", "length", "value", "children")
+
+    def __init__(self, key, length, value=None):
+        self.key = key
+        self.length = length
+        self.value = value
+        self.children = [None, None]
+
+
+def _bit(key, length, index):
+    """Return bit `index` (from the most significant) of `key`, a `length`-bit integer"""
+    return (key >> (length - index - 1)) & 1
+
 
-from unittest.mock import Mock
-from kubernetes.client import api_client
+class _RadixTree:
+    """Path-compressed binary radix tree of networks of one IP version
 
-_dummy_pool = Mock()
-api_client.ThreadPool = lambda *args, **kwargs: _dummy_pool
+    Finds the longest network containing an address
+    in at most one step per stored network on the path, instead of one per bit.
+    """
+
+    def __init__(self, bits):
+        self.bits = bits
+        self.root = _RadixNode(0, 0)
+
+    def insert(self, prefix, length, value):
+        """Insert the network of the `length`-bit integer `prefix`"""
+        node = self.root
+        while True:
+            if node.length == length:
+                node.value = value
+                return
+            branch = _bit(prefix, length, node.length)
+            child = node.children[branch]
+            if child is None:
+                node.children[branch] = _RadixNode(prefix, length, value)
+                return
+            # length of the common prefix of the new network and the child
+            shortest = min(length, child.length)
+            diff = (prefix >> (length - shortest)) ^ (child.key >> (child.length - shortest))
+            common = shortest - diff.bit_length()
+            if common == child.length:
+                # the child contains the new network
+                node = child
+                continue
+            new = _RadixNode(prefix, length, value)
+            if common == length:
+                # the new network contains the child
+                new.children[_bit(child.key, child.length, length)] = child
+                node.children[branch] = new
+                return
+            # the new network and the child only share a shorter prefix
+            split = _RadixNode(prefix >> (length - common), common)
+            split.children[_bit(prefix, length, common)] = new
+            split.children[_bit(child.key, child.length, common)] = child
+            node.children[branch] = split
+            return
+
+    def lookup(self, address):
+        """Return the value of the longest network containing the integer `address`"""
+        bits = self.bits
+        node = self.root
+        found = node.value
+        while node.length < bits:
+            child = node.children[(address >> (bits - node.length - 1)) & 1]
+            if child is None or (address >> (bits - child.length)) != child.key:
+                break
+            node = child
+            if node.value is not None:
+                found = node.value
+        return found
+
+
+class NetworkMatcher:
+    """Match IP addresses against a (large) dict of networks
+
+    A replacement for `ip_in_networks`, for lists of up to
+    tens of thousands of mixed IPv4 and IPv6 networks (e.g. from abuse feeds).
+    The networks are compiled into a radix tree per IP version,
+    and the results for recent addresses are cached.
+
+    Use :meth:`for_networks` to reuse the matcher of the same dict of networks.
+    """
+
+    # the last compiled matcher
+    _last = None
+
+    @classmethod
+    def for_networks(cls, networks, cache_size=4096):
+        """Return a NetworkMatcher for `networks`, reusing the last one if it's the same dict
+
+        Changes made to the dict in place are not noticed.
+        """
+        last = cls._last
+        if last is not None and last.networks is networks:
+            return last
+        cls._last = matcher = cls(networks, cache_size=cache_size)
+        return matcher
+
+    def __init__(self, networks, cache_size=4096):
+        """networks: dict of ip_network (or CIDR string) to value"""
+        self.networks = networks
+        self._trees = {4: _RadixTree(32), 6: _RadixTree(128)}
+        for network, value in networks.items():
+            if not isinstance(network, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+                network = ipaddress.ip_network(network)
+            self._trees[network.version].insert(
+                int(network.network_address) >> (network.max_prefixlen - network.prefixlen),
+                network.prefixlen,
+                (network, value),
+            )
+        self.cache = Cache(cache_size)
+
+    def match(self, ip):
+        """Return `(network, networks[network])` for the longest network containing ip
+
+        or False if none does, like ip_in_networks.
+        """
+        found = self.cache.get(ip)
+        if found is None:
+            address = ipaddress.ip_address(ip)
+            found = self._trees[address.version].lookup(int(address)) or False
+            self.cache.set(ip, found)
+        return found
+
+
+def patch_kubernetes_threadpool():
+    """Patch the kubernetes client, before creating one
+
+    Not done on import, so kubernetes is only imported when needed.
+    """
+    # FIXME: remove when instantiating a kubernetes client
+    # doesn't create N-CPUs threads unconditionally.
+    # monkeypatch threadpool in kubernetes api_client
+    # to avoid instantiating ThreadPools.
+    # This is known to work for kubernetes-4.0
+    # and may need updating with later kubernetes clients
+    from unittest.mock import Mock
+    from kubernetes.client import api_client
+
+    _dummy_pool = Mock()
+    api_client.ThreadPool = lambda *args, **kwargs: _dummy_pool
@@ -1,6 +1,7 @@
 """Launching a binder via API
 
-The binder build API yields a sequence of messages via event-stream.
+The binder build API yields a sequence of messages via event-stream,
+or via a (compressed) WebSocket at /ws/build/... with --websocket.
 This example demonstrates how to consume events from the stream
 and redirect to the URL when it is ready.
 
@@ -13,6 +14,8 @@ import sys
 import webbrowser
 
 import requests
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
 
 
 def build_binder(repo,
@@ -33,6 +36,26 @@ def build_binder(repo,
             yield json.loads(line.split(':', 1)[1])
 
 
+def build_binder_ws(repo,
+                    ref,
+                    *,
+                    binder_url='https://mybinder.org'):
+    """Launch a binder, receiving events over a WebSocket
+
+    Yields the same events as build_binder
+    """
+    print("Building binder for {repo}@{ref}".format(repo=repo, ref=ref))
+    url = binder_url.replace('http', 'ws', 1) + '/ws/build/gh/{repo}/{ref}'.format(repo=repo, ref=ref)
+    loop = IOLoop.current()
+    # enable permessage-deflate
+    ws = loop.run_sync(lambda: websocket_connect(url, compression_options={}))
+    while True:
+        message = loop.run_sync(ws.read_message)
+        if message is None:
+            break
+        yield json.loads(message)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument('repo', type=str, help="The GitHub repo to build")
@@ -50,9 +73,14 @@ if __name__ == '__main__':
         The URL of the binder instance to use.
         Use `http://localhost:8585` if you are doing local testing.
     """)
+    parser.add_argument(
+        '--websocket',
+        action='store_true',
+        help="Receive events over a WebSocket instead of an event-stream")
     opts = parser.parse_args()
 
-    for evt in build_binder(
+    build = build_binder_ws if opts.websocket else build_binder
+    for evt in build(
             opts.repo,
             ref=opts.ref,
             binder_url=opts.binder):
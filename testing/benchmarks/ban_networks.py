@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""Microbenchmarks of checking request IPs against ban_networks
+
+Compares utils.ip_in_networks with utils.NetworkMatcher,
+without and with its cache, for random lists of IPv4 and IPv6 networks
+of the size of abuse feeds::
+
+    python testing/benchmarks/ban_networks.py --networks 50000
+"""
+import argparse
+import ipaddress
+import random
+import timeit
+
+from binderhub.utils import NetworkMatcher, ip_in_networks
+
+
+def random_networks(rng, n, ipv6_fraction):
+    networks = {}
+    while len(networks) < n:
+        if rng.random() < ipv6_fraction:
+            bits, prefix_len = 128, rng.choice([32, 48, 56, 64, 128])
+        else:
+            bits, prefix_len = 32, rng.choice([16, 20, 24, 28, 32])
+        address = rng.getrandbits(prefix_len) << (bits - prefix_len)
+        network = ipaddress.ip_network((address, prefix_len))
+        networks[network] = str(network)
+    return networks
+
+
+def random_ips(rng, networks, n):
+    """Half in a banned network, half random"""
+    network_list = list(networks)
+    ips = []
+    for i in range(n):
+        network = rng.choice(network_list)
+        if i % 2:
+            address = network.network_address + rng.randrange(
+                min(network.num_addresses, 1 << 16)
+            )
+        else:
+            address = ipaddress.ip_address(rng.getrandbits(network.max_prefixlen))
+        ips.append(str(address))
+    return ips
+
+
+def bench(label, check, ips, repeat):
+    def run():
+        for ip in ips:
+            check(ip)
+
+    best = min(timeit.repeat(run, number=1, repeat=repeat))
+    print(f"{label:32} {best / len(ips) * 1e6:8.2f} µs/ip")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--networks", type=int, default=20000)
+    parser.add_argument("--ips", type=int, default=10000)
+    parser.add_argument("--ipv6-fraction", type=float, default=0.3)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    networks = random_networks(rng, args.networks, args.ipv6_fraction)
+    ips = random_ips(rng, networks, args.ips)
+
+    compile_time = timeit.timeit(lambda: NetworkMatcher(networks), number=1)
+    print(f"{len(networks)} networks, compiled in {compile_time * 1e3:.1f} ms")
+
+    bench("ip_in_networks", lambda ip: ip_in_networks(ip, networks), ips, args.repeat)
+    # a cache of one entry: every lookup goes to the tree
+    uncached = NetworkMatcher(networks, cache_size=1)
+    bench("NetworkMatcher (uncached)", uncached.match, ips, args.repeat)
+    cached = NetworkMatcher(networks, cache_size=len(ips))
+    bench("NetworkMatcher (cached)", cached.match, ips, args.repeat)
+
+
+if __name__ == "__main__":
+    main()